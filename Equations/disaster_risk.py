@@ -1,63 +1,35 @@
+import csv
+import json
+import os
+import threading
 import requests
 import pycountry
+import numpy as np
 from geopy.distance import geodesic
-from ML.weather_detection_model import get_extreme_weather
+from sklearn.neighbors import BallTree
+from ML.weather_detection_model import get_extreme_weather, get_extreme_weather_batch
 
 # OpenStreetMap API for geocoding
 GEOCODE_API_URL = "https://nominatim.openstreetmap.org/search"
 HEADERS = {"User-Agent": "DisasterRiskChecker/1.0 (contact@example.com)"}
 
-# Disaster hotspot database
-DISASTER_HOTSPOTS = {
-    # Major Tectonic Plate Boundaries & Earthquake Faults
-    "San Andreas Fault (California, USA)": (35.775, -119.750),
-    "Cascadia Subduction Zone (Pacific Northwest, USA/Canada)": (44.000, -125.000),
-    "New Madrid Seismic Zone (Missouri, USA)": (36.6000, -89.6000),
-    "North Anatolian Fault (Turkey)": (40.923, 32.521),
-    "Japan Trench (Pacific Ring of Fire)": (38.000, 142.000),
-    "Himalayan Collision Zone (Nepal, India)": (28.3949, 84.1240),
-    "Alpide Belt (Italy, Greece, Turkey, Iran)": (42.7339, 12.8289),
-    "South American Subduction Zone (Peru, Chile)": (-33.4489, -70.6693),
-    "East African Rift (Ethiopia, Kenya, Tanzania)": (-6.3690, 34.8888),
-
-    # Volcanic Eruption Risk Areas
-    "Yellowstone Supervolcano (USA)": (44.4280, -110.5885),
-    "Mount St. Helens (Washington, USA)": (46.1912, -122.1944),
-    "Icelandic Volcanoes (Mid-Atlantic Ridge)": (64.1355, -21.8954),
-    "Mount Fuji (Japan - Pacific Plate)": (35.3606, 138.7274),
-    "Mount Vesuvius (Italy - African/Eurasian Plate)": (40.8224, 14.4289),
-    "Krakatoa Volcano (Indonesia - Indo-Australian Plate)": (-6.102, 105.423),
-    "Mount Etna (Italy)": (37.7550, 14.9950),
-    "Taal Volcano (Philippines)": (14.0024, 120.9938),
-
-    # Tsunami-Prone Subduction Zones
-    "Tsunami Risk Zone (Indonesia)": (-0.7893, 113.9213),
-    "Japan Trench Tsunami Zone (Japan)": (38.297, 141.883),
-    "Cascadia Tsunami Zone (West Coast, USA/Canada)": (44.500, -125.000),
-    "Chilean Tsunami Zone (South America)": (-33.047, -71.612),
-    "Indian Ocean Tsunami Zone (Sri Lanka, India, Thailand)": (9.1220, 92.7440),
-
-    # Hurricane, Cyclone, and Typhoon Hotspots
-    "Hurricane Zone (Florida, USA)": (25.7617, -80.1918),
-    "Gulf of Mexico Hurricane Zone (USA)": (27.500, -90.000),
-    "Caribbean Hurricane Zone (Puerto Rico, Cuba, Bahamas)": (20.000, -75.000),
-    "Indian Ocean Cyclone Zone (Bangladesh, India, Myanmar)": (20.000, 88.000),
-
-    # Tornado & Extreme Storm Zones
-    "Tornado Alley (USA - Texas, Oklahoma, Kansas)": (37.000, -97.000),
-    "Great Plains Tornado Zone (Midwest USA)": (39.000, -94.000),
-    "Bangladesh Tornado Risk Area": (24.000, 90.000),
-
-    # Major Flood-Prone River Basins
-    "Mississippi River Flood Zone (USA)": (34.000, -90.000),
-    "Amazon River Flood Zone (Brazil)": (-3.4653, -62.2159),
-    "Ganges River Flood Zone (India, Bangladesh)": (25.000, 83.000),
-
-    # Wildfire Risk Areas
-    "California Wildfire Zone (USA)": (37.7749, -119.4194),
-    "Australia Bushfire Zone (Victoria, New South Wales)": (-37.8136, 144.9631),
-    "Siberian Wildfire Zone (Russia)": (60.000, 105.000)
-}
+# Disaster hotspot catalogue, one row per hazard site with its name, latitude, longitude and category.
+# A GeoJSON FeatureCollection of Points with a "name" property works too
+HOTSPOTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "disaster_hotspots.csv")
+# Mean earth radius in km, as used by geopy's great_circle
+EARTH_RADIUS_KM = 6371.0088
+# Closest hotspots by haversine distance that are measured again with geodesic. The two
+# differ by well under 1%, so the geodesic nearest is always among the first few
+GEODESIC_CANDIDATES = 5
+
+# Read both risk components from the precomputed grid (Equations/risk_grid.py) once one has been
+# built, falling back to computing them for points the grid has no weather for
+USE_RISK_GRID = True
+# Interpolate between grid cell centres instead of reading the cell a point falls in
+RISK_GRID_INTERPOLATE = False
+# Keep reading a grid that went stale (too old, or built on an older weather dataset) instead
+# of computing every quote live until it is rebuilt; a warning is printed either way
+SERVE_STALE_RISK_GRID = False
 
 # Convert Country Name to ISO Code
 def get_country_code(country_name):
@@ -67,37 +39,139 @@ def get_country_code(country_name):
     except LookupError:
         raise ValueError(f"Invalid country name: {country_name}")
 
+# Postcodes are looked up with spacing and case normalised, so "ne1 7ru" and "NE1 7RU" are the same key
+def normalise_postcode(postcode):
+    return " ".join(str(postcode).split()).upper()
+
+# Geocoder backend that asks Nominatim. A backend has geocode(postcode, country_code), returning
+# (lat, lon, display_name), None if nothing matches, and raising ValueError when the lookup failed.
+# Its name is recorded as the source of the answers cached by core.geocoding.CachedGeocoder
+class NominatimGeocoder:
+    name = "NOMINATIM"
+
+    def __init__(self, api_url=GEOCODE_API_URL, headers=HEADERS, timeout=10):
+        self.api_url = api_url
+        self.headers = headers
+        self.timeout = timeout
+
+    def geocode(self, postcode, country_code):
+        params = {"postalcode": postcode, "country": country_code, "format": "json"}
+        try:
+            response = requests.get(self.api_url, params=params, headers=self.headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise ValueError(f"Error fetching geocode data: {e}")
+
+        if response.status_code != 200:
+            raise ValueError(f"Error fetching geocode data: HTTP {response.status_code}")
+
+        data = response.json()
+        if not data:
+            return None
+
+        # Select first matching location
+        selected_location = data[0]
+        lat, lon = float(selected_location['lat']), float(selected_location['lon'])
+        return lat, lon, selected_location.get("display_name", "Unknown Location")
+
+# Backend used by get_coordinates_from_postcode. The Django app swaps in its database cached
+# geocoder on startup, tests can install a local stand-in the same way
+_geocoder = NominatimGeocoder()
+
+def get_geocoder():
+    return _geocoder
+
+def set_geocoder(geocoder):
+    global _geocoder
+    _geocoder = geocoder
+
 # Fetch Coordinates from Postal Code
 def get_coordinates_from_postcode(postcode, country_name):
     country_code = get_country_code(country_name)  # Auto-convert country name to code
-    params = {"postalcode": postcode, "country": country_code, "format": "json"}
-    response = requests.get(GEOCODE_API_URL, params=params, headers=HEADERS)
+    location = _geocoder.geocode(normalise_postcode(postcode), country_code)
 
-    if response.status_code != 200:
-        raise ValueError(f"Error fetching geocode data: HTTP {response.status_code}")
+    if location is None:
+        raise ValueError(f"Could not fetch coordinates for postal code: {postcode} in {country_name}")
 
-    data = response.json()
+    return location
 
-    if not data:
-        raise ValueError(f"Could not fetch coordinates for postal code: {postcode} in {country_name}")
+# Load the hotspot catalogue as (names, categories, lat/lon array in degrees)
+def load_hotspots(path=HOTSPOTS_FILE):
+    names, categories, coordinates = [], [], []
+    if path.lower().endswith((".geojson", ".json")):
+        with open(path, encoding="utf-8") as hotspots_file:
+            for feature in json.load(hotspots_file)["features"]:
+                lon, lat = feature["geometry"]["coordinates"][:2]  # GeoJSON is (lon, lat)
+                properties = feature.get("properties") or {}
+                names.append(properties["name"])
+                categories.append(properties.get("category", ""))
+                coordinates.append((float(lat), float(lon)))
+    else:
+        with open(path, newline="", encoding="utf-8") as hotspots_file:
+            for row in csv.DictReader(hotspots_file):
+                names.append(row["name"])
+                categories.append(row.get("category", ""))
+                coordinates.append((float(row["latitude"]), float(row["longitude"])))
 
-    # Select first matching location
-    selected_location = data[0]
-    lat, lon = float(selected_location['lat']), float(selected_location['lon'])
-    return lat, lon, selected_location.get("display_name", "Unknown Location")
+    if not coordinates:
+        raise ValueError(f"No disaster hotspots found in {path}")
+    return names, categories, np.array(coordinates, dtype=np.float64)
 
-# Calculate Distance to Nearest Disaster Hotspot
-def calculate_distance_to_hotspots(user_location):
-    min_distance = float("inf")
-    closest_hotspot = None
+# Haversine ball tree over the hotspot catalogue, so the nearest hotspot is found in
+# logarithmic time however many hazard sites there are
+class HotspotIndex:
+    def __init__(self, names, categories, coordinates):
+        self.names = names
+        self.categories = categories
+        self.coordinates = coordinates
+        self.tree = BallTree(np.radians(coordinates), metric="haversine")
+
+    @classmethod
+    def from_file(cls, path=HOTSPOTS_FILE):
+        return cls(*load_hotspots(path))
+
+    def nearest(self, locations, candidates=GEODESIC_CANDIDATES):
+        """
+        Takes (lat, lon) pairs and returns, for each, (distance in km, hotspot position).
+        With candidates > 1 the closest few hotspots by haversine distance are measured
+        again with geodesic, and the geodesic closest of them is returned with its
+        geodesic distance. With candidates=0 the haversine distance is returned as is.
+        """
+        locations = np.asarray(locations, dtype=np.float64).reshape(-1, 2)
+        k = min(max(candidates, 1), len(self.names))
+        distances, hotspots = self.tree.query(np.radians(locations), k=k)
+        if candidates == 0:
+            return list(zip(distances[:, 0] * EARTH_RADIUS_KM, hotspots[:, 0].tolist()))
+
+        results = []
+        for location, point_hotspots in zip(locations, hotspots):
+            geodesic_distances = [geodesic(tuple(location), tuple(self.coordinates[i])).km for i in point_hotspots]
+            closest = int(np.argmin(geodesic_distances))
+            results.append((geodesic_distances[closest], int(point_hotspots[closest])))
+        return results
+
+    def hotspot(self, position):
+        return self.names[position], tuple(self.coordinates[position].tolist())
 
-    for hotspot_name, hotspot_coords in DISASTER_HOTSPOTS.items():
-        distance = geodesic(user_location, hotspot_coords).km
-        if distance < min_distance:
-            min_distance = distance
-            closest_hotspot = (hotspot_name, hotspot_coords)
+_hotspot_index = None
+_hotspot_index_lock = threading.Lock()
 
-    return min_distance, closest_hotspot
+# Catalogue loaded from HOTSPOTS_FILE on first use
+def get_hotspot_index():
+    global _hotspot_index
+    if _hotspot_index is None:
+        with _hotspot_index_lock:
+            if _hotspot_index is None:
+                _hotspot_index = HotspotIndex.from_file()
+    return _hotspot_index
+
+# Calculate Distance to Nearest Disaster Hotspot
+def calculate_distance_to_hotspots(user_location, candidates=GEODESIC_CANDIDATES):
+    return calculate_distances_to_hotspots([user_location], candidates)[0]
+
+# Same as above for many locations in one tree query, returns a list of (distance, (name, coords))
+def calculate_distances_to_hotspots(user_locations, candidates=GEODESIC_CANDIDATES):
+    index = get_hotspot_index()
+    return [(distance, index.hotspot(position)) for distance, position in index.nearest(user_locations, candidates)]
 
 # Normalized Risk Score Calculation
 def get_normalized_risk_score(distance):
@@ -114,13 +188,36 @@ def get_normalized_risk_score(distance):
 def calculate_final_risk_score(proximity_risk_score, disaster_frequency_score):
     return round((proximity_risk_score + disaster_frequency_score) / 2, 2)
 
+# Grid to read risk components from, None when it is disabled, not built yet or stale
+def get_active_risk_grid():
+    if not USE_RISK_GRID:
+        return None
+    from Equations.risk_grid import get_risk_grid  # risk_grid imports this module
+    return get_risk_grid(allow_stale=SERVE_STALE_RISK_GRID)
+
 # Main Function to Get Disaster Risk
 def get_disaster_risk(postcode,country_name):
 
     try:
         lat, lon, formatted_address = get_coordinates_from_postcode(postcode, country_name)
-        disaster_frequency_score = get_extreme_weather(lat, lon, timeframe_in_days=365, percent_to_consider_extreme=50)
         location = (lat, lon)
+
+        risk_grid = get_active_risk_grid()
+        components = risk_grid.components(lat, lon, RISK_GRID_INTERPOLATE) if risk_grid is not None else None
+        if components is not None:
+            proximity_risk_score, disaster_frequency_score = components
+            final_risk_score = calculate_final_risk_score(proximity_risk_score, disaster_frequency_score)
+
+            print(f"\n Disaster Risk Assessment (risk grid) ")
+            print(f"Postal Code: {postcode} ({country_name})")
+            print(f"Location: {formatted_address}")
+            print(f"Coordinates: {location}")
+            print(f"Proximity Risk Score: {proximity_risk_score:.2f} (0 - 1 scale)")
+            print(f"Disaster Frequency Score: {disaster_frequency_score:.2f} (0 - 1 scale)")
+            print(f"Final Risk Score: {final_risk_score:.2f} (0 - 1 scale)")
+            return final_risk_score
+
+        disaster_frequency_score = get_extreme_weather(lat, lon, timeframe_in_days=365, percent_to_consider_extreme=50)
         distance, nearest_hotspot = calculate_distance_to_hotspots(location)
         proximity_risk_score = get_normalized_risk_score(distance)
 
@@ -141,6 +238,52 @@ def get_disaster_risk(postcode,country_name):
     except ValueError as e:
         print(f"Error: {e}")
 
+# Disaster Risk for many properties at once (e.g. repricing the whole portfolio)
+def get_disaster_risk_batch(locations):
+    """
+    Takes a list of (postcode, country_name) pairs and returns their final
+    risk scores in the same order. The weather model only runs once for the
+    whole list; locations that cannot be geocoded get None.
+    """
+    coordinates = []
+    for postcode, country_name in locations:
+        try:
+            lat, lon, _ = get_coordinates_from_postcode(postcode, country_name)
+            coordinates.append((lat, lon))
+        except ValueError as e:
+            print(f"Error: {e}")
+            coordinates.append(None)
+
+    return get_disaster_risk_for_coordinates(coordinates)
+
+def get_disaster_risk_for_coordinates(coordinates):
+    """
+    Final risk scores for a list of (lat, lon) pairs, in the same order. None
+    entries, and points without weather readings, get None. Points are read
+    from the risk grid when there is one; only the rest are computed.
+    """
+    risk_scores = [None] * len(coordinates)
+    pending = [i for i, location in enumerate(coordinates) if location is not None]
+
+    risk_grid = get_active_risk_grid()
+    if risk_grid is not None and pending:
+        proximity, frequency = risk_grid.components_batch([coordinates[i] for i in pending], RISK_GRID_INTERPOLATE)
+        for i, proximity_risk_score, disaster_frequency_score in zip(pending, proximity, frequency):
+            if not np.isnan(disaster_frequency_score):
+                risk_scores[i] = calculate_final_risk_score(float(proximity_risk_score), float(disaster_frequency_score))
+        pending = [i for i in pending if risk_scores[i] is None]
+
+    found = [coordinates[i] for i in pending]
+    frequency_scores = get_extreme_weather_batch(found, timeframe_in_days=365, percent_to_consider_extreme=50) if found else []
+    hotspot_distances = calculate_distances_to_hotspots(found) if found else []
+
+    for i, disaster_frequency_score, (distance, _) in zip(pending, frequency_scores, hotspot_distances):
+        proximity_risk_score = get_normalized_risk_score(distance)
+        if disaster_frequency_score is not None:
+            risk_scores[i] = calculate_final_risk_score(proximity_risk_score, disaster_frequency_score)
+
+    return risk_scores
+
 # Allow direct execution from the command line
 if __name__ == "__main__":
     get_disaster_risk()
\ No newline at end of file
@@ -1,13 +1,147 @@
+import json
+import threading
+from time import time
+
 import requests
 
+from Equations.single_flight import SingleFlight
+from ML.atomic_files import write_file_atomically
+
+RATE_API_URL = "https://min-api.cryptocompare.com/data/price"
+# Fetched together in one request whichever of them is asked for
+SUPPORTED_CURRENCIES = ["USD", "GBP", "EUR"]
+# Rates younger than this are used as they are
+RATE_TTL_SECONDS = 300
+# Up to this much older still, a rate is used while a fresh one is fetched in the background
+RATE_STALE_SECONDS = 3600
+# Rates are kept here between restarts, None keeps them in memory only. Django installs
+# a cache that keeps them in settings.ETH_RATE_CACHE_FILE (see core/apps.py)
+RATE_CACHE_FILE = None
+
+# Rate source that asks cryptocompare. A rate source has fetch(currency_codes), returning
+# {currency_code: ETH price in that currency} and raising ValueError if the request failed
+class CryptoCompareRateSource:
+    def __init__(self, api_url=RATE_API_URL, timeout=10):
+        self.api_url = api_url
+        self.timeout = timeout
+
+    def fetch(self, currency_codes):
+        params = {"fsym": "ETH", "tsyms": ",".join(currency_codes)}
+        try:
+            response = requests.get(self.api_url, params=params, timeout=self.timeout)
+            data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            raise ValueError(f"Error fetching exchange rates: {e}")
+        return {code: data[code] for code in currency_codes if code in data}
+
+# ETH exchange rates per currency code, kept in memory and in the file at path, if any
+class RateCache:
+    def __init__(self, source, ttl=RATE_TTL_SECONDS, stale=RATE_STALE_SECONDS, path=RATE_CACHE_FILE):
+        self.source = source
+        self.ttl = ttl
+        self.stale = stale
+        self.path = path
+        self._rates = None  # {code: (rate, fetched_at)}, read from path on first use
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._single_flight = SingleFlight()
+
+    def get_rate(self, currency_code):
+        """
+        Returns the ETH price in currency_code. A missing or expired rate is
+        fetched, with every supported currency in the same request and
+        concurrent callers sharing it. A rate past its TTL but within the stale
+        window is returned at once and refreshed in the background.
+        """
+        entry = self._get_entry(currency_code)
+        age = time() - entry[1] if entry is not None else None
+
+        if age is not None and age < self.ttl:
+            return entry[0]
+        if age is not None and age < self.ttl + self.stale:
+            self._refresh_in_background(currency_code)
+            return entry[0]
+
+        try:
+            self._single_flight.do("rates", lambda: self._refresh(currency_code))
+        except ValueError:
+            # Better an old rate than failing the request
+            if entry is not None:
+                return entry[0]
+            raise
+
+        entry = self._get_entry(currency_code)
+        if entry is None:
+            raise ValueError(f"Exchange rate for {currency_code} not found.")
+        return entry[0]
+
+    def _get_entry(self, currency_code):
+        with self._lock:
+            if self._rates is None:
+                self._rates = self._load()
+            return self._rates.get(currency_code)
+
+    def _refresh(self, currency_code=None):
+        codes = list(SUPPORTED_CURRENCIES)
+        if currency_code is not None and currency_code not in codes:
+            codes.append(currency_code)
+        fetched = self.source.fetch(codes)
+        fetched_at = time()
+        with self._lock:
+            rates = dict(self._rates or {})
+            rates.update({code: (rate, fetched_at) for code, rate in fetched.items()})
+            self._rates = rates
+        self._save(rates)
+
+    def _refresh_in_background(self, currency_code):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                self._single_flight.do("rates", lambda: self._refresh(currency_code))
+            except ValueError as e:
+                print(f"Error refreshing exchange rates: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def _load(self):
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path) as rates_file:
+                return {code: (rate, fetched_at) for code, (rate, fetched_at) in json.load(rates_file).items()}
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save(self, rates):
+        if self.path is None:
+            return
+        try:
+            write_file_atomically(self.path, json.dumps(rates).encode())
+        except OSError as e:
+            print(f"Error saving exchange rates: {e}")
+
+# Cache used by get_eth_rate. Install one with a local stand-in source for tests and benchmarks
+_rate_cache = RateCache(CryptoCompareRateSource())
+
+def get_rate_cache():
+    return _rate_cache
+
+def set_rate_cache(rate_cache):
+    global _rate_cache
+    _rate_cache = rate_cache
+
 def get_eth_rate(currency_code):
-    url = f"https://min-api.cryptocompare.com/data/price?fsym=ETH&tsyms={currency_code}"
-    response = requests.get(url)
-    data = response.json()
-    if currency_code in data:
-        return data[currency_code]
-    else:
-        raise ValueError(f"Exchange rate for {currency_code} not found.")
+    return _rate_cache.get_rate(currency_code)
+
+def get_eth_rates(currency_codes):
+    return {code: get_eth_rate(code) for code in set(currency_codes)}
 
 def convert_fiat_to_eth(amount, currency_code):
     rate = get_eth_rate(currency_code)
@@ -1,3 +1,5 @@
+from Equations.policy_engine import calculate_payouts_wei
+
 def final_payout_estimate_wei(d_final, house_value_wei, coverage_percentage=0.80):
     """
     Calculates the Final Official Payout in Wei without any multiplier or deductible.
@@ -11,11 +13,9 @@ def final_payout_estimate_wei(d_final, house_value_wei, coverage_percentage=0.80
     Returns:
       int: The final payout in Wei.
     """
-    # Calculate the insured portion of the house value in Wei.
-    insured_value_wei = house_value_wei * coverage_percentage
-
-    # Compute the final payout by multiplying by the final damage score.
-    final_payout_wei = int(insured_value_wei * d_final)
+    # Insured portion of the house value times the damage score, in exact integer Wei
+    # (see policy_engine, which does the same for a whole portfolio at once).
+    final_payout_wei = int(calculate_payouts_wei([d_final], [house_value_wei], coverage_percentage)[0])
     return final_payout_wei
 
 
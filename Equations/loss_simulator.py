@@ -0,0 +1,192 @@
+"""
+Monte Carlo simulator of aggregate portfolio losses.
+
+Every scenario samples, for every property, whether a disaster hits it (with
+probability riskLevel) and if so how bad the damage is, in the same three
+buckets as the damage assessment model (little/none, mild, severe). The
+payout of each bucket is final_payout_estimate_wei of that bucket's damage
+score, so the losses are what the payout formulas would pay.
+
+Scenarios are simulated in blocks of policies x scenarios spread over a
+process pool. Each block draws from its own SeedSequence child, picked by the
+block's position, so the result for a given seed is the same whatever the
+number of workers.
+
+Usage on a synthetic portfolio (from the project root):
+    python -m Equations.loss_simulator --policies 1000000 --scenarios 10000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+
+import numpy as np
+
+from Equations.policy_engine import WEI_PER_ETH, calculate_payouts_wei
+
+# Model classes 0, 1 and 2 of the damage assessment, with the damage score paid for each
+SEVERITY_BUCKETS = ["LITTLE_OR_NONE", "MILD", "SEVERE"]
+SEVERITY_DAMAGE_SCORES = (0.0, 0.4, 0.8)
+# How likely each bucket is once a disaster hits
+SEVERITY_PROBABILITIES = (0.6, 0.3, 0.1)
+VAR_LEVELS = (0.95, 0.99, 0.995)
+# Block size of one task, about 16MB of float32 draws
+POLICY_CHUNK = 32768
+SCENARIO_CHUNK = 128
+
+# Set in each worker by _init_worker
+_worker_inputs = None
+
+
+def severity_payouts_wei(house_values_wei, damage_scores=SEVERITY_DAMAGE_SCORES, coverage_percentage=0.80):
+    """
+    (policies, buckets) object array of the exact payout in wei of every
+    severity bucket, as final_payout_estimate_wei would give it.
+    """
+    return np.column_stack([calculate_payouts_wei(damage, house_values_wei, coverage_percentage)
+                            for damage in damage_scores])
+
+
+def _init_worker(inputs_dir):
+    global _worker_inputs
+    _worker_inputs = {name: np.load(os.path.join(inputs_dir, name + ".npy"), mmap_mode="r")
+                      for name in ("probabilities", "payout_steps", "thresholds")}
+
+
+def _simulate_block(task):
+    """Total loss in ETH of each scenario of a block, over the block's policies."""
+    scenario_count, policy_start, policy_end, seed = task
+    probabilities = np.asarray(_worker_inputs["probabilities"][policy_start:policy_end])
+    payout_steps = np.asarray(_worker_inputs["payout_steps"][:, policy_start:policy_end])
+    thresholds = _worker_inputs["thresholds"]
+
+    # One uniform draw decides both: a hit when u < p, and given a hit u / p is
+    # uniform again and picks the severity bucket
+    rng = np.random.default_rng(seed)
+    u = rng.random((scenario_count, policy_end - policy_start), dtype=np.float32)
+    u /= probabilities
+    totals = np.zeros(scenario_count)
+    # payout_steps holds each bucket's payout minus the one below, so a policy
+    # in bucket b is paid the sum of steps 0..b
+    for threshold, step in zip(thresholds, payout_steps):
+        totals += ((u >= threshold) & (u < 1)).astype(np.float32) @ step
+    return totals
+
+
+def simulate_portfolio_losses(risk_levels, house_values_wei, scenarios=10000, seed=0, workers=None,
+                              severity_probabilities=SEVERITY_PROBABILITIES, damage_scores=SEVERITY_DAMAGE_SCORES,
+                              coverage_percentage=0.80, occurrence_scale=1.0,
+                              policy_chunk=POLICY_CHUNK, scenario_chunk=SCENARIO_CHUNK):
+    """
+    Simulates scenarios of the whole portfolio and returns the total loss in
+    ETH of each scenario. risk_levels are the per-property probabilities of a
+    disaster (Property.riskLevel, times occurrence_scale) and house_values_wei
+    the house values in wei.
+    """
+    probabilities = np.clip(np.asarray(risk_levels, dtype=np.float64) * occurrence_scale, 0, 1)
+    severity_probabilities = np.asarray(severity_probabilities, dtype=np.float64)
+    if not np.isclose(severity_probabilities.sum(), 1):
+        raise ValueError("Severity probabilities must add up to 1")
+    if len(severity_probabilities) != len(damage_scores):
+        raise ValueError("Expected one damage score per severity bucket")
+
+    payouts = severity_payouts_wei(house_values_wei, damage_scores, coverage_percentage)
+    payouts_eth = np.array([[int(payout) / WEI_PER_ETH for payout in row] for row in payouts.T])
+    payout_steps = np.diff(payouts_eth, axis=0, prepend=0).astype(np.float32)
+    thresholds = np.concatenate([[0], np.cumsum(severity_probabilities)[:-1]]).astype(np.float32)
+    # Properties that can never be hit cost nothing, and would divide by zero
+    payable = probabilities > 0
+
+    policy_starts = range(0, int(payable.sum()), policy_chunk)
+    scenario_starts = range(0, scenarios, scenario_chunk)
+    seeds = np.random.SeedSequence(seed).spawn(len(policy_starts) * len(scenario_starts))
+    tasks = []
+    for scenario_block, scenario_start in enumerate(scenario_starts):
+        scenario_count = min(scenario_chunk, scenarios - scenario_start)
+        for policy_block, policy_start in enumerate(policy_starts):
+            tasks.append((scenario_count, policy_start, min(policy_start + policy_chunk, int(payable.sum())),
+                          seeds[scenario_block * len(policy_starts) + policy_block]))
+
+    workers = workers or os.cpu_count() or 1
+    inputs_dir = tempfile.mkdtemp(prefix="loss-simulator-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+    try:
+        np.save(os.path.join(inputs_dir, "probabilities.npy"), probabilities[payable].astype(np.float32))
+        np.save(os.path.join(inputs_dir, "payout_steps.npy"), np.ascontiguousarray(payout_steps[:, payable]))
+        np.save(os.path.join(inputs_dir, "thresholds.npy"), thresholds)
+
+        if workers == 1:
+            _init_worker(inputs_dir)
+            block_totals = map(_simulate_block, tasks)
+            return _collect(block_totals, tasks, scenarios, scenario_chunk)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker, initargs=(inputs_dir,)) as pool:
+            return _collect(pool.map(_simulate_block, tasks), tasks, scenarios, scenario_chunk)
+    finally:
+        shutil.rmtree(inputs_dir, ignore_errors=True)
+
+
+def _collect(block_totals, tasks, scenarios, scenario_chunk):
+    # Blocks come back in task order, so the sums are added up in the same order every run
+    losses = np.zeros(scenarios)
+    policy_blocks = len(tasks) // -(-scenarios // scenario_chunk) if tasks else 0
+    for i, totals in enumerate(block_totals):
+        scenario_start = (i // policy_blocks) * scenario_chunk
+        losses[scenario_start:scenario_start + len(totals)] += totals
+    return losses
+
+
+def summarise_losses(losses, var_levels=VAR_LEVELS):
+    """
+    Mean, spread, value at risk and tail value at risk (the mean loss of the
+    scenarios at or beyond the VaR) of simulated losses, in ETH.
+    """
+    losses = np.sort(np.asarray(losses))
+    summary = {
+        "scenarios": int(len(losses)),
+        "mean": float(losses.mean()),
+        "std": float(losses.std()),
+        "min": float(losses[0]),
+        "max": float(losses[-1]),
+        "var": {},
+        "tvar": {},
+    }
+    for level in var_levels:
+        var = float(np.quantile(losses, level))
+        summary["var"][str(level)] = var
+        summary["tvar"][str(level)] = float(losses[losses >= var].mean())
+    return summary
+
+
+def generate_portfolio(policies, seed=0):
+    """Synthetic (risk_levels, house_values_wei) roughly like the real portfolio."""
+    rng = np.random.default_rng(seed)
+    risk_levels = np.clip(rng.beta(2, 12, policies), 0, 1)
+    house_values_eth = rng.lognormal(np.log(120), 0.5, policies)
+    house_values_wei = (house_values_eth * 1e6).astype(np.int64).astype(object) * 10 ** 12
+    return risk_levels, house_values_wei
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate portfolio losses on a synthetic portfolio.")
+    parser.add_argument("--policies", type=int, default=100000)
+    parser.add_argument("--scenarios", type=int, default=10000)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--occurrence-scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    risk_levels, house_values_wei = generate_portfolio(args.policies, args.seed)
+    started = time()
+    losses = simulate_portfolio_losses(risk_levels, house_values_wei, args.scenarios, args.seed, args.workers,
+                                       occurrence_scale=args.occurrence_scale)
+    summary = summarise_losses(losses)
+    summary["seconds"] = round(time() - started, 3)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+from decimal import Decimal
+from fractions import Fraction
+
+import numpy as np
+
+# Batch premium and payout maths for whole portfolios in exact integer wei.
+# Rates such as 0.80 or 0.002 are taken at their decimal value (4/5, 1/500), not
+# their nearest binary float, and every result is truncated to a whole wei like
+# int() did in the scalar functions, which now delegate here.
+
+WEI_PER_ETH = 10 ** 18
+# Fixed base monthly premium, 0.00065 ETH (around £70 in GBP)
+BASE_PREMIUM_WEI = 650_000_000_000_000
+DEFAULT_COVERAGE_PERCENTAGE = 0.80
+DEFAULT_PREMIUM_RATE = 0.002
+
+
+def to_fraction(value):
+    """Exact value of an int, Decimal, Fraction, str or float (read as its shortest decimal repr)."""
+    if isinstance(value, (float, np.floating)):
+        return Fraction(str(value))
+    if isinstance(value, np.integer):
+        return Fraction(int(value))
+    return Fraction(value)
+
+
+def to_wei(eth_amount):
+    """Whole wei in an ETH amount, truncated."""
+    return _truncate(to_fraction(eth_amount) * WEI_PER_ETH)
+
+
+def wei_to_eth_decimal(wei_amount):
+    """Exact Decimal ETH value of a whole amount of wei."""
+    return Decimal(int(wei_amount)).scaleb(-18)
+
+
+def _truncate(fraction):
+    # int() rounds towards zero, floor division alone would round negatives down
+    return fraction.numerator // fraction.denominator if fraction >= 0 else -((-fraction.numerator) // fraction.denominator)
+
+
+def _as_wei_array(values, length=None):
+    values = np.asarray(values, dtype=object).reshape(-1)
+    if length is not None and len(values) == 1 and length != 1:
+        values = np.repeat(values, length)
+    # House values in wei can be past int64, so they are kept as Python ints
+    return np.array([value if isinstance(value, int) else _truncate(to_fraction(value)) for value in values],
+                    dtype=object)
+
+
+def _as_ratio_arrays(values, length):
+    """
+    Numerator and denominator object arrays for a scalar or per-policy rate.
+    Each distinct rate is converted once, however many policies share it.
+    """
+    values = np.asarray(values).reshape(-1)
+    if len(values) == 1 and length != 1:
+        values = np.repeat(values, length)
+    if len(values) != length:
+        raise ValueError(f"Expected {length} values, got {len(values)}")
+    distinct, positions = np.unique(values, return_inverse=True)
+    fractions = [to_fraction(value) for value in distinct]
+    numerators = np.array([fraction.numerator for fraction in fractions], dtype=object)
+    denominators = np.array([fraction.denominator for fraction in fractions], dtype=object)
+    return numerators[positions.reshape(-1)], denominators[positions.reshape(-1)]
+
+
+def _truncated_ratio(numerators, denominators):
+    # Elementwise int() of numerators / denominators on object arrays of Python ints
+    quotient = np.abs(numerators) // denominators
+    return np.where(numerators >= 0, quotient, -quotient)
+
+
+def calculate_premiums_wei(house_values_wei, coverage_percentage=DEFAULT_COVERAGE_PERCENTAGE,
+                           premium_rate=DEFAULT_PREMIUM_RATE, base_premium_wei=BASE_PREMIUM_WEI):
+    """
+    Monthly premium in wei for each house value in wei:
+    base_premium_wei + int(house_value_wei * coverage_percentage * premium_rate).
+    coverage_percentage and premium_rate can be one value for every policy or
+    one per policy. Returns an object array of Python ints.
+    """
+    house_values = _as_wei_array(house_values_wei)
+    coverage_numerators, coverage_denominators = _as_ratio_arrays(coverage_percentage, len(house_values))
+    rate_numerators, rate_denominators = _as_ratio_arrays(premium_rate, len(house_values))
+    risk_based = _truncated_ratio(house_values * coverage_numerators * rate_numerators,
+                                  coverage_denominators * rate_denominators)
+    return risk_based + int(base_premium_wei)
+
+
+def calculate_payouts_wei(damage_scores, house_values_wei, coverage_percentage=DEFAULT_COVERAGE_PERCENTAGE):
+    """
+    Payout in wei for each policy: int(house_value_wei * coverage_percentage * damage_score),
+    used for both the preliminary and the final payout. Damage scores and
+    coverage can be one value for every policy or one per policy. Returns an
+    object array of Python ints, so .sum() of it is an exact reserve total.
+    """
+    damage_scores = np.asarray(damage_scores).reshape(-1)
+    length = max(len(damage_scores), len(np.asarray(house_values_wei, dtype=object).reshape(-1)))
+    house_values = _as_wei_array(house_values_wei, length)
+    damage_numerators, damage_denominators = _as_ratio_arrays(damage_scores, length)
+    coverage_numerators, coverage_denominators = _as_ratio_arrays(coverage_percentage, length)
+    return _truncated_ratio(house_values * coverage_numerators * damage_numerators,
+                            coverage_denominators * damage_denominators)
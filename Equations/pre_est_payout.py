@@ -1,3 +1,5 @@
+from Equations.policy_engine import calculate_payouts_wei
+
 def preliminary_payout_estimate_wei(d_pre, house_value_wei,coverage_percentage = 0.80):
     """
         Parameters:
@@ -8,11 +10,9 @@ def preliminary_payout_estimate_wei(d_pre, house_value_wei,coverage_percentage =
     Returns:
       int: The estimated preliminary payout in Wei.
     """
-    # Calculate the insured portion of the house value in Wei.
-    insured_value_wei = house_value_wei * coverage_percentage
-
-    # Compute the estimated payout by multiplying by the preliminary damage score.
-    estimated_payout_wei = int(insured_value_wei * d_pre)
+    # Insured portion of the house value times the damage score, in exact integer Wei
+    # (see policy_engine, which does the same for a whole portfolio at once).
+    estimated_payout_wei = int(calculate_payouts_wei([d_pre], [house_value_wei], coverage_percentage)[0])
     return estimated_payout_wei
 
 
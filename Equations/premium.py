@@ -1,21 +1,18 @@
+from Equations.policy_engine import BASE_PREMIUM_WEI, calculate_premiums_wei, to_wei, wei_to_eth_decimal
 
 def calculate_premium_wei(house_value_wei, coverage_percentage=0.80, premium_rate=0.002):
 
-    # Fixed base premium in Wei
+    # Despite the name, callers pass Property.ethHouseValue, a value in ETH, and store the
+    # result in Property.premium as ETH. The maths is done in exact wei by the policy
+    # engine and handed back as an ETH Decimal with 18 places (one wei).
 
-    base_premium_wei = 0.00065  # Fixed base monthly premium around £70 in GBP
+    # Fixed base premium, 0.00065 ETH, around £70 in GBP (BASE_PREMIUM_WEI)
 
-    # Calculate the insured portion of the house value in Wei.
+    house_value_in_wei = to_wei(house_value_wei)
 
-    insured_value_wei = house_value_wei * coverage_percentage
+    # Total monthly premium: base premium plus insured value times the premium rate
 
-    # Compute the risk-based premium in Wei.
-
-    risk_based_premium_wei = insured_value_wei * premium_rate
-
-    # Compute the total monthly premium.
-
-    total_monthly_premium_wei = base_premium_wei + risk_based_premium_wei
-
-    return total_monthly_premium_wei
+    total_monthly_premium_wei = calculate_premiums_wei([house_value_in_wei], coverage_percentage, premium_rate,
+                                                       BASE_PREMIUM_WEI)[0]
 
+    return wei_to_eth_decimal(total_monthly_premium_wei)
@@ -0,0 +1,447 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from time import time
+
+import numpy as np
+
+from Equations.disaster_risk import (GEODESIC_CANDIDATES, get_hotspot_index, get_normalized_risk_score,
+                                     calculate_final_risk_score)
+from ML.weather_detection_model import get_current_dataset_fingerprint, get_weather_risk_engine, write_file_atomically
+
+# Precomputed components of get_disaster_risk over a fixed lat/lon grid, so a quote is a cell read
+# instead of a hotspot search plus a weather model lookup. Built by `manage.py build_risk_grid`.
+RISK_GRID_DIR = "./risk_grid"
+# Cell size in degrees, cells are centred on -89.95, -89.85, ... at the default 0.1
+RESOLUTION_DEGREES = 0.1
+# Cells per side of a tile, the unit the grid is rebuilt in (10 degree tiles by default)
+TILE_CELLS = 100
+# Same weather settings get_disaster_risk uses
+TIMEFRAME_IN_DAYS = 365
+PERCENT_TO_CONSIDER_EXTREME = 50
+SENSORS_TO_USE = 3
+# How often a loaded grid checks whether a newer version was built, or it went stale
+RISK_GRID_CHECK_SECONDS = 600
+# A grid older than this, or built on another weather dataset version than the current one, is
+# stale; quotes are then computed live until `manage.py build_risk_grid` is run again
+RISK_GRID_MAX_AGE_SECONDS = 7 * 24 * 60 * 60
+# Proximity risk steps at these distances (see get_normalized_risk_score). Haversine is within 1%
+# of geodesic, so only cells that close to a step are measured again with geodesic
+PROXIMITY_STEPS_KM = np.array([50, 100, 200, 500])
+GEODESIC_MARGIN = 0.01
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine(lat_lon_r, other_r):
+    """Great circle distance in radians between two arrays of (lat, lon) in radians."""
+    dlat = other_r[..., 0] - lat_lon_r[..., 0]
+    dlon = other_r[..., 1] - lat_lon_r[..., 1]
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat_lon_r[..., 0]) * np.cos(other_r[..., 0]) * np.sin(dlon / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class GridLayout:
+    """
+    Geometry of the grid: rows of cells from the south pole north, columns from
+    -180 east, grouped into square tiles of tile_cells cells.
+    """
+
+    def __init__(self, resolution=RESOLUTION_DEGREES, tile_cells=TILE_CELLS):
+        self.resolution = resolution
+        self.tile_cells = tile_cells
+        self.rows = int(round(180 / resolution))
+        self.cols = int(round(360 / resolution))
+        self.tile_rows = -(-self.rows // tile_cells)
+        self.tile_cols = -(-self.cols // tile_cells)
+        self.tiles = self.tile_rows * self.tile_cols
+        # Furthest any cell centre of a tile is from the tile centre, an upper bound at every latitude
+        self.tile_half_diagonal = np.radians(resolution * tile_cells / 2 * np.sqrt(2))
+
+    def tile_slices(self, tile):
+        row, col = divmod(tile, self.tile_cols)
+        return (slice(row * self.tile_cells, min((row + 1) * self.tile_cells, self.rows)),
+                slice(col * self.tile_cells, min((col + 1) * self.tile_cells, self.cols)))
+
+    def cell_centres(self, rows, cols):
+        lat = -90 + (np.arange(rows.start, rows.stop) + 0.5) * self.resolution
+        lon = -180 + (np.arange(cols.start, cols.stop) + 0.5) * self.resolution
+        return np.column_stack([np.repeat(lat, len(lon)), np.tile(lon, len(lat))])
+
+    def tile_centres(self):
+        centres = []
+        for tile in range(self.tiles):
+            rows, cols = self.tile_slices(tile)
+            centres.append((-90 + (rows.start + rows.stop) / 2 * self.resolution,
+                            -180 + (cols.start + cols.stop) / 2 * self.resolution))
+        return np.array(centres)
+
+    def fractional_cell(self, lat_lon):
+        lat_lon = np.asarray(lat_lon, dtype=np.float64).reshape(-1, 2)
+        return (lat_lon[:, 0] + 90) / self.resolution, ((lat_lon[:, 1] + 180) / self.resolution) % self.cols
+
+
+class RiskGrid:
+    """
+    One built version of the grid. proximity and frequency are (rows, cols)
+    float32 arrays memory-mapped read-only; frequency is NaN where the
+    closest sensors had no readings in the timeframe.
+    """
+
+    def __init__(self, version_dir, meta, proximity, frequency, tiles, sensors, hotspots):
+        self.version_dir = version_dir
+        self.meta = meta
+        self.layout = GridLayout(meta["resolution"], meta["tile_cells"])
+        self.proximity = proximity
+        self.frequency = frequency
+        self.tiles = tiles
+        self.sensors = sensors
+        self.hotspots = hotspots
+
+    @classmethod
+    def load(cls, grid_dir=RISK_GRID_DIR):
+        with open(os.path.join(grid_dir, "CURRENT")) as current_file:
+            version_dir = os.path.join(grid_dir, current_file.read().strip())
+        with open(os.path.join(version_dir, "meta.json")) as meta_file:
+            meta = json.load(meta_file)
+        with np.load(os.path.join(version_dir, "tiles.npz")) as tiles, \
+                np.load(os.path.join(version_dir, "sensors.npz")) as sensors, \
+                np.load(os.path.join(version_dir, "hotspots.npz")) as hotspots:
+            return cls(version_dir, meta,
+                       np.load(os.path.join(version_dir, "proximity.npy"), mmap_mode="r"),
+                       np.load(os.path.join(version_dir, "frequency.npy"), mmap_mode="r"),
+                       dict(tiles), dict(sensors), dict(hotspots))
+
+    def stale_reason(self, weather_fingerprint=None, max_age=RISK_GRID_MAX_AGE_SECONDS):
+        """
+        Why the grid should no longer be used, or None if it is up to date:
+        it is older than max_age seconds, or weather_fingerprint (the current
+        weather dataset version) is not the one it was built on.
+        """
+        age = time() - self.meta.get("built_at", 0)
+        if max_age is not None and age > max_age:
+            return f"built {age / 86400:.1f} days ago"
+        built_on = tuple(self.meta.get("weather_fingerprint", ()))
+        if weather_fingerprint is not None and built_on != tuple(weather_fingerprint):
+            return f"built on weather dataset {built_on}, the current one is {tuple(weather_fingerprint)}"
+        return None
+
+    def components_batch(self, lat_lon, interpolate=False):
+        """
+        Returns (proximity risk, disaster frequency) arrays for (lat, lon) pairs,
+        read from the cell each point falls in. With interpolate, both are
+        bilinearly interpolated between the four closest cell centres instead,
+        except next to cells without a frequency.
+        """
+        fractional_rows, fractional_cols = self.layout.fractional_cell(lat_lon)
+        rows = np.clip(np.floor(fractional_rows).astype(np.int64), 0, self.layout.rows - 1)
+        cols = np.floor(fractional_cols).astype(np.int64) % self.layout.cols
+        proximity = self.proximity[rows, cols].astype(np.float64)
+        frequency = self.frequency[rows, cols].astype(np.float64)
+        if not interpolate:
+            return proximity, frequency
+
+        # Cell centres are at whole cell positions + 0.5, latitude is clamped at the poles
+        # and longitude wraps around the antimeridian
+        row_position = np.clip(fractional_rows - 0.5, 0, self.layout.rows - 1)
+        col_position = fractional_cols - 0.5
+        row0 = np.minimum(np.floor(row_position).astype(np.int64), self.layout.rows - 2)
+        col0 = np.floor(col_position).astype(np.int64)
+        row_weight = (row_position - row0)[:, None]
+        col_weight = (col_position - col0)[:, None]
+        row_pair = np.column_stack([row0, row0 + 1])
+        col_pair = np.column_stack([col0, col0 + 1]) % self.layout.cols
+
+        def bilinear(values):
+            corners = values[row_pair[:, :, None], col_pair[:, None, :]].astype(np.float64)
+            lower = corners[:, 0, 0:1] * (1 - col_weight) + corners[:, 0, 1:2] * col_weight
+            upper = corners[:, 1, 0:1] * (1 - col_weight) + corners[:, 1, 1:2] * col_weight
+            return (lower * (1 - row_weight) + upper * row_weight)[:, 0]
+
+        interpolated_frequency = bilinear(self.frequency)
+        usable = ~np.isnan(interpolated_frequency)
+        proximity[usable] = bilinear(self.proximity)[usable]
+        frequency[usable] = interpolated_frequency[usable]
+        return proximity, frequency
+
+    def components(self, lat, lon, interpolate=False):
+        """(proximity risk, disaster frequency) at one point, or None if the cell has no frequency."""
+        proximity, frequency = self.components_batch([(lat, lon)], interpolate)
+        if np.isnan(frequency[0]):
+            return None
+        return float(proximity[0]), float(frequency[0])
+
+    def risk(self, lat, lon, interpolate=False):
+        """Final risk score as get_disaster_risk would compute it, or None."""
+        components = self.components(lat, lon, interpolate)
+        if components is None:
+            return None
+        return calculate_final_risk_score(*components)
+
+
+_risk_grid = None
+_risk_grid_checked_at = 0
+_risk_grid_stale = False
+_risk_grid_lock = threading.Lock()
+
+
+def get_risk_grid(grid_dir=RISK_GRID_DIR, allow_stale=False):
+    """
+    Returns the current RiskGrid, or None if none was built yet. Picks up a
+    newly built version at most RISK_GRID_CHECK_SECONDS after it was made current.
+    A stale grid (see RiskGrid.stale_reason) is reported when it is checked
+    and not returned unless allow_stale is set.
+    """
+    global _risk_grid, _risk_grid_checked_at, _risk_grid_stale
+    if time() - _risk_grid_checked_at < RISK_GRID_CHECK_SECONDS:
+        return _risk_grid if allow_stale or not _risk_grid_stale else None
+
+    with _risk_grid_lock:
+        if time() - _risk_grid_checked_at >= RISK_GRID_CHECK_SECONDS:
+            try:
+                with open(os.path.join(grid_dir, "CURRENT")) as current_file:
+                    version_dir = os.path.join(grid_dir, current_file.read().strip())
+                if _risk_grid is None or _risk_grid.version_dir != version_dir:
+                    _risk_grid = RiskGrid.load(grid_dir)
+            except FileNotFoundError:
+                _risk_grid = None
+
+            reason = _risk_grid.stale_reason(get_current_dataset_fingerprint()) if _risk_grid is not None else None
+            if reason is not None:
+                print(f"Risk grid {_risk_grid.version_dir} is stale ({reason}), "
+                      f"{'still using it' if allow_stale else 'computing risk live'} until it is rebuilt")
+            _risk_grid_stale = reason is not None
+            _risk_grid_checked_at = time()
+    return _risk_grid if allow_stale or not _risk_grid_stale else None
+
+
+def get_sensor_snapshot(state):
+    """
+    Everything about the weather sensors a grid cell's frequency depends on:
+    each sensor's name, position, amount of readings and latest reading.
+    """
+    index, dataset = state.index, state.dataset
+    first_rows = index.row_order[index.row_starts[:-1]]
+    epochs = np.asarray(dataset["last_updated_epoch"], dtype=np.int64)[index.row_order]
+    return {
+        "names": index.location_names.astype(str),
+        "lat_lon": dataset[["latitude", "longitude"]].to_numpy(dtype=np.float64)[first_rows],
+        "readings": np.diff(index.row_starts),
+        "last_epoch": np.maximum.reduceat(epochs, index.row_starts[:-1]) if len(first_rows) else np.empty(0, np.int64),
+    }
+
+
+def get_model_key(state):
+    # A refit model changes every score, a model carried over by an incremental refresh does not
+    coeff = state.features.normalisation_coeff
+    return [int(state.model.n_samples_fit_)] + [float(coeff[column]) for column in coeff.index]
+
+
+def compute_tile(layout, tile, state, hotspot_index):
+    """
+    Computes both components for every cell of a tile, plus which sensors and
+    hotspots they used and how far the furthest used one is, which is what
+    find_touched_tiles needs to tell if new data could change the tile.
+    """
+    rows, cols = layout.tile_slices(tile)
+    centres = layout.cell_centres(rows, cols)
+
+    sensor_distances, point_sensors = state.index.nearest_sensors_batch(centres, SENSORS_TO_USE)
+    frequency = get_weather_risk_engine().get_extreme_weather_for_sensors(
+        state, point_sensors, TIMEFRAME_IN_DAYS, PERCENT_TO_CONSIDER_EXTREME)
+    frequency = np.array([np.nan if value is None else value for value in frequency], dtype=np.float32)
+
+    hotspots = hotspot_index.nearest(centres, candidates=0)
+    distances = np.array([distance for distance, _ in hotspots])
+    nearest = np.array([position for _, position in hotspots])
+    # Only cells close to a proximity step can change score between haversine and geodesic
+    near_step = (np.abs(distances[:, None] - PROXIMITY_STEPS_KM) <= PROXIMITY_STEPS_KM * GEODESIC_MARGIN).any(axis=1)
+    if near_step.any():
+        refined = hotspot_index.nearest(centres[near_step], candidates=GEODESIC_CANDIDATES)
+        distances[near_step] = [distance for distance, _ in refined]
+        nearest[near_step] = [position for _, position in refined]
+    proximity = np.array([get_normalized_risk_score(distance) for distance in distances], dtype=np.float32)
+
+    shape = (rows.stop - rows.start, cols.stop - cols.start)
+    return {
+        "proximity": proximity.reshape(shape),
+        "frequency": frequency.reshape(shape),
+        "sensors": np.unique(point_sensors),
+        "sensor_radius": float(sensor_distances[:, -1].max()),
+        "hotspots": np.unique(nearest),
+        "hotspot_radius": float(distances.max() / EARTH_RADIUS_KM),
+    }
+
+
+def _changed_keys(old_names, old_values, new_names, new_values):
+    # Names whose values differ or that only exist on one side
+    old = dict(zip(old_names.tolist(), map(tuple, old_values)))
+    new = dict(zip(new_names.tolist(), map(tuple, new_values)))
+    return {name for name in old.keys() | new.keys() if old.get(name) != new.get(name)}
+
+
+def find_touched_tiles(previous, sensors, hotspot_index):
+    """
+    Returns the tiles of the previous grid whose cells could have a different
+    value with the given sensors and hotspots:
+    - tiles that used a sensor or hotspot that changed or disappeared
+    - tiles where a new or moved sensor or hotspot is closer to some cell
+      centre than the furthest one that tile used
+    """
+    layout = previous.layout
+    tiles = previous.tiles
+    touched = np.zeros(layout.tiles, dtype=bool)
+    tile_centres_r = np.radians(layout.tile_centres())
+
+    def check(old_names, old_values, new_names, new_values, new_lat_lon, offsets, used, radius):
+        changed = _changed_keys(old_names, old_values, new_names, new_values)
+        if not changed:
+            return
+        changed_old = np.isin(old_names, list(changed))
+        for tile in range(layout.tiles):
+            if changed_old[used[offsets[tile]:offsets[tile + 1]]].any():
+                touched[tile] = True
+
+        # Wherever changed ones are now, they may be closer than what a tile used
+        changed_new = np.isin(new_names, list(changed))
+        for lat_lon in np.radians(new_lat_lon[changed_new]):
+            distance = haversine(tile_centres_r, lat_lon[None, :])
+            touched[distance - layout.tile_half_diagonal <= radius * (1 + GEODESIC_MARGIN)] = True
+
+    old_sensors = previous.sensors
+    check(old_sensors["names"], np.column_stack([old_sensors["lat_lon"], old_sensors["readings"], old_sensors["last_epoch"]]),
+          sensors["names"], np.column_stack([sensors["lat_lon"], sensors["readings"], sensors["last_epoch"]]),
+          sensors["lat_lon"], tiles["sensor_offsets"], tiles["sensor_ids"], tiles["sensor_radius"])
+
+    old_hotspots = previous.hotspots
+    hotspot_names = np.asarray(hotspot_index.names, dtype=str)
+    check(old_hotspots["names"], old_hotspots["coordinates"], hotspot_names, hotspot_index.coordinates,
+          hotspot_index.coordinates, tiles["hotspot_offsets"], tiles["hotspot_ids"], tiles["hotspot_radius"])
+
+    return np.flatnonzero(touched)
+
+
+def build_risk_grid(grid_dir=RISK_GRID_DIR, resolution=RESOLUTION_DEGREES, tile_cells=TILE_CELLS, full=False,
+                    max_age_days=None, progress=None):
+    """
+    Brings the grid in grid_dir up to date with the loaded weather dataset and
+    hotspot catalogue. Only tiles whose cells could have changed are computed
+    again (plus those older than max_age_days, as the weather timeframe moves
+    with the date); the rest are copied from the previous version. Everything
+    is rebuilt if full, if there is no previous grid or if it was built with
+    a different layout or weather model.
+
+    Like the weather dataset, each version is written to its own directory
+    and then made current by rewriting CURRENT, so readers are never handed a
+    partially built grid. progress is called with (tiles done, tiles to do).
+
+    Returns (tiles rebuilt, tiles in the grid).
+    """
+    state = get_weather_risk_engine().get_state()
+    hotspot_index = get_hotspot_index()
+    sensors = get_sensor_snapshot(state)
+    model_key = get_model_key(state)
+    layout = GridLayout(resolution, tile_cells)
+    today = int(time() // 86400)
+
+    previous = None
+    if not full:
+        try:
+            previous = RiskGrid.load(grid_dir)
+        except FileNotFoundError:
+            previous = None
+    if previous is not None and (previous.meta["resolution"] != resolution or previous.meta["tile_cells"] != tile_cells
+                                 or previous.meta["model_key"] != model_key
+                                 or previous.meta["weather"] != [TIMEFRAME_IN_DAYS, PERCENT_TO_CONSIDER_EXTREME, SENSORS_TO_USE]):
+        previous = None
+
+    if previous is None:
+        to_build = np.arange(layout.tiles)
+    else:
+        to_build = find_touched_tiles(previous, sensors, hotspot_index)
+        if max_age_days is not None:
+            to_build = np.union1d(to_build, np.flatnonzero(today - previous.tiles["built_day"] >= max_age_days))
+
+    os.makedirs(grid_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=grid_dir, prefix=".tmp-")
+    try:
+        proximity = np.lib.format.open_memmap(os.path.join(tmp_dir, "proximity.npy"), mode="w+", dtype=np.float32,
+                                              shape=(layout.rows, layout.cols))
+        frequency = np.lib.format.open_memmap(os.path.join(tmp_dir, "frequency.npy"), mode="w+", dtype=np.float32,
+                                              shape=(layout.rows, layout.cols))
+        if previous is not None:
+            proximity[:] = previous.proximity
+            frequency[:] = previous.frequency
+
+        # Which sensors and hotspots each tile used, by name, so unchanged tiles carry over
+        sensor_names = sensors["names"]
+        hotspot_names = np.asarray(hotspot_index.names, dtype=str)
+        tile_sensors, tile_hotspots = [None] * layout.tiles, [None] * layout.tiles
+        sensor_radius = np.zeros(layout.tiles)
+        hotspot_radius = np.zeros(layout.tiles)
+        built_day = np.full(layout.tiles, today, dtype=np.int64)
+        if previous is not None:
+            tiles = previous.tiles
+            sensor_radius[:] = tiles["sensor_radius"]
+            hotspot_radius[:] = tiles["hotspot_radius"]
+            built_day[:] = tiles["built_day"]
+            for tile in range(layout.tiles):
+                tile_sensors[tile] = previous.sensors["names"][
+                    tiles["sensor_ids"][tiles["sensor_offsets"][tile]:tiles["sensor_offsets"][tile + 1]]]
+                tile_hotspots[tile] = previous.hotspots["names"][
+                    tiles["hotspot_ids"][tiles["hotspot_offsets"][tile]:tiles["hotspot_offsets"][tile + 1]]]
+
+        for done, tile in enumerate(to_build):
+            values = compute_tile(layout, tile, state, hotspot_index)
+            rows, cols = layout.tile_slices(tile)
+            proximity[rows, cols] = values["proximity"]
+            frequency[rows, cols] = values["frequency"]
+            tile_sensors[tile] = sensor_names[values["sensors"]]
+            tile_hotspots[tile] = hotspot_names[values["hotspots"]]
+            sensor_radius[tile] = values["sensor_radius"]
+            hotspot_radius[tile] = values["hotspot_radius"]
+            built_day[tile] = today
+            if progress is not None:
+                progress(done + 1, len(to_build))
+        proximity.flush()
+        frequency.flush()
+        del proximity, frequency
+
+        def ids_for(per_tile, names):
+            positions = {name: i for i, name in enumerate(names.tolist())}
+            ids = [np.array([positions[name] for name in tile_names], dtype=np.int64) for tile_names in per_tile]
+            return np.concatenate([[0], np.cumsum([len(tile_ids) for tile_ids in ids])]), np.concatenate(ids)
+
+        sensor_offsets, sensor_ids = ids_for(tile_sensors, sensor_names)
+        hotspot_offsets, hotspot_ids = ids_for(tile_hotspots, hotspot_names)
+        np.savez(os.path.join(tmp_dir, "tiles.npz"), built_day=built_day, sensor_offsets=sensor_offsets,
+                 sensor_ids=sensor_ids, sensor_radius=sensor_radius, hotspot_offsets=hotspot_offsets,
+                 hotspot_ids=hotspot_ids, hotspot_radius=hotspot_radius)
+        np.savez(os.path.join(tmp_dir, "sensors.npz"), **sensors)
+        np.savez(os.path.join(tmp_dir, "hotspots.npz"), names=hotspot_names, coordinates=hotspot_index.coordinates)
+        meta = {
+            "resolution": resolution,
+            "tile_cells": tile_cells,
+            "weather": [TIMEFRAME_IN_DAYS, PERCENT_TO_CONSIDER_EXTREME, SENSORS_TO_USE],
+            "weather_fingerprint": [int(value) for value in state.fingerprint],
+            "model_key": model_key,
+            "built_at": time(),
+        }
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as meta_file:
+            json.dump(meta, meta_file)
+
+        version = "{}-{}".format(int(time() * 1000), os.getpid())
+        os.replace(tmp_dir, os.path.join(grid_dir, version))
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    write_file_atomically(os.path.join(grid_dir, "CURRENT"), version.encode())
+
+    # Open memory maps keep their pages after an unlink, so old versions can go
+    for old_version in os.listdir(grid_dir):
+        if old_version not in (version, "CURRENT") and not old_version.startswith("."):
+            shutil.rmtree(os.path.join(grid_dir, old_version), ignore_errors=True)
+
+    return len(to_build), layout.tiles
@@ -3,10 +3,19 @@ from tensorflow.keras import layers, models
 from tensorflow.keras.layers import GlobalAveragePooling2D, Dense
 import numpy as np
 import os
+import tempfile
+import threading
 import pandas as pd
 from tensorflow.keras.models import load_model
 from PIL import Image
 import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
+
+# Images per forward pass and threads decoding them for batched inference
+DEFAULT_INFERENCE_BATCH_SIZE = 16
+DEFAULT_DECODE_WORKERS = 4
+# Versioned trained models, see ML/model_registry.py
+MODEL_REGISTRY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "registry")
 
 # Download and extract the dataset
 def download_and_extract_dataset(url, cache_dir='dataset'):
@@ -59,16 +68,34 @@ def decode_image_wrapper(image_path, label):
 def filter_valid_images(image, label):
     return tf.not_equal(label, -1.0)
 
-# Create TensorFlow datasets
-def create_tf_dataset(image_paths, labels, batch_size=32, shuffle=True):
+# Decode an image from its preprocessed cache file when there is one, otherwise from the image itself
+def decode_cached_image(image_path, cache_path, label):
+    img = load_preprocessed_image(cache_path.decode() if isinstance(cache_path, bytes) else cache_path)
+    if img is None:
+        return decode_image(image_path, label)
+    return img, np.float32(label)
+
+# Wrapper function for TensorFlow dataset mapping of cached images
+def decode_cached_image_wrapper(image_path, cache_path, label):
+    img, label = tf.numpy_function(decode_cached_image, [image_path, cache_path, label], [tf.float32, tf.float32])
+    img.set_shape((224, 224, 3))
+    label.set_shape(())
+    return img, label
+
+# Create TensorFlow datasets, reading images from their preprocessed cache files where cache_paths has one
+def create_tf_dataset(image_paths, labels, batch_size=32, shuffle=True, cache_paths=None):
     label_to_index = {label: index for index, label in enumerate(set(labels))}
     labels = [label_to_index[label] for label in labels]
 
     image_paths_ds = tf.data.Dataset.from_tensor_slices(image_paths)
     labels_ds = tf.data.Dataset.from_tensor_slices(labels)
-    dataset = tf.data.Dataset.zip((image_paths_ds, labels_ds))
-
-    dataset = dataset.map(decode_image_wrapper, num_parallel_calls=tf.data.AUTOTUNE)
+    if cache_paths is not None:
+        cache_paths_ds = tf.data.Dataset.from_tensor_slices([cache_path or "" for cache_path in cache_paths])
+        dataset = tf.data.Dataset.zip((image_paths_ds, cache_paths_ds, labels_ds))
+        dataset = dataset.map(decode_cached_image_wrapper, num_parallel_calls=tf.data.AUTOTUNE)
+    else:
+        dataset = tf.data.Dataset.zip((image_paths_ds, labels_ds))
+        dataset = dataset.map(decode_image_wrapper, num_parallel_calls=tf.data.AUTOTUNE)
     dataset = dataset.filter(filter_valid_images)
 
     if shuffle:
@@ -109,18 +136,20 @@ class CBAM(tf.keras.layers.Layer):
 
         return output
 
-# Build the model with fine-tuning
-def build_model(num_classes, img_height=224, img_width=224, trainable=False):
+# Build the ConvNeXtXLarge backbone, which outputs (7, 7, 2048) feature maps
+def build_backbone(img_height=224, img_width=224, trainable=False):
     convnext_xl = tf.keras.applications.ConvNeXtXLarge(
         include_top=False,
         input_shape=(img_height, img_width, 3),
         weights="imagenet"
     )
     convnext_xl.trainable = trainable
-    inputs = layers.Input(shape=(img_height, img_width, 3))
-    x = convnext_xl(inputs)
+    return convnext_xl
 
-    x = CBAM()(x)
+# Build the CBAM and dense head, taking backbone feature maps of feature_shape
+def build_head(num_classes, feature_shape):
+    inputs = layers.Input(shape=tuple(feature_shape))
+    x = CBAM()(inputs)
     x = GlobalAveragePooling2D()(x)
     x = Dense(1024, activation="relu", kernel_initializer='he_normal')(x)
     x = tf.keras.layers.BatchNormalization()(x)
@@ -131,11 +160,21 @@ def build_model(num_classes, img_height=224, img_width=224, trainable=False):
     x = tf.keras.layers.Dropout(0.3)(x)
 
     output = Dense(num_classes, activation="softmax", kernel_initializer='glorot_normal')(x)
-    model = models.Model(inputs=inputs, outputs=output)
-    return model
+    return models.Model(inputs=inputs, outputs=output, name="damage_head")
+
+# Put a backbone and a head together into a model taking images
+def assemble_model(backbone, head, img_height=224, img_width=224):
+    inputs = layers.Input(shape=(img_height, img_width, 3))
+    return models.Model(inputs=inputs, outputs=head(backbone(inputs)))
+
+# Build the model with fine-tuning
+def build_model(num_classes, img_height=224, img_width=224, trainable=False):
+    backbone = build_backbone(img_height, img_width, trainable)
+    head = build_head(num_classes, backbone.output_shape[1:])
+    return assemble_model(backbone, head, img_height, img_width)
 
 # Train the model
-def train_model(train_dataset, valid_dataset=None, epochs=10, class_num=3):
+def train_model(train_dataset, valid_dataset=None, epochs=10, class_num=3, registry_dir=MODEL_REGISTRY_DIR, metadata=None):
     num_classes = class_num
     model = build_model(num_classes, trainable=False)
     model.summary()
@@ -148,28 +187,61 @@ def train_model(train_dataset, valid_dataset=None, epochs=10, class_num=3):
         loss="sparse_categorical_crossentropy",
         metrics=["accuracy"]
     )
-    true_labels = np.concatenate([y for x, y in train_dataset], axis=0)
-    steps_per_epoch = len(true_labels) // 32
+    # Each epoch is one pass over the dataset, no need to decode it all first just to count it
     if valid_dataset is not None:
         history = model.fit(
             train_dataset,
             validation_data=valid_dataset,
-            epochs=epochs,
-            steps_per_epoch=steps_per_epoch
+            epochs=epochs
         )
     else:
         history = model.fit(
             train_dataset,
-            epochs=epochs,
-            steps_per_epoch=steps_per_epoch
+            epochs=epochs
         )
-    save_model(model, "models/damageassessment.keras")
+    promote_trained_model(model, history, registry_dir, dict(metadata or {}, training="full"))
     return model, history
 
-# Load the model
+# Save a trained model as a new version in the registry and make it current, instead of
+# overwriting the file running processes load from
+def promote_trained_model(model, history, registry_dir=MODEL_REGISTRY_DIR, metadata=None):
+    from ML.model_registry import ModelRegistry
+
+    metrics = {name: float(values[-1]) for name, values in history.history.items() if len(values)}
+    metadata = dict(metadata or {}, metrics=metrics, epochs=len(history.epoch))
+    return ModelRegistry(registry_dir).promote(lambda path: save_model(model, path), metadata)
+
+# Load the model, a .tflite export (see ML/export_tflite.py) is loaded into the TFLite interpreter
 def load_trained_model(model_path):
+    if str(model_path).endswith(".tflite"):
+        return TFLiteDamageModel(model_path)
     return load_model(model_path, custom_objects={"CBAM": CBAM})
 
+# Runs a TFLite export of the model with the same predict methods as the Keras model
+class TFLiteDamageModel:
+    def __init__(self, model_path, num_threads=None):
+        self.model_path = str(model_path)
+        self.interpreter = tf.lite.Interpreter(model_path=self.model_path, num_threads=num_threads)
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.batch_size = None
+        # One interpreter can only run one batch at a time
+        self._lock = threading.Lock()
+
+    def predict_on_batch(self, images):
+        images = np.asarray(images, dtype=np.float32)
+        with self._lock:
+            if self.batch_size != len(images):
+                self.interpreter.resize_tensor_input(self.input_index, images.shape)
+                self.interpreter.allocate_tensors()
+                self.batch_size = len(images)
+            self.interpreter.set_tensor(self.input_index, images)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output_index).copy()
+
+    def predict(self, images, **kwargs):
+        return self.predict_on_batch(images)
+
 # Evaluate and display results
 def evaluate_and_display_results(model, test_dataset, test_image_paths):
     test_loss, test_accuracy = model.evaluate(test_dataset)
@@ -257,24 +329,225 @@ def decode_test_image(image_path):
         # Return a placeholder tensor
         return tf.zeros((1, 224, 224, 3), dtype=tf.float32)
 
-def calculate_damage_assessment(image_path, model):
+def calculate_damage_assessment(image_path, model, cache_path=None):
     base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     media_file = os.path.join(base_dir, 'media')
     user_file = os.path.join(media_file, image_path)
     if model is None:
         model = load_trained_model("models/damageassessment.keras")
-    image = decode_test_image(user_file)
+    # The preprocessed cache file skips decoding the upload again
+    cached = load_preprocessed_image(cache_path)
+    image = cached[np.newaxis] if cached is not None else decode_test_image(user_file)
     return np.argmax(model.predict(image), axis=1)
 
+# Resolve an image path the same way calculate_damage_assessment does
+def resolve_media_path(image_path):
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(base_dir, 'media', image_path)
+
+# Decode one image to a (224, 224, 3) float32 array, or None if it cannot be read
+def decode_image_array(image_path):
+    try:
+        img = tf.keras.utils.load_img(image_path, target_size=(224, 224))
+        img = img.convert("RGB")
+        return tf.keras.utils.img_to_array(img, dtype="float32")
+    except Exception as e:
+        print(f"Error loading image {image_path}: {e}")
+        return None
+
+# Resize an image to the model's (224, 224, 3) uint8 input. JPEG draft mode lets a big photo
+# be decoded straight at 1/2, 1/4 or 1/8 scale instead of decoding every pixel and throwing most away
+def preprocess_image(image_path):
+    with Image.open(image_path) as img:
+        img.draft("RGB", (224, 224))
+        img = img.convert("RGB").resize((224, 224), Image.NEAREST)
+        return np.asarray(img, dtype=np.uint8)
+
+# Write the preprocessed image to cache_path, in one step so readers never see half a file
+def save_preprocessed_image(image_path, cache_path):
+    img = preprocess_image(image_path)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # A temporary file of its own, two saves of the same image can run at the same time
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), prefix=".tmp-", suffix=".npy")
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            np.save(temp_file, img)
+        os.replace(temp_path, cache_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return img
+
+# Load a preprocessed image as the float32 array the model takes, or None if it isn't cached
+def load_preprocessed_image(cache_path):
+    if not cache_path or not os.path.exists(cache_path):
+        return None
+    try:
+        img = np.load(cache_path)
+    except (OSError, ValueError) as e:
+        print(f"Error loading cached image {cache_path}: {e}")
+        return None
+    if img.shape != (224, 224, 3):
+        return None
+    return img.astype(np.float32)
+
+def calculate_damage_probabilities_batch(image_paths, model, batch_size=DEFAULT_INFERENCE_BATCH_SIZE, decode_workers=DEFAULT_DECODE_WORKERS, cache_paths=None):
+    """
+    Class probabilities of many images, keyed by the image paths as given.
+    Images are decoded on a thread pool, the next batch while the model runs
+    on the current one, and each batch is one forward pass. Images that cannot
+    be decoded are left out of the result rather than scored as a blank image.
+    cache_paths maps image paths to preprocessed cache files, read instead of
+    decoding the image when they exist.
+    """
+    if model is None:
+        model = load_trained_model("models/damageassessment.keras")
+    return predict_images_batch(image_paths, model, batch_size, decode_workers, cache_paths)
+
+# Output of any model taking images (the full model or just its backbone) for many images, see above
+def predict_images_batch(image_paths, model, batch_size=DEFAULT_INFERENCE_BATCH_SIZE, decode_workers=DEFAULT_DECODE_WORKERS, cache_paths=None):
+    cache_paths = cache_paths or {}
+    image_paths = list(dict.fromkeys(image_paths))
+    batches = [image_paths[i:i + batch_size] for i in range(0, len(image_paths), batch_size)]
+    results = {}
+    if not batches:
+        return results
+
+    with ThreadPoolExecutor(max_workers=decode_workers) as pool:
+        def decode_batch(paths):
+            return [pool.submit(load_or_decode_image, resolve_media_path(path), cache_paths.get(path)) for path in paths]
+
+        pending = decode_batch(batches[0])
+        for i, paths in enumerate(batches):
+            images = [future.result() for future in pending]
+            if i + 1 < len(batches):
+                pending = decode_batch(batches[i + 1])
+
+            decoded = [(path, image) for path, image in zip(paths, images) if image is not None]
+            if not decoded:
+                continue
+            batch = np.stack([image for _, image in decoded])
+            probabilities = model.predict_on_batch(batch)
+            for (path, _), row in zip(decoded, np.asarray(probabilities)):
+                results[path] = row
+    return results
+
+def load_or_decode_image(image_path, cache_path=None):
+    img = load_preprocessed_image(cache_path)
+    return img if img is not None else decode_image_array(image_path)
+
+def calculate_damage_assessment_batch(image_paths, model, batch_size=DEFAULT_INFERENCE_BATCH_SIZE, decode_workers=DEFAULT_DECODE_WORKERS, cache_paths=None):
+    """
+    Batched calculate_damage_assessment: the predicted class of each image,
+    keyed by the image paths as given. See calculate_damage_probabilities_batch.
+    """
+    probabilities = calculate_damage_probabilities_batch(image_paths, model, batch_size, decode_workers, cache_paths)
+    return {path: int(np.argmax(row)) for path, row in probabilities.items()}
+
+AGGREGATION_RULES = ("max", "mean", "majority")
+
+def aggregate_damage_probabilities(probabilities, rule="max"):
+    """
+    One class for a claim from the class probabilities of each of its images.
+    max is the most severe class predicted for any image, mean the class of
+    the mean probabilities and majority the most often predicted class, with
+    ties settled by the mean probabilities.
+    """
+    if len(probabilities) == 0:
+        raise ValueError("No image probabilities to aggregate")
+    probabilities = np.atleast_2d(np.asarray(probabilities, dtype=np.float64))
+    classes = np.argmax(probabilities, axis=1)
+    mean = probabilities.mean(axis=0)
+    if rule == "max":
+        return int(classes.max())
+    if rule == "mean":
+        return int(np.argmax(mean))
+    if rule == "majority":
+        votes = np.bincount(classes, minlength=len(mean))
+        tied = np.flatnonzero(votes == votes.max())
+        return int(tied[np.argmax(mean[tied])])
+    raise ValueError(f"Unknown aggregation rule {rule}, expected one of {', '.join(AGGREGATION_RULES)}")
+
+# Run the backbone over the images of items (key, image path, cache path) not in the store yet
+def compute_embeddings(store, items, backbone, batch_size=DEFAULT_INFERENCE_BATCH_SIZE, decode_workers=DEFAULT_DECODE_WORKERS, chunk_size=256):
+    missing = set(store.missing([key for key, _, _ in items]))
+    items = [item for item in items if item[0] in missing]
+    for start in range(0, len(items), chunk_size):
+        chunk = items[start:start + chunk_size]
+        cache_paths = {image_path: cache_path for _, image_path, cache_path in chunk if cache_path}
+        features = predict_images_batch([image_path for _, image_path, _ in chunk], backbone, batch_size, decode_workers, cache_paths)
+        decoded = [(key, features[image_path]) for key, image_path, _ in chunk if image_path in features]
+        if decoded:
+            store.add([key for key, _ in decoded], np.stack([row for _, row in decoded]))
+
+# Dataset of stored features and labels, read from the store's memory map one batch at a time
+def create_embedding_dataset(store, keys, labels, batch_size=32, shuffle=True):
+    labels = np.asarray(labels, dtype=np.float32)
+
+    def batches():
+        order = np.random.permutation(len(keys)) if shuffle else np.arange(len(keys))
+        for start in range(0, len(order), batch_size):
+            chosen = order[start:start + batch_size]
+            yield store.get([keys[i] for i in chosen]).astype(np.float32), labels[chosen]
+
+    return tf.data.Dataset.from_generator(batches, output_signature=(
+        tf.TensorSpec(shape=(None,) + tuple(store.feature_shape), dtype=tf.float32),
+        tf.TensorSpec(shape=(None,), dtype=tf.float32),
+    )).prefetch(buffer_size=tf.data.AUTOTUNE)
+
+# Train only the CBAM and dense head on stored backbone features
+def train_head(store, keys, labels, epochs=10, class_num=3, batch_size=32):
+    head = build_head(class_num, store.feature_shape)
+    lr_schedule = tf.keras.optimizers.schedules.CosineDecayRestarts(
+        initial_learning_rate=1e-3, first_decay_steps=5000, t_mul=2)
+    head.compile(
+        optimizer=tf.keras.optimizers.Adam(learning_rate=lr_schedule),
+        loss="sparse_categorical_crossentropy",
+        metrics=["accuracy"]
+    )
+    history = head.fit(create_embedding_dataset(store, keys, labels, batch_size), epochs=epochs)
+    return head, history
+
+def retrain_head_from_store(data, store_dir, epochs=10, class_num=3, backbone=None, registry_dir=MODEL_REGISTRY_DIR):
+    """
+    Retrains the model on data (items of image path, label and optionally the
+    preprocessed cache path, as for create_retraining_dataset) by fitting only
+    the head on backbone features from the embedding store at store_dir. Only
+    images not stored yet go through the backbone, once; every epoch after
+    that reads the stored features. Promotes the full model to a new version
+    in the registry at registry_dir and returns it.
+    """
+    from ML.embedding_store import EmbeddingStore
+
+    backbone = backbone or build_backbone()
+    store = EmbeddingStore(store_dir, backbone.output_shape[1:], backbone=backbone.name)
+    media_dir = os.path.join(os.path.dirname(__file__), "../media")
+    image_paths = [os.path.join(media_dir, item[0]) for item in data]
+    items = [(image_path, image_path, item[2] if len(item) > 2 else None) for image_path, item in zip(image_paths, data)]
+    compute_embeddings(store, items, backbone)
+
+    # Images that could not be decoded have no features and are left out
+    labelled = [(image_path, item[1]) for image_path, item in zip(image_paths, data) if image_path in store]
+    head, history = train_head(store, [key for key, _ in labelled], [label for _, label in labelled], epochs, class_num)
+    model = assemble_model(backbone, head)
+    labels = [int(label) for _, label in labelled]
+    promote_trained_model(model, history, registry_dir, {
+        "training": "head",
+        "training_samples": len(labels),
+        "class_counts": {str(label): labels.count(label) for label in sorted(set(labels))},
+    })
+    return model, history
+
 def create_retraining_dataset(data):
     current_script_path = os.path.dirname(__file__)
     media_dir = os.path.join(current_script_path, "../media",)
-    # Extract file paths and numerical labels
+    # Extract file paths and numerical labels, and the preprocessed cache file if the item has one
     file_paths = [os.path.join(media_dir, item[0]) for item in data]
     numerical_labels = [item[1] for item in data]
+    cache_paths = [item[2] if len(item) > 2 else "" for item in data]
     # Create the TensorFlow dataset
     batch_size = 32
-    train_dataset = create_tf_dataset(file_paths, numerical_labels, batch_size=batch_size, shuffle=True)
+    train_dataset = create_tf_dataset(file_paths, numerical_labels, batch_size=batch_size, shuffle=True, cache_paths=cache_paths)
 
     # Inspect the dataset
     for batch in train_dataset.take(1):
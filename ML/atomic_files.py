@@ -0,0 +1,22 @@
+import os
+import tempfile
+
+
+def write_file_atomically(path, data, sync=False):
+    """
+    Writes data (bytes) to a temporary file next to path and renames it into
+    place, so anyone reading path sees either the old file or the complete
+    new one, never a half written file. With sync, the data is flushed to
+    disk before the rename, so the new file also survives a crash.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+            if sync:
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
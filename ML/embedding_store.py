@@ -0,0 +1,150 @@
+"""
+On-disk store of damage model backbone features, one row per image.
+
+Rows are float16 arrays appended to a single raw file and read back through
+a memory map, with a small JSON index giving the row of every image key. The
+index is replaced atomically after the rows it lists are written, so a crash
+mid-append leaves the store as it was before the append.
+
+The features kept are the backbone's 7x7xC spatial maps rather than pooled
+vectors, because the CBAM layer at the start of the head attends over the
+spatial positions and cannot be trained on pooled features.
+"""
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from ML.atomic_files import write_file_atomically
+
+try:
+    import fcntl
+except ImportError:  # Windows, appends are then only serialised within the process
+    fcntl = None
+
+FEATURES_FILE = "features.f16"
+INDEX_FILE = "index.json"
+LOCK_FILE = ".lock"
+
+# One lock per store directory, shared by every EmbeddingStore of this process
+_directory_locks = {}
+_directory_locks_lock = threading.Lock()
+
+
+@contextmanager
+def _locked_directory(directory):
+    with _directory_locks_lock:
+        lock = _directory_locks.setdefault(os.path.realpath(directory), threading.Lock())
+    with lock:
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(directory, LOCK_FILE), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class EmbeddingStore:
+    """
+    Backbone features keyed by image. feature_shape is taken from the first
+    features added when not given; backbone names the network they came
+    from, and opening a store of another backbone's features fails.
+    """
+
+    def __init__(self, directory, feature_shape=None, backbone="convnext_xlarge"):
+        self.directory = str(directory)
+        self.features_path = os.path.join(self.directory, FEATURES_FILE)
+        self.index_path = os.path.join(self.directory, INDEX_FILE)
+        self._lock = threading.Lock()
+        self._memmap = None
+        self.backbone = backbone
+        self.feature_shape = tuple(feature_shape) if feature_shape is not None else None
+        self.keys = []
+        self.rows = {}
+        self._read_index()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def missing(self, keys):
+        return [key for key in dict.fromkeys(keys) if key not in self.rows]
+
+    def add(self, keys, features):
+        """Appends features for keys not in the store yet, features[i] being those of keys[i]."""
+        features = np.asarray(features, dtype=np.float16)
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with _locked_directory(self.directory):
+                # Another store may have appended since this one last read the index
+                self._read_index()
+                if self.feature_shape is None:
+                    self.feature_shape = features.shape[1:]
+                if features.shape[1:] != self.feature_shape:
+                    raise ValueError(f"Expected features of shape {self.feature_shape}, got {features.shape[1:]}")
+                new = {}
+                for row, key in enumerate(keys):
+                    if key not in self.rows and key not in new:
+                        new[key] = row
+                new = list(new.items())
+                if not new:
+                    return
+
+                mode = "r+b" if os.path.exists(self.features_path) else "wb"
+                with open(self.features_path, mode) as features_file:
+                    # Rows past the index are left over from an append that never finished
+                    features_file.seek(len(self.keys) * self._row_bytes())
+                    features_file.write(np.ascontiguousarray(features[[row for _, row in new]]).tobytes())
+                    features_file.truncate()
+                    features_file.flush()
+                    os.fsync(features_file.fileno())
+
+                for key, _ in new:
+                    self.rows[key] = len(self.keys)
+                    self.keys.append(key)
+                self._write_index()
+                self._memmap = None
+
+    def get(self, keys):
+        """float16 array of the features of keys, in order. Raises KeyError for keys not in the store."""
+        rows = [self.rows[key] for key in keys]
+        if not rows:
+            return np.zeros((0,) + tuple(self.feature_shape or ()), dtype=np.float16)
+        return np.asarray(self._features()[rows])
+
+    def _features(self):
+        with self._lock:
+            if self._memmap is None or len(self._memmap) != len(self.keys):
+                self._memmap = np.memmap(self.features_path, dtype=np.float16, mode="r",
+                                         shape=(len(self.keys),) + self.feature_shape)
+            return self._memmap
+
+    def _row_bytes(self):
+        return int(np.prod(self.feature_shape)) * np.dtype(np.float16).itemsize
+
+    def _read_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path) as index_file:
+            index = json.load(index_file)
+        if index["backbone"] != self.backbone:
+            raise ValueError(f"Embedding store {self.directory} holds {index['backbone']} features, not {self.backbone}")
+        if self.feature_shape is not None and tuple(index["feature_shape"]) != self.feature_shape:
+            raise ValueError(f"Embedding store {self.directory} holds features of shape {index['feature_shape']}")
+        self.feature_shape = tuple(index["feature_shape"])
+        if len(index["keys"]) != len(self.keys):
+            self.keys = index["keys"]
+            self.rows = {key: row for row, key in enumerate(self.keys)}
+            self._memmap = None
+
+    def _write_index(self):
+        index = {"backbone": self.backbone, "feature_shape": list(self.feature_shape), "dtype": "float16",
+                 "keys": self.keys}
+        write_file_atomically(self.index_path, json.dumps(index).encode(), sync=True)
@@ -0,0 +1,178 @@
+"""
+Export of the damage assessment model to a quantized TFLite artifact for
+CPU-only nodes, and a report comparing it with the full Keras model.
+
+Quantization modes:
+    dynamic  weights stored as int8, activations computed in float (no data needed)
+    int8     weights and activations in int8, calibrated on representative images
+    float16  weights stored as float16
+    none     plain float32 conversion
+
+The report scores a held-out image set with both models and gives the class
+agreement rate, the accuracy of each against the labels when the set has
+them, and per-image latency at batch size 1 and batched. Switch over by
+pointing DAMAGE_MODEL_FILE at the .tflite file once the agreement is good
+enough; load_trained_model loads either format.
+
+Usage (from the project root), with a MEDIC style TSV/CSV of image_path and
+optionally damage_severity columns, paths relative to the file:
+    python -m ML.export_tflite --heldout dataset/MEDIC_test.tsv --quantization int8
+"""
+import argparse
+import json
+import os
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from ML.Damage_Assessment import DEFAULT_DECODE_WORKERS, calculate_damage_probabilities_batch, \
+    decode_image_array, load_trained_model
+
+QUANTIZATION_MODES = ("dynamic", "int8", "float16", "none")
+LABEL_MAPPING = {'little_or_none': 0, 'mild': 1, 'severe': 2}
+# Images used to calibrate activation ranges for int8
+REPRESENTATIVE_IMAGES = 200
+LATENCY_IMAGES = 20
+
+
+def export_tflite(model, output_path, quantization="dynamic", representative_paths=()):
+    """Converts a loaded Keras model and writes it to output_path. Returns the artifact's size in bytes."""
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization {quantization}, expected one of {', '.join(QUANTIZATION_MODES)}")
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization != "none":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    if quantization == "int8":
+        representative_paths = list(representative_paths)[:REPRESENTATIVE_IMAGES]
+        if not representative_paths:
+            raise ValueError("int8 quantization needs representative images")
+
+        def representative_dataset():
+            for path in representative_paths:
+                image = decode_image_array(path)
+                if image is not None:
+                    yield [image[np.newaxis]]
+
+        converter.representative_dataset = representative_dataset
+        # Inputs and outputs stay float32, so callers pass the same arrays as to the Keras model
+
+    artifact = converter.convert()
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    temp_path = output_path + ".tmp"
+    with open(temp_path, "wb") as artifact_file:
+        artifact_file.write(artifact)
+    os.replace(temp_path, output_path)
+    return len(artifact)
+
+
+def read_heldout_set(path):
+    """(image_paths, labels or None) of a TSV/CSV with image_path and optionally damage_severity columns."""
+    frame = pd.read_csv(path, sep="\t" if path.endswith(".tsv") else ",")
+    base_dir = os.path.dirname(os.path.abspath(path))
+    image_paths = [os.path.join(base_dir, image_path) for image_path in frame["image_path"]]
+    if "damage_severity" not in frame:
+        return image_paths, None
+    labels = frame["damage_severity"].map(lambda label: LABEL_MAPPING.get(label, label))
+    return image_paths, dict(zip(image_paths, labels.astype(int)))
+
+
+def measure_latency(model, image_paths, batch_size):
+    """Seconds per image at batch size 1 (mean, p50, p95) and batched, on already decoded images."""
+    images = [image for image in (decode_image_array(path) for path in image_paths[:LATENCY_IMAGES])
+              if image is not None]
+    if not images:
+        return None
+    images = np.stack(images)
+    model.predict_on_batch(images[:1])  # warm up, the first call builds the graph or allocates tensors
+
+    single = []
+    for image in images:
+        started = perf_counter()
+        model.predict_on_batch(image[np.newaxis])
+        single.append(perf_counter() - started)
+
+    batch = np.resize(images, (batch_size,) + images.shape[1:])
+    model.predict_on_batch(batch)
+    started = perf_counter()
+    model.predict_on_batch(batch)
+    batched = (perf_counter() - started) / batch_size
+
+    return {
+        "single_mean": float(np.mean(single)),
+        "single_p50": float(np.percentile(single, 50)),
+        "single_p95": float(np.percentile(single, 95)),
+        "batched_per_image": batched,
+        "batch_size": batch_size,
+    }
+
+
+def compare_models(full_model, candidate_model, image_paths, labels=None, batch_size=16,
+                   decode_workers=DEFAULT_DECODE_WORKERS):
+    """Accuracy-vs-latency report of candidate_model against full_model on the same images."""
+    full = calculate_damage_probabilities_batch(image_paths, full_model, batch_size, decode_workers)
+    candidate = calculate_damage_probabilities_batch(image_paths, candidate_model, batch_size, decode_workers)
+    scored = [path for path in full if path in candidate]
+    if not scored:
+        raise ValueError("None of the held-out images could be decoded")
+
+    full_classes = np.array([np.argmax(full[path]) for path in scored])
+    candidate_classes = np.array([np.argmax(candidate[path]) for path in scored])
+    report = {
+        "images": len(scored),
+        "class_agreement": float(np.mean(full_classes == candidate_classes)),
+        "agreement_by_class": {},
+        "max_probability_difference": float(max(np.abs(full[path] - candidate[path]).max() for path in scored)),
+        "latency_seconds": {
+            "full": measure_latency(full_model, scored, batch_size),
+            "candidate": measure_latency(candidate_model, scored, batch_size),
+        },
+    }
+    for label, index in LABEL_MAPPING.items():
+        predicted = full_classes == index
+        if predicted.any():
+            report["agreement_by_class"][label] = float(np.mean(candidate_classes[predicted] == index))
+    if labels is not None:
+        true_classes = np.array([labels[path] for path in scored])
+        report["accuracy"] = {
+            "full": float(np.mean(full_classes == true_classes)),
+            "candidate": float(np.mean(candidate_classes == true_classes)),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the damage model to TFLite and compare it with the full model.")
+    parser.add_argument("--model", default="ML/models/damageassessment.keras")
+    parser.add_argument("--output", help="Defaults to the model path with a _<quantization>.tflite suffix")
+    parser.add_argument("--quantization", choices=QUANTIZATION_MODES, default="dynamic")
+    parser.add_argument("--heldout", required=True, help="TSV/CSV of held-out images to compare the models on")
+    parser.add_argument("--calibration", help="TSV/CSV of images to calibrate int8 on, defaults to the held-out set")
+    parser.add_argument("--batch-size", type=int, default=16)
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.model)[0] + f"_{args.quantization}.tflite"
+    image_paths, labels = read_heldout_set(args.heldout)
+    full_model = load_trained_model(args.model)
+
+    calibration_paths = read_heldout_set(args.calibration)[0] if args.calibration else image_paths
+    size = export_tflite(full_model, output, args.quantization, calibration_paths)
+    report = compare_models(full_model, load_trained_model(output), image_paths, labels, args.batch_size)
+    report.update({
+        "model": args.model,
+        "artifact": output,
+        "quantization": args.quantization,
+        "artifact_bytes": size,
+        "model_bytes": os.path.getsize(args.model),
+    })
+
+    with open(os.path.splitext(output)[0] + "_report.json", "w") as report_file:
+        json.dump(report, report_file, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
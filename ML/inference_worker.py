@@ -0,0 +1,227 @@
+"""
+Out-of-process inference worker for the damage assessment model.
+
+The worker loads the model once and serves requests from any number of
+clients over a local socket (multiprocessing.connection, authenticated with a
+shared key). Requests that arrive within BATCH_WINDOW_SECONDS of each other
+are coalesced into one micro-batch, up to MAX_BATCH_IMAGES images, and scored
+with calculate_damage_probabilities_batch, so concurrent callers share
+forward passes instead of each running their own.
+
+Clients get a Future per request and can wait on it or attach callbacks, so
+the web process never loads TensorFlow weights or runs the model itself.
+
+Run it from the project root with:
+    python -m ML.inference_worker --model ML/models/damageassessment.keras
+or with the Django settings through `manage.py run_inference_worker`.
+"""
+import argparse
+import itertools
+import queue
+import threading
+from concurrent.futures import Future
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from time import monotonic
+
+import numpy as np
+
+DEFAULT_ADDRESS = ("127.0.0.1", 6010)
+# How long the first request of a batch waits for others to join it
+BATCH_WINDOW_SECONDS = 0.02
+MAX_BATCH_IMAGES = 32
+
+
+class InferenceWorker:
+    """
+    Serves damage probabilities for image paths. model is anything with a
+    predict_on_batch method, loaded once by the caller.
+    """
+
+    def __init__(self, model, address=DEFAULT_ADDRESS, authkey=None, batch_window=BATCH_WINDOW_SECONDS,
+                 max_batch_images=MAX_BATCH_IMAGES, decode_workers=None):
+        self.model = model
+        self.address = address
+        self.authkey = authkey
+        self.batch_window = batch_window
+        self.max_batch_images = max_batch_images
+        self.decode_workers = decode_workers
+        self._requests = queue.Queue()
+
+    def serve_forever(self):
+        threading.Thread(target=self._run_batches, daemon=True).start()
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print(f"Inference worker listening on {listener.address}")
+            while True:
+                try:
+                    connection = listener.accept()
+                except Exception as e:
+                    # A client that failed to authenticate, keep serving the others
+                    print(f"Rejected inference client: {e}")
+                    continue
+                threading.Thread(target=self._read_requests, args=(connection,), daemon=True).start()
+
+    def _read_requests(self, connection):
+        # Replies to one connection come from the batching thread only, so sends never interleave
+        try:
+            while True:
+                request_id, image_paths, cache_paths = connection.recv()
+                self._requests.put((connection, request_id, list(image_paths), cache_paths))
+        except (EOFError, OSError):
+            connection.close()
+
+    def _next_batch(self):
+        batch = [self._requests.get()]
+        images = len(batch[0][2])
+        deadline = monotonic() + self.batch_window
+        while images < self.max_batch_images:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            images += len(request[2])
+        return batch
+
+    def _run_batches(self):
+        from ML.Damage_Assessment import DEFAULT_DECODE_WORKERS, calculate_damage_probabilities_batch
+
+        while True:
+            batch = self._next_batch()
+            image_paths = [path for _, _, paths, _ in batch for path in paths]
+            cache_paths = {}
+            for _, _, _, request_cache_paths in batch:
+                cache_paths.update(request_cache_paths)
+            try:
+                probabilities = calculate_damage_probabilities_batch(
+                    image_paths, self.model, batch_size=self.max_batch_images,
+                    decode_workers=self.decode_workers or DEFAULT_DECODE_WORKERS, cache_paths=cache_paths)
+                replies = [(connection, (request_id, True, {path: probabilities[path] for path in paths
+                                                            if path in probabilities}))
+                           for connection, request_id, paths, _ in batch]
+            except Exception as e:
+                replies = [(connection, (request_id, False, repr(e))) for connection, request_id, _, _ in batch]
+
+            for connection, reply in replies:
+                try:
+                    connection.send(reply)
+                except (EOFError, OSError):
+                    # The client went away, its reader thread closes the connection
+                    pass
+
+
+class InferenceError(RuntimeError):
+    pass
+
+
+class InferenceClient:
+    """
+    Thread-safe client of an InferenceWorker. submit returns a Future of the
+    class probabilities of each readable image, keyed by path, optionally
+    with preprocessed cache files to read instead of the images; assess waits
+    for the predicted classes. The connection is opened on first use and
+    reopened after it drops, failing the requests that were in flight.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None):
+        self.address = address
+        self.authkey = authkey
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pending = {}
+        self._ids = itertools.count()
+
+    def submit(self, image_paths, cache_paths=None):
+        future = Future()
+        failed = []
+        with self._lock:
+            request_id = next(self._ids)
+            try:
+                connection = self._connect()
+                self._pending[request_id] = future
+                connection.send((request_id, list(image_paths), dict(cache_paths or {})))
+            except (EOFError, OSError, AuthenticationError) as e:
+                self._pending.pop(request_id, None)
+                failed = self._drop(self._connection)
+                future.set_exception(InferenceError(f"Inference worker at {self.address} is unavailable: {e}"))
+        self._fail(failed)
+        return future
+
+    def assess(self, image_paths, timeout=None, cache_paths=None):
+        probabilities = self.submit(image_paths, cache_paths).result(timeout)
+        return {path: int(np.argmax(row)) for path, row in probabilities.items()}
+
+    def close(self):
+        with self._lock:
+            failed = self._drop(self._connection)
+        self._fail(failed)
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = Client(self.address, authkey=self.authkey)
+            threading.Thread(target=self._read_replies, args=(self._connection,), daemon=True).start()
+        return self._connection
+
+    def _read_replies(self, connection):
+        try:
+            while True:
+                request_id, ok, result = connection.recv()
+                with self._lock:
+                    future = self._pending.pop(request_id, None)
+                if future is None:
+                    continue
+                if ok:
+                    future.set_result(result)
+                else:
+                    future.set_exception(InferenceError(result))
+        except (EOFError, OSError):
+            with self._lock:
+                failed = self._drop(connection)
+            self._fail(failed)
+
+    def _drop(self, connection):
+        # Called with the lock held. Returns the futures of the requests sent on this
+        # connection, failed by _fail once the lock is released so callbacks can submit again
+        if connection is None or connection is not self._connection:
+            return []
+        self._connection = None
+        try:
+            connection.close()
+        except OSError:
+            pass
+        pending, self._pending = self._pending, {}
+        return list(pending.values())
+
+    def _fail(self, futures):
+        for future in futures:
+            future.set_exception(InferenceError(f"Lost the connection to the inference worker at {self.address}"))
+
+
+def parse_address(address):
+    """'host:port' to a (host, port) tuple, anything else is used as a Unix socket path."""
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the damage assessment model to other processes.")
+    parser.add_argument("--model", default="ML/models/damageassessment.keras")
+    parser.add_argument("--address", default="%s:%d" % DEFAULT_ADDRESS, help="host:port or a Unix socket path")
+    parser.add_argument("--authkey", default="", help="Key clients must present")
+    parser.add_argument("--batch-window", type=float, default=BATCH_WINDOW_SECONDS)
+    parser.add_argument("--max-batch-images", type=int, default=MAX_BATCH_IMAGES)
+    args = parser.parse_args()
+
+    from ML.Damage_Assessment import load_trained_model
+    model = load_trained_model(args.model)
+    InferenceWorker(model, parse_address(args.address), args.authkey.encode() or None,
+                    args.batch_window, args.max_batch_images).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Versioned store of trained damage assessment models.
+
+Every promoted model gets its own version directory holding the model file
+and a metadata.json (metrics, training sample counts, ...). It is written
+under a temporary name and renamed into place complete, then made current by
+atomically rewriting the CURRENT file, the same way the weather dataset is
+versioned. Readers therefore only ever see whole versions.
+
+Running processes keep using the model they loaded. A ModelWatcher polls
+CURRENT in the background, loads a newly promoted version off the request
+path and hands it to a callback, which swaps the in-memory reference. Code
+that reads the reference once per batch finishes its batch on the old model
+and starts the next one on the new model, with no restart.
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from datetime import datetime, timezone
+from time import sleep
+
+MODEL_FILENAME = "model.keras"
+METADATA_FILENAME = "metadata.json"
+CURRENT_FILENAME = "CURRENT"
+# Versions kept besides the current one, for rolling back
+KEEP_VERSIONS = 5
+CHECK_SECONDS = 30
+
+
+class ModelRegistry:
+
+    def __init__(self, root, keep=KEEP_VERSIONS):
+        self.root = str(root)
+        self.keep = keep
+
+    def current_version(self):
+        """The current version, or None when nothing has been promoted yet."""
+        try:
+            with open(os.path.join(self.root, CURRENT_FILENAME)) as current_file:
+                return current_file.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def versions(self):
+        """Every complete version, oldest first."""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root)
+                      if not name.startswith(".") and os.path.isdir(os.path.join(self.root, name)))
+
+    def metadata(self, version):
+        with open(os.path.join(self.root, version, METADATA_FILENAME)) as metadata_file:
+            return json.load(metadata_file)
+
+    def model_path(self, version=None):
+        """Path of the model file of version, the current one by default, or None if there is none."""
+        version = version or self.current_version()
+        if version is None:
+            return None
+        return os.path.join(self.root, version, self.metadata(version)["filename"])
+
+    def promote(self, write_model, metadata=None, filename=MODEL_FILENAME):
+        """
+        Adds a version and makes it current. write_model(path) writes the
+        model file to the path it is given. Returns the new version.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        created_at = datetime.now(timezone.utc)
+        # Names sort in the order versions were made
+        version = created_at.strftime("%Y%m%dT%H%M%S-%f") + "-" + uuid.uuid4().hex[:6]
+
+        tmp_dir = tempfile.mkdtemp(dir=self.root, prefix=".tmp-")
+        try:
+            write_model(os.path.join(tmp_dir, filename))
+            metadata = dict(metadata or {}, version=version, filename=filename, created_at=created_at.isoformat())
+            with open(os.path.join(tmp_dir, METADATA_FILENAME), "w") as metadata_file:
+                json.dump(metadata, metadata_file, indent=2, default=float)
+            os.replace(tmp_dir, os.path.join(self.root, version))
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        self.set_current(version)
+        self.prune()
+        return version
+
+    def promote_file(self, path, metadata=None):
+        """Promotes a copy of an existing model file, such as a TFLite export."""
+        return self.promote(lambda target: shutil.copyfile(path, target), metadata,
+                            MODEL_FILENAME if str(path).endswith(".keras") else "model" + os.path.splitext(path)[1])
+
+    def set_current(self, version):
+        """Makes an existing version current, which is also how to roll back."""
+        if not os.path.isfile(os.path.join(self.root, version, METADATA_FILENAME)):
+            raise ValueError(f"No model version {version} in {self.root}")
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as tmp_file:
+                tmp_file.write(version)
+            os.replace(tmp_path, os.path.join(self.root, CURRENT_FILENAME))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def prune(self):
+        # Loaded models live in memory, so removing a version file doesn't affect processes using it
+        current = self.current_version()
+        old = [version for version in self.versions() if version != current]
+        for version in old[:max(len(old) - self.keep, 0)]:
+            shutil.rmtree(os.path.join(self.root, version), ignore_errors=True)
+
+
+class ModelWatcher:
+    """
+    Polls a registry every interval seconds on a daemon thread. When another
+    version becomes current it is loaded with load_model(path) and passed to
+    on_swap(model, version). A version that fails to load is retried on the
+    next poll, and the old model stays in use meanwhile.
+    """
+
+    def __init__(self, registry, load_model, on_swap, interval=CHECK_SECONDS, version=None):
+        self.registry = registry
+        self.load_model = load_model
+        self.on_swap = on_swap
+        self.interval = interval
+        self.version = version
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def check(self):
+        """Swaps in the current version if it isn't loaded yet. Returns whether it did."""
+        version = self.registry.current_version()
+        if version is None or version == self.version:
+            return False
+        model = self.load_model(self.registry.model_path(version))
+        self.version = version
+        self.on_swap(model, version)
+        return True
+
+    def _run(self):
+        while True:
+            sleep(self.interval)
+            try:
+                if self.check():
+                    print(f"Damage model {self.version} loaded")
+            except Exception as e:
+                print(f"Error loading damage model from {self.registry.root}: {e}")
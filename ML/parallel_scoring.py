@@ -0,0 +1,95 @@
+"""
+Process pool scoring for the weather outlier model.
+
+LocalOutlierFactor.decision_function is CPU bound and single threaded, so
+large scoring passes (building the daily extreme weather table, scoring a
+big frame) can be split across worker processes. The scaled feature matrix
+and the fitted model are written once to shared memory (/dev/shm where it
+exists) and memory-mapped by every worker, so neither is copied per worker
+or per task. Kept separate from weather_detection_model so that spawned
+workers only have to import numpy and joblib.
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import joblib
+import numpy as np
+
+# Chunks per worker when no boundaries are given, so a slow chunk doesn't
+# leave the other workers idle at the end
+CHUNKS_PER_WORKER = 4
+
+# Set in each worker by _init_worker
+_worker_model = None
+_worker_x = None
+
+
+def _init_worker(model_path, features_path):
+    global _worker_model, _worker_x
+    _worker_model = joblib.load(model_path, mmap_mode='r')
+    _worker_x = np.load(features_path, mmap_mode='r')
+
+
+def _score_range(bounds):
+    start, end = bounds
+    return start, _worker_model.decision_function(_worker_x[start:end])
+
+
+def _shared_scratch_dir():
+    return tempfile.mkdtemp(prefix="weather-scoring-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+
+def parallel_decision_function(model, fill_features, rows, n_features, workers, boundaries=None):
+    """
+    Returns model.decision_function over a rows x n_features matrix, scored
+    by a pool of workers processes.
+
+    fill_features is called once with a writable memory-mapped array of that
+    shape and must fill it with the (already scaled) features, which lets
+    the caller write it in chunks without holding a second copy in memory.
+
+    boundaries optionally gives the row positions scoring may be split at
+    (e.g. where each sensor's rows begin). Every chunk's scores are written
+    back at its own offset, so the result does not depend on how the work
+    was split or in which order workers finish.
+    """
+    scratch_dir = _shared_scratch_dir()
+    try:
+        features_path = os.path.join(scratch_dir, "features.npy")
+        weather_x = np.lib.format.open_memmap(features_path, mode='w+', dtype=np.float64, shape=(rows, n_features))
+        fill_features(weather_x)
+        weather_x.flush()
+        del weather_x
+
+        model_path = os.path.join(scratch_dir, "model.joblib")
+        joblib.dump(model, model_path)
+
+        if boundaries is None:
+            boundaries = np.linspace(0, rows, workers * CHUNKS_PER_WORKER + 1)
+        boundaries = np.unique(np.clip(np.asarray(boundaries, dtype=np.int64), 0, rows))
+        boundaries = np.union1d(boundaries, [0, rows])
+        chunks = [(int(start), int(end)) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+
+        scores = np.empty(rows)
+        # spawn rather than fork, forking a threaded web worker is not safe
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker, initargs=(model_path, features_path)) as pool:
+            for start, chunk_scores in pool.map(_score_range, chunks):
+                scores[start:start + len(chunk_scores)] = chunk_scores
+        return scores
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def split_evenly(group_starts, parts):
+    """
+    Picks up to parts + 1 of the given group start positions (sorted, first
+    0 and last the total) that split the rows into roughly equal runs of
+    whole groups.
+    """
+    group_starts = np.asarray(group_starts)
+    targets = np.linspace(0, group_starts[-1], parts + 1)
+    return np.unique(group_starts[np.clip(np.searchsorted(group_starts, targets), 0, len(group_starts) - 1)])
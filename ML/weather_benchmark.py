@@ -0,0 +1,246 @@
+"""
+Benchmark for the weather risk pipeline in weather_detection_model.
+
+Generates a synthetic dataset shaped like the Kaggle GlobalWeatherRepository
+CSV, so it runs fully offline, then times every stage of the pipeline on it
+and reports throughput and peak memory as JSON.
+
+Usage (from the project root):
+    python -m ML.weather_benchmark --sensors 200 --days 90 --output bench.json
+
+With --scoring-workers 1,2,4 the daily table is also built with each amount
+of scoring processes, to show how parallel LOF scoring scales with cores.
+"""
+import argparse
+import json
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from ML import weather_detection_model as weather
+
+# Same column order as GlobalWeatherRepository.csv, without the air quality
+# and astronomy columns which nothing in the pipeline reads
+SYNTHETIC_COLUMNS = [
+    'country', 'location_name', 'latitude', 'longitude', 'timezone', 'last_updated_epoch', 'last_updated',
+    'temperature_celsius', 'temperature_fahrenheit', 'condition_text', 'wind_mph', 'wind_kph', 'wind_degree',
+    'wind_direction', 'pressure_mb', 'pressure_in', 'precip_mm', 'precip_in', 'humidity', 'cloud',
+    'feels_like_celsius', 'feels_like_fahrenheit', 'visibility_km', 'visibility_miles', 'uv_index',
+    'gust_mph', 'gust_kph',
+]
+
+
+def generate_weather_dataset(sensors=200, days=90, readings_per_day=1, storm_rate=0.02, seed=0, end_time=None):
+    """
+    Returns a dataframe shaped like GlobalWeatherRepository with one reading
+    per sensor readings_per_day times a day for the last days days. Each
+    sensor gets its own climate, and storm_rate of the readings are storms
+    (high wind, gusts and rain) so the outlier model has something to find.
+    """
+    rng = np.random.default_rng(seed)
+    end_time = int(time.time()) if end_time is None else int(end_time)
+
+    latitudes = np.degrees(np.arcsin(rng.uniform(-0.9, 0.95, sensors)))
+    longitudes = rng.uniform(-180, 180, sensors)
+    base_temperatures = 28 - np.abs(latitudes) * 0.45 + rng.normal(0, 3, sensors)
+    base_humidity = rng.uniform(35, 85, sensors)
+
+    readings = sensors * days * readings_per_day
+    sensor = np.tile(np.arange(sensors), days * readings_per_day)
+    reading_slot = np.repeat(np.arange(days * readings_per_day), sensors)
+    epoch = end_time - (reading_slot * 86400) // readings_per_day - rng.integers(0, 3600, readings)
+    epoch = epoch - epoch % 60
+
+    storm = rng.random(readings) < storm_rate
+    wind_mph = np.abs(rng.gamma(2.0, 3.5, readings)) + storm * rng.uniform(25, 70, readings)
+    gust_mph = wind_mph * rng.uniform(1.1, 1.6, readings) + storm * rng.uniform(5, 30, readings)
+    precip_mm = rng.exponential(0.3, readings) * (rng.random(readings) < 0.3) + storm * rng.uniform(10, 80, readings)
+    temperature_celsius = base_temperatures[sensor] + rng.normal(0, 4, readings)
+    humidity = np.clip(base_humidity[sensor] + rng.normal(0, 10, readings) + storm * 15, 5, 100).round()
+    pressure_mb = rng.normal(1013, 6, readings) - storm * rng.uniform(10, 40, readings)
+    cloud = np.clip(rng.normal(45, 30, readings) + storm * 50, 0, 100).round()
+    visibility_km = np.clip(10 - storm * rng.uniform(3, 9, readings), 0.5, 10).round(1)
+    wind_degree = rng.integers(0, 360, readings)
+    directions = np.array(['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE', 'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW'])
+
+    return pd.DataFrame({
+        'country': np.array(['Country {}'.format(i // 4) for i in range(sensors)])[sensor],
+        'location_name': np.array(['Sensor {}'.format(i) for i in range(sensors)])[sensor],
+        'latitude': latitudes.round(4)[sensor],
+        'longitude': longitudes.round(4)[sensor],
+        'timezone': 'UTC',
+        'last_updated_epoch': epoch,
+        'last_updated': pd.to_datetime(epoch, unit='s').strftime('%Y-%m-%d %H:%M'),
+        'temperature_celsius': temperature_celsius.round(1),
+        'temperature_fahrenheit': (temperature_celsius * 9 / 5 + 32).round(1),
+        'condition_text': np.where(storm, 'Thunderstorm', 'Partly cloudy'),
+        'wind_mph': wind_mph.round(1),
+        'wind_kph': (wind_mph * 1.609).round(1),
+        'wind_degree': wind_degree,
+        'wind_direction': directions[(wind_degree * 16) // 360],
+        'pressure_mb': pressure_mb.round(),
+        'pressure_in': (pressure_mb * 0.02953).round(2),
+        'precip_mm': precip_mm.round(2),
+        'precip_in': (precip_mm / 25.4).round(2),
+        'humidity': humidity,
+        'cloud': cloud,
+        'feels_like_celsius': (temperature_celsius - wind_mph * 0.1).round(1),
+        'feels_like_fahrenheit': ((temperature_celsius - wind_mph * 0.1) * 9 / 5 + 32).round(1),
+        'visibility_km': visibility_km,
+        'visibility_miles': (visibility_km * 0.621).round(1),
+        'uv_index': rng.integers(0, 11, readings),
+        'gust_mph': gust_mph.round(1),
+        'gust_kph': (gust_mph * 1.609).round(1),
+    }, columns=SYNTHETIC_COLUMNS)
+
+
+class StageTimer:
+    """
+    Collects wall time and peak traced memory for each stage run through
+    it, plus a throughput figure when the amount of work is known.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def run(self, name, function, items=None, unit='rows'):
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+        peak_memory = tracemalloc.get_traced_memory()[1] - start_memory
+
+        stage = {'seconds': round(seconds, 6), 'peak_memory_bytes': int(max(peak_memory, 0))}
+        if items is not None:
+            stage[unit] = int(items)
+            stage['{}_per_second'.format(unit)] = round(items / seconds, 2) if seconds > 0 else None
+        self.stages[name] = stage
+        return result
+
+
+def run_benchmark(sensors=200, days=90, readings_per_day=1, queries=1000, timeframe_in_days=365,
+                  percent_to_consider_extreme=50, sensors_to_use=3, seed=0, scoring_workers=()):
+    """
+    Runs every stage of the weather risk pipeline on a synthetic dataset in
+    a scratch directory and returns the measurements as a dict.
+
+    For every count in scoring_workers the daily table is built again with
+    that many scoring processes, and checked to match the in process build.
+    """
+    rng = np.random.default_rng(seed + 1)
+    query_lat_lon = np.column_stack((rng.uniform(-60, 70, queries), rng.uniform(-180, 180, queries)))
+    timer = StageTimer()
+    previous_dir = os.getcwd()
+
+    tracemalloc.start()
+    try:
+        with tempfile.TemporaryDirectory() as scratch_dir:
+            # The pipeline keeps its files relative to the working directory
+            os.chdir(scratch_dir)
+
+            dataset = timer.run('generate', lambda: generate_weather_dataset(sensors, days, readings_per_day, seed=seed),
+                                sensors * days * readings_per_day)
+            dataset.to_csv('GlobalWeatherRepository.csv', index=False)
+            del dataset
+            rows = sensors * days * readings_per_day
+
+            timer.run('ingest_csv', lambda: weather.ingest_weather_csv('GlobalWeatherRepository.csv'), rows)
+            dataset = timer.run('load', weather.load_dataset_columns, rows)
+            fingerprint = weather.get_dataset_fingerprint(dataset)
+
+            features = timer.run('preprocess', lambda: weather.prepare_features(dataset), rows)
+            model = timer.run('fit', lambda: weather.create_model(features.normalised_x, fingerprint=fingerprint),
+                              len(features.normalised_x))
+
+            index = timer.run('sensor_index_build', lambda: weather.SensorIndex(dataset), sensors, 'sensors')
+            _, point_sensors = timer.run('nearest_sensor_search_batch',
+                                         lambda: index.nearest_sensors_batch(query_lat_lon, sensors_to_use),
+                                         queries, 'queries')
+            timer.run('nearest_sensor_search_single',
+                      lambda: [index.nearest_sensors(lat, lon, sensors_to_use) for lat, lon in query_lat_lon],
+                      queries, 'queries')
+
+            # Model pass over the closest sensors' readings, as done before the daily table
+            scored_points = min(queries, 100)
+            closest_frames = [dataset.iloc[index.rows_for_sensors(point)] for point in point_sensors[:scored_points]]
+            timer.run('per_day_scoring',
+                      lambda: [weather.get_extreme_weather_over_timeframe(
+                          frame, model, features.normalisation_coeff, timeframe_in_days, percent_to_consider_extreme)
+                          for frame in closest_frames],
+                      sum(len(frame) for frame in closest_frames))
+
+            daily_table = timer.run('daily_table_build',
+                                    lambda: weather.DailyWeatherTable.build(dataset, index, model, features.normalisation_coeff),
+                                    rows)
+
+            def query_daily_table():
+                for point in point_sensors:
+                    point = daily_table.sensors_for_locations(index.location_names[point])
+                    _, readings, outliers = daily_table.day_totals(point, timeframe_in_days)
+                    if len(readings):
+                        weather.get_extreme_day_fraction((readings - 2 * outliers) / readings, percent_to_consider_extreme)
+
+            timer.run('daily_table_queries', query_daily_table, queries, 'queries')
+
+            # Scaling runs skip the row threshold, the pool itself is what is measured
+            min_rows = weather.PARALLEL_SCORING_MIN_ROWS
+            weather.PARALLEL_SCORING_MIN_ROWS = 0
+            try:
+                for workers in scoring_workers:
+                    table = timer.run('daily_table_build_workers_{}'.format(workers),
+                                      lambda: weather.DailyWeatherTable.build(
+                                          dataset, index, model, features.normalisation_coeff, workers),
+                                      rows)
+                    if not (np.array_equal(table.outliers, daily_table.outliers)
+                            and np.array_equal(table.mean_scores, daily_table.mean_scores)):
+                        raise AssertionError("Scoring with {} workers changed the daily table".format(workers))
+            finally:
+                weather.PARALLEL_SCORING_MIN_ROWS = min_rows
+    finally:
+        os.chdir(previous_dir)
+        tracemalloc.stop()
+
+    return {
+        'config': {
+            'sensors': sensors, 'days': days, 'readings_per_day': readings_per_day, 'rows': rows,
+            'queries': queries, 'timeframe_in_days': timeframe_in_days,
+            'percent_to_consider_extreme': percent_to_consider_extreme, 'sensors_to_use': sensors_to_use,
+            'seed': seed, 'scoring_workers': list(scoring_workers),
+        },
+        'stages': timer.stages,
+        'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the weather risk pipeline on synthetic data.")
+    parser.add_argument('--sensors', type=int, default=200)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--readings-per-day', type=int, default=1)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--timeframe-in-days', type=int, default=365)
+    parser.add_argument('--percent-to-consider-extreme', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scoring-workers', default='',
+                        help="Comma separated process counts to build the daily table with, e.g. 1,2,4")
+    parser.add_argument('--output', help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    scoring_workers = [int(workers) for workers in args.scoring_workers.split(',') if workers.strip()]
+    report = run_benchmark(args.sensors, args.days, args.readings_per_day, args.queries, args.timeframe_in_days,
+                           args.percent_to_consider_extreme, seed=args.seed, scoring_workers=scoring_workers)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,11 @@ import pandas as pd
 import numpy as np
 import kagglehub
 from kagglehub import KaggleDatasetAdapter
-import os.path, pickle
+import os.path, pickle, tempfile, threading, json, shutil, io
+from collections import namedtuple
 from time import time
+from ML.atomic_files import write_file_atomically
+from ML.parallel_scoring import CHUNKS_PER_WORKER, parallel_decision_function, split_evenly
 """Weather_Detection_Model.ipynb
 
 """
@@ -16,8 +19,137 @@ from time import time
 # Redownload if dataset is [by default] a day or greater out of date
 DATASET_TIMEOUT_SECONDS = 86400
 
+# Version changes with each day, so we use a different path for our backup
+# than the .../.cache/ one.
+LOCAL_DATASET_DIR = "./last_downloaded_dataset"
+# Where older versions kept the whole dataframe as a single pickle
+LEGACY_DF_PATH = "./last_downloaded_dataset.df"
+
+# Only the columns read by preprocess_dataset and the sensor search are kept
+DATASET_COLUMNS = ['location_name', 'latitude', 'longitude', 'last_updated_epoch', 'last_updated',
+                   'temperature_celsius', 'wind_mph', 'precip_mm', 'humidity', 'gust_mph']
+# Strings are stored as integer codes into a list of their distinct values
+CATEGORICAL_COLUMNS = ['location_name', 'last_updated']
+# Epochs are kept as integers, a float32 would round them to the nearest few minutes
+INTEGER_COLUMNS = ['last_updated_epoch']
+
+# Rows copied at a time when writing columns, keeps memory use flat
+WRITE_CHUNK_ROWS = 1000000
+
+def get_column_categories(parts, column):
+  '''
+  Distinct values of column across parts, in order of first appearance like
+  pd.factorize. Categorical parts keep the order of their categories, so
+  codes of an existing dataset stay the same when rows are appended to it.
+  '''
+  categories = pd.Index([], dtype=object)
+  for part in parts:
+    values = part[column]
+    if isinstance(values.dtype, pd.CategoricalDtype):
+      values = pd.Index(values.cat.categories, dtype=object)
+    else:
+      values = pd.Index(pd.unique(values.dropna()), dtype=object)
+    categories = categories.append(values[~values.isin(categories)])
+  return categories
+
+def save_dataset_columns(dataset_df, dataset_dir=LOCAL_DATASET_DIR):
+  '''
+  Saves the columns in DATASET_COLUMNS as one .npy file each, so they can be
+  memory-mapped by load_dataset_columns. Numeric readings are stored as
+  float32 and strings as int32 codes, with the distinct strings in meta.json.
+
+  dataset_df can also be a list of dataframes, which are saved one after the
+  other as a single version. Rows are copied WRITE_CHUNK_ROWS at a time, so
+  appending a few rows to a large memory-mapped dataset never loads all of it.
+
+  Every version is written to its own directory and then made current by
+  atomically rewriting the CURRENT file, so processes still reading the
+  previous version are never handed a partially written one.
+  '''
+  parts = dataset_df if isinstance(dataset_df, list) else [dataset_df]
+  rows = sum(len(part) for part in parts)
+  if rows == 0:
+    raise ValueError("Cannot save an empty weather dataset")
+
+  os.makedirs(dataset_dir, exist_ok=True)
+  version = "{}-{}".format(rows, max(int(part['last_updated_epoch'].max()) for part in parts if len(part)))
+  version_dir = os.path.join(dataset_dir, version)
+
+  if not os.path.isdir(version_dir):
+    tmp_dir = tempfile.mkdtemp(dir=dataset_dir, prefix=".tmp-")
+    meta = {'rows': rows, 'categories': {}}
+    for column in DATASET_COLUMNS:
+      if column in CATEGORICAL_COLUMNS:
+        categories = get_column_categories(parts, column)
+        meta['categories'][column] = [str(_) for _ in categories]
+        encode = lambda block: pd.Categorical(block, categories=categories).codes
+        dtype = np.int32
+      else:
+        encode = lambda block: block.to_numpy()
+        dtype = np.int64 if column in INTEGER_COLUMNS else np.float32
+
+      values = np.lib.format.open_memmap(os.path.join(tmp_dir, column + ".npy"), mode='w+', dtype=dtype, shape=(rows,))
+      offset = 0
+      for part in parts:
+        for start in range(0, len(part), WRITE_CHUNK_ROWS):
+          block = part[column].iloc[start:start + WRITE_CHUNK_ROWS]
+          values[offset:offset + len(block)] = encode(block)
+          offset += len(block)
+      values.flush()
+      del values
+
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as meta_file:
+      json.dump(meta, meta_file)
+    try:
+      os.replace(tmp_dir, version_dir)
+    except OSError:
+      # Another process finished saving the same version first
+      shutil.rmtree(tmp_dir, ignore_errors=True)
+      if not os.path.isdir(version_dir):
+        raise
+
+  write_file_atomically(os.path.join(dataset_dir, "CURRENT"), version.encode())
+
+  # Open memory maps keep their pages after an unlink, so removing old
+  # versions is safe even while another process is still using one
+  for old_version in os.listdir(dataset_dir):
+    if old_version not in (version, "CURRENT") and not old_version.startswith("."):
+      shutil.rmtree(os.path.join(dataset_dir, old_version), ignore_errors=True)
+
+def get_current_dataset_fingerprint(dataset_dir=LOCAL_DATASET_DIR):
+  '''
+  Fingerprint (see get_dataset_fingerprint) of the current dataset version,
+  read from its version name without loading it, or None if there is none.
+  '''
+  try:
+    with open(os.path.join(dataset_dir, "CURRENT")) as current_file:
+      rows, newest = current_file.read().strip().split("-")
+    return (int(rows), int(newest))
+  except (FileNotFoundError, ValueError):
+    return None
+
+def load_dataset_columns(dataset_dir=LOCAL_DATASET_DIR):
+  '''
+  Loads the current dataset version written by save_dataset_columns. Every
+  column is memory-mapped read-only, so only the pages actually touched are
+  read, and worker processes on the same machine share one copy of them in
+  the page cache.
+  '''
+  with open(os.path.join(dataset_dir, "CURRENT")) as current_file:
+    version_dir = os.path.join(dataset_dir, current_file.read().strip())
+  with open(os.path.join(version_dir, "meta.json")) as meta_file:
+    meta = json.load(meta_file)
+
+  columns = {}
+  for column in DATASET_COLUMNS:
+    values = np.load(os.path.join(version_dir, column + ".npy"), mmap_mode='r')
+    if column in CATEGORICAL_COLUMNS:
+      values = pd.Categorical.from_codes(values, categories=meta['categories'][column], validate=False)
+    columns[column] = values
+
+  return pd.DataFrame(columns, copy=False)
+
 def download_dataset(save=True):
-  LOCAL_DF_PATH = "./last_downloaded_dataset.df"
   """
   In production save should always be true, mostly included
   as a toggle as good practice.
@@ -30,39 +162,113 @@ def download_dataset(save=True):
       KaggleDatasetAdapter.PANDAS,
       "nelgiriyewithana/global-weather-repository",
       "GlobalWeatherRepository.csv",
+      pandas_kwargs={'usecols': DATASET_COLUMNS},
     )
-  
+
   if save:
-    with open(LOCAL_DF_PATH,"wb") as df_file:
-      pickle.dump(dataset_df, df_file)
+    save_dataset_columns(dataset_df)
+    return load_dataset_columns()
 
   return dataset_df
 
 def get_dataset(force_reload=False):
 
-  # Version changes with each day, so we use a different path for our backup
-  # than the .../.cache/ one.
-  LOCAL_DF_PATH = "./last_downloaded_dataset.df"
-
   # If dataset download fails for any reason, use the backup
   if force_reload:
     dataset_df = download_dataset()
   else:
     try:
-      if os.path.isfile(LOCAL_DF_PATH):
-        with open(LOCAL_DF_PATH, 'rb') as df_file:
-          dataset_df = pickle.load(df_file)
-        if abs(dataset_df.max()['last_updated_epoch'] - time()) >= DATASET_TIMEOUT_SECONDS:
-          print("Dataset is old, redownloading")
-          dataset_df = download_dataset()
+      if os.path.isfile(os.path.join(LOCAL_DATASET_DIR, "CURRENT")):
+        dataset_df = load_dataset_columns()
+      elif os.path.isfile(LEGACY_DF_PATH):
+        # Convert the old single pickle backup over to the columnar format
+        with open(LEGACY_DF_PATH, 'rb') as df_file:
+          save_dataset_columns(pickle.load(df_file))
+        dataset_df = load_dataset_columns()
       else:
         raise FileNotFoundError("Local dataset backup not found.")
+      if abs(dataset_df['last_updated_epoch'].max() - time()) >= DATASET_TIMEOUT_SECONDS:
+        print("Dataset is old, refreshing")
+        dataset_df = refresh_dataset() if INCREMENTAL_REFRESH else download_dataset()
     except FileNotFoundError:
       dataset_df = download_dataset()
 
   return dataset_df
 
 
+# Rows read from the source CSV at a time during an incremental refresh
+INGEST_CHUNK_ROWS = 100000
+# Refresh a stale dataset by appending new readings instead of replacing it
+INCREMENTAL_REFRESH = True
+
+def ingest_weather_csv(source, dataset_dir=LOCAL_DATASET_DIR, chunksize=INGEST_CHUNK_ROWS):
+  '''
+  Appends the new readings in a GlobalWeatherRepository CSV (a local path or
+  anything pd.read_csv accepts) to the local dataset as a new version.
+
+  The CSV is read chunksize rows at a time. A reading is only kept if it is
+  newer than the newest one already stored for its location (that location's
+  high-water mark), and duplicates on (location_name, last_updated_epoch)
+  are dropped.
+
+  RETURNS: (dataset_df, new_rows), the dataset after ingesting (the current
+  one if nothing was new) and the readings that were appended.
+  '''
+  current_df = None
+  high_water_marks = pd.Series(dtype=np.int64)
+  if os.path.isfile(os.path.join(dataset_dir, "CURRENT")):
+    current_df = load_dataset_columns(dataset_dir)
+    high_water_marks = current_df.groupby('location_name', observed=True)['last_updated_epoch'].max()
+    high_water_marks.index = high_water_marks.index.astype(object)
+
+  # Each chunk is deduplicated on its own and against the keys kept from earlier
+  # chunks, so no chunk is ever compared with all the rows read before it
+  new_parts = []
+  seen_keys = set()
+  for chunk in pd.read_csv(source, usecols=DATASET_COLUMNS, chunksize=chunksize):
+    newest_stored = chunk['location_name'].map(high_water_marks).fillna(-1)
+    chunk = chunk[chunk['last_updated_epoch'] > newest_stored][DATASET_COLUMNS]
+    chunk = chunk.drop_duplicates(subset=['location_name', 'last_updated_epoch'])
+    keys = list(zip(chunk['location_name'], chunk['last_updated_epoch']))
+    unseen = np.fromiter((key not in seen_keys for key in keys), dtype=bool, count=len(keys))
+    seen_keys.update(keys)
+    if unseen.any():
+      new_parts.append(chunk[unseen])
+
+  if not new_parts:
+    return current_df, pd.DataFrame(columns=DATASET_COLUMNS)
+
+  # save_dataset_columns copies the parts one after the other, they are only concatenated for the return value
+  save_dataset_columns([current_df] + new_parts if current_df is not None else new_parts, dataset_dir)
+  return load_dataset_columns(dataset_dir), pd.concat(new_parts, ignore_index=True)
+
+def refresh_dataset(source=None):
+  '''
+  Incremental alternative to download_dataset. Ingests source (by default
+  the CSV downloaded by kagglehub) with ingest_weather_csv, then updates the
+  cached features, model, sensor index and daily table for the sensors that
+  got new readings instead of rebuilding them.
+
+  The fitted model and its normalisation are carried over until the dataset
+  has grown by MODEL_REFIT_NEW_ROWS rows or the fit is MODEL_REFIT_MAX_AGE_SECONDS
+  old, then everything is refit and rebuilt on the refreshed dataset.
+  '''
+  if source is None:
+    path = kagglehub.dataset_download("nelgiriyewithana/global-weather-repository")
+    source = os.path.join(path, "GlobalWeatherRepository.csv")
+
+  previous_df = None
+  if os.path.isfile(os.path.join(LOCAL_DATASET_DIR, "CURRENT")):
+    previous_df = load_dataset_columns()
+
+  dataset_df, new_rows = ingest_weather_csv(source)
+  if previous_df is not None and len(new_rows):
+    update_derived_state(previous_df, dataset_df, new_rows)
+  print("Added {} new readings to the dataset".format(len(new_rows)))
+
+  return dataset_df
+
+
 def preprocess_dataset(dataset_df, normalise=True):
   # Seperate x (data) from y (labels) from everything else we dont want atall
   # Define MIN/MAX weather thresholds
@@ -73,8 +279,7 @@ def preprocess_dataset(dataset_df, normalise=True):
   MAX_HUMIDITY = 100
   MIN_HUMIDITY = 0
 
-  # default value is wind_kph
-  x_no_date = dataset_df.iloc[:, 10:11]
+  x_no_date = dataset_df[['wind_mph']]
 
   # btw, the reason pressure is left out is because it completely breaks
   # outlier detection for some reason. maybe due to the way its distributed?
@@ -101,72 +306,248 @@ def preprocess_dataset(dataset_df, normalise=True):
     normalised_x=(x_df-x_df.min())/(x_df.max()-x_df.min())
   return normalised_x
 
+# Columns the model is fit on, in the order preprocess_dataset puts them
+FEATURE_COLUMNS = ['wind_mph', 'temperature_celsius', 'precip_mm', 'humidity', 'gust_mph']
+
+LOCAL_FEATURES_FILE = "./last_preprocessed_features.npz"
+
+# normalised_x: filtered, min/max normalised feature matrix the model is fit on
+# x_min, x_max: per feature minimum and maximum of the filtered raw readings
+# normalisation_coeff: what readings are divided by before being scored
+PreparedFeatures = namedtuple('PreparedFeatures', ['normalised_x', 'x_min', 'x_max', 'normalisation_coeff'])
+
+def prepare_features(dataset_df):
+  '''
+  Runs preprocess_dataset once and derives everything the scoring functions
+  need from it, so the dataset only has to be filtered once per version.
+  '''
+  raw_x = preprocess_dataset(dataset_df, normalise=False)[FEATURE_COLUMNS]
+  x_min = raw_x.min()
+  x_max = raw_x.max()
+  normalised_x = ((raw_x - x_min) / (x_max - x_min)).to_numpy()
+  return PreparedFeatures(normalised_x, x_min, x_max, x_max)
+
+def save_prepared_features(features, fingerprint, fit_fingerprint=None):
+  '''
+  Saves features as the ones to use for the dataset version fingerprint.
+  fit_fingerprint is the version they were computed on, when they were
+  carried over from an earlier version by an incremental refresh.
+  '''
+  buffer = io.BytesIO()
+  np.savez(buffer, fingerprint=np.asarray(fingerprint), fit_fingerprint=np.asarray(fit_fingerprint or fingerprint),
+           normalised_x=features.normalised_x,
+           x_min=features.x_min.to_numpy(), x_max=features.x_max.to_numpy(),
+           normalisation_coeff=features.normalisation_coeff.to_numpy())
+  write_file_atomically(LOCAL_FEATURES_FILE, buffer.getvalue())
+
+def load_prepared_features(fingerprint):
+  '''
+  Returns the saved PreparedFeatures if they were computed on the dataset
+  version given by fingerprint, otherwise None.
+  '''
+  try:
+    with np.load(LOCAL_FEATURES_FILE) as saved:
+      if tuple(saved['fingerprint'].tolist()) != tuple(fingerprint):
+        return None
+      return PreparedFeatures(
+        saved['normalised_x'],
+        pd.Series(saved['x_min'], index=FEATURE_COLUMNS),
+        pd.Series(saved['x_max'], index=FEATURE_COLUMNS),
+        pd.Series(saved['normalisation_coeff'], index=FEATURE_COLUMNS),
+      )
+  except (FileNotFoundError, ValueError, KeyError, EOFError):
+    return None
+
+def get_prepared_features(dataset_df, fingerprint):
+  '''
+  Returns the PreparedFeatures for dataset_df, read back from
+  LOCAL_FEATURES_FILE if they were already saved for this dataset version,
+  otherwise computed and saved.
+  '''
+  features = load_prepared_features(fingerprint)
+  if features is None:
+    features = prepare_features(dataset_df)
+    save_prepared_features(features, fingerprint)
+  return features
+
 """
 # Model
 
 # Training
 """
 
-def create_model(normalised_x, load_saved=False):
+LOCAL_MODEL_PARAMS_FILE = "./last_trained_model"
+
+def save_pickle_atomically(obj, path):
+  write_file_atomically(path, pickle.dumps(obj))
+
+def create_model(normalised_x, load_saved=False, fingerprint=None, save=True):
 
   import numpy as np
   from sklearn.neighbors import LocalOutlierFactor
 
-  LOCAL_MODEL_PARAMS_FILE = "./last_trained_model"
-
   lof = LocalOutlierFactor(n_neighbors=20, novelty=True)
   if load_saved:
     #try:
       with open(LOCAL_MODEL_PARAMS_FILE, "rb") as model_file:
         anomalies = pickle.load(model_file)
+      # Saved models are stored along with the dataset version they were fit on
+      if isinstance(anomalies, dict):
+        anomalies = anomalies['model']
     #except:
     #  print("Error loading model file. Aborting.")
     #  raise IOError
   else:
-    anomalies = lof.fit(normalised_x.values)
-    with open(LOCAL_MODEL_PARAMS_FILE, "wb") as model_file:
-      pickle.dump(anomalies, model_file)
+    anomalies = lof.fit(np.asarray(normalised_x))
+    # Unsaved fits are for one-off uses, so they don't replace the model kept for the dataset version
+    if save:
+      save_pickle_atomically({'fingerprint': fingerprint, 'fit_fingerprint': fingerprint, 'fitted_at': time(),
+                              'model': anomalies}, LOCAL_MODEL_PARAMS_FILE)
 
   return anomalies
 
+def load_model_record(fingerprint):
+  '''
+  Returns the saved model record (the model, the dataset version it is used
+  for, the version it was actually fit on and when) if it is the one to use
+  for the dataset version given by fingerprint, otherwise None.
+  '''
+  try:
+    with open(LOCAL_MODEL_PARAMS_FILE, "rb") as model_file:
+      saved = pickle.load(model_file)
+  except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+    return None
+  if isinstance(saved, dict) and saved.get('fingerprint') == fingerprint:
+    return saved
+  return None
+
+def load_model_for_fingerprint(fingerprint):
+  '''
+  Returns the saved model if it is the one to use for the dataset version
+  given by fingerprint, otherwise None.
+  '''
+  record = load_model_record(fingerprint)
+  return record['model'] if record is not None else None
+
+# A model carried over by incremental refreshes is refit once the dataset has
+# this many rows more than the version it was fit on, or once it is this old
+MODEL_REFIT_NEW_ROWS = 100000
+MODEL_REFIT_MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+
+def model_needs_refit(record, dataset_rows):
+  '''
+  Whether the model in a saved record is too far behind a dataset of
+  dataset_rows rows to keep carrying it over. Records saved before the fit
+  version was kept don't say what they were fit on, so they are refit.
+  '''
+  if 'fit_fingerprint' not in record or 'fitted_at' not in record:
+    return True
+  return (dataset_rows - record['fit_fingerprint'][0] >= MODEL_REFIT_NEW_ROWS
+          or time() - record['fitted_at'] >= MODEL_REFIT_MAX_AGE_SECONDS)
+
+def get_trained_model(normalised_x, fingerprint, save=True):
+  '''
+  Returns a model fit on the dataset version given by fingerprint, loading
+  the saved one if it matches and only fitting a new one otherwise. Without
+  save, a newly fit model is not kept in place of the saved one.
+  '''
+  model = load_model_for_fingerprint(fingerprint)
+  if model is None:
+    print("No trained model for this dataset version, fitting a new one")
+    model = create_model(normalised_x, fingerprint=fingerprint, save=save)
+  return model
+
 """# Auxillary Functions"""
 
-from sklearn.metrics.pairwise import haversine_distances
-from math import radians
+from sklearn.neighbors import BallTree
 
-def get_closest_cities_to_lat_lon(lat, lon, city_df, cities_to_keep=3):
+def get_dataset_fingerprint(dataset_df):
   '''
-  Given a latitude, longitude, and dataframe with columns labeled
-  latitude and longitude, outputs the haversine distance for
-  each row to the given lat and longitude.
+  Cheap identifier for a version of the weather dataset. A refresh always
+  changes either the amount of rows or the newest reading, so the pair is
+  enough to tell when anything derived from the dataset has gone stale.
+  '''
+  return (len(dataset_df), int(dataset_df['last_updated_epoch'].max()))
 
-  Returns the input dataframe with an appended haversine distances,
-  sorted such that the first row is the closest city. Only
-  cities_to_keep distinct locations are returned, the rest are
-  trimmed.
+class SensorIndex:
   '''
+  Spatial index over the distinct sensor locations in a weather dataset.
 
-  city_lat_lon_df = city_df.iloc[:, 0:4].join(city_df['last_updated']).join(city_df['wind_mph'])
-  for i in values_to_keep:
-    city_lat_lon_df = city_lat_lon_df.join(city_df[i])
+  Sensors are put in a BallTree using the haversine metric, so finding the
+  k nearest sensors to a point is a tree query rather than a scan over every
+  reading. Rows are grouped by sensor through row_order (row positions
+  sorted by sensor) and row_starts (where each sensor's run of rows begins),
+  so the readings of sensor i are row_order[row_starts[i]:row_starts[i + 1]].
+  '''
+
+  def __init__(self, dataset_df, previous=None):
+    codes, location_names = pd.factorize(dataset_df['location_name'])
+    # Readings without a location can never be matched to a sensor
+    known_rows = np.flatnonzero(codes >= 0)
+    codes = codes[known_rows]
+
+    sensor_order = np.argsort(codes, kind='stable')
+    self.row_order = known_rows[sensor_order]
+    self.row_starts = np.concatenate(([0], np.cumsum(np.bincount(codes, minlength=len(location_names)))))
+    self.location_names = np.asarray(location_names)
+    self.sensor_ids = {name: i for i, name in enumerate(self.location_names)}
+
+    # Rows appended to a dataset come after the old ones, so if no sensor is
+    # new the previous version's tree still has every sensor in place
+    if previous is not None and np.array_equal(previous.location_names, self.location_names):
+      self.tree = previous.tree
+      return
 
-  lat_lon = [lat, lon]
-  lat_lon_r = [radians(_) for _ in lat_lon]
-  city_distances = []
+    # Like drop_duplicates, a sensor's position is taken from its first reading
+    first_rows = self.row_order[self.row_starts[:-1]]
+    lat_lon = dataset_df[['latitude', 'longitude']].to_numpy(dtype=np.float64)[first_rows]
+    self.tree = BallTree(np.radians(lat_lon), metric='haversine')
 
-  for index,i in city_lat_lon_df.iterrows():
-    i_lat_lon = [int(i['latitude']), int(i['longitude'])]
-    i_lat_lon_r = [radians(_) for _ in i_lat_lon]
-    i_distance = haversine_distances([lat_lon_r, i_lat_lon_r])
-    city_distances.append(i_distance[0][0] + i_distance[0][1])
+  def nearest_sensors(self, lat, lon, k=3):
+    '''
+    Returns (distances, sensors) for the k sensors closest to (lat, lon),
+    closest first. Distances are in radians on the unit sphere.
+    '''
+    distances, sensors = self.nearest_sensors_batch([(lat, lon)], k)
+    return distances[0], sensors[0]
 
-  city_df['haversine_distance_to_point'] = city_distances
-  distinct_distance_df = city_df.drop_duplicates(subset=['location_name'])
-  distinct_distance_df = distinct_distance_df.sort_values(by=['haversine_distance_to_point'])
-  city_df = city_df.sort_values(by=['haversine_distance_to_point'])
-  city_df = city_df[(city_df['haversine_distance_to_point'] <= distinct_distance_df.iloc[cities_to_keep]['haversine_distance_to_point'])]
+  def nearest_sensors_batch(self, lat_lon, k=3):
+    '''
+    Same as nearest_sensors for many (lat, lon) pairs in one tree query.
+    Returns two arrays shaped (len(lat_lon), k).
+    '''
+    k = min(k, len(self.location_names))
+    lat_lon_r = np.radians(np.asarray(lat_lon, dtype=np.float64).reshape(-1, 2))
+    return self.tree.query(lat_lon_r, k=k)
 
-  return city_df
+  def rows_for_sensors(self, sensors):
+    '''
+    Returns the dataset row positions belonging to the given sensors, grouped
+    by sensor in the order they were given.
+    '''
+    return np.concatenate([self.row_order[self.row_starts[i]:self.row_starts[i + 1]] for i in sensors])
+
+  def readings_per_sensor(self, sensors):
+    return np.diff(self.row_starts)[sensors]
+
+def get_closest_cities_to_lat_lon(lat, lon, city_df, cities_to_keep=3):
+  '''
+  Given a latitude, longitude, and dataframe with columns labeled
+  location_name, latitude and longitude, finds the cities_to_keep
+  distinct locations closest to the given point.
+
+  Returns only the rows of those locations, with an appended haversine
+  distance to the point, sorted such that the first row is the closest
+  city.
+  '''
+
+  index = get_weather_risk_engine().get_sensor_index(city_df)
+  distances, sensors = index.nearest_sensors(lat, lon, cities_to_keep)
+
+  closest_df = city_df.iloc[index.rows_for_sensors(sensors)].copy()
+  closest_df['haversine_distance_to_point'] = np.repeat(distances, index.readings_per_sensor(sensors))
+
+  return closest_df
 
 # Get cities closest to Newcastle (as an example)
 #get_closest_cities_to_lat_lon(54.9787632, 1.6094462, city_lat_lon_df)
@@ -174,13 +555,17 @@ def get_closest_cities_to_lat_lon(lat, lon, city_df, cities_to_keep=3):
 import datetime as dt
 import numpy as np
 
-def get_extreme_weather_probabilities_over_timeframe(weather_dataset, model, timeframe_in_days=21):
+def get_extreme_weather_probabilities_over_timeframe(weather_dataset, model, normalisation_coeff, timeframe_in_days=21, workers=1):
 
   '''
-  Takes a dataframe of datetime-labelled weather data,and a machine learning model with a
-  predict() method. Over timeframe_in_days since datetime.today(), splits input dataframe into sub-frames split
-  by day and runs predict on each sub-frame. Finally, converts predictions into a per-day probability of
-  extreme weather.
+  Takes a dataframe of datetime-labelled weather data, a machine learning model with a
+  predict() method and the normalisation_coeff of the dataset it was fit on. Over timeframe_in_days
+  since datetime.today(), runs predict once over every reading and groups the predictions by day.
+  Finally, converts predictions into a per-day probability of extreme weather.
+
+  With workers > 1 a large frame is scored by a process pool instead (see
+  score_readings), using decision_function < 0 for outliers exactly as the
+  LocalOutlierFactor's predict() does.
 
   Note: day-based voting is used instead of specifically sensor-based voting because oftentimes
   sensors do not record at exactly the same time. Day-based voting allows us to approximate sensor-based
@@ -193,32 +578,28 @@ def get_extreme_weather_probabilities_over_timeframe(weather_dataset, model, tim
 
   # Set up local variables
   timeframe_end = dt.date.today() - dt.timedelta(days=timeframe_in_days)
-  weather_df = weather_dataset.iloc[:, 6:7].join(weather_dataset['wind_mph'])
 
-  for i in values_to_keep:
-    weather_df = weather_df.join(weather_dataset[i])
+  # last_updated is "YYYY-MM-DD HH:MM", so the day can be compared as a string
+  days = weather_dataset['last_updated'].str.slice(0, 10)
+
   # Drop days that are not in our timeframe
-  for index, i in weather_df.iterrows():
-    if dt.datetime.strptime(i['last_updated'].split(" ")[0],"%Y-%m-%d") < dt.datetime.combine(timeframe_end, dt.datetime.min.time()):
-      weather_df = weather_df.drop(index)
-
-  # Convert dataframe to day-based sub-frames
-  day_weather_dataframes = {}
-  for index, i in weather_df.iterrows():
-    if i['last_updated'].split(" ")[0] not in day_weather_dataframes.keys():
-      day_weather_dataframes[i['last_updated'].split(" ")[0]] = i[1:].to_frame().T
-    else:
-      day_weather_dataframes[i['last_updated'].split(" ")[0]] = day_weather_dataframes[i['last_updated'].split(" ")[0]]._append(i[1:].to_frame().T)
+  in_timeframe = (days >= timeframe_end.isoformat()).to_numpy()
+  days = days[in_timeframe].to_numpy()
+  if len(days) == 0:
+    return []
 
-  # Get day-based probabilities and return
-  pred_probabilities = []
-  for i in day_weather_dataframes.values():
-    i_pred_arr = model.predict(i / normalisation_coeff)
-    pred_probabilities.append(np.sum(i_pred_arr)/len(i_pred_arr))
+  # Score every reading at once, then get day-based probabilities
+  if workers > 1 and len(days) >= PARALLEL_SCORING_MIN_ROWS:
+    scores = score_readings(weather_dataset, np.flatnonzero(in_timeframe), model, normalisation_coeff, workers)
+    predictions = np.where(scores < 0, -1, 1)
+  else:
+    weather_x = weather_dataset[FEATURE_COLUMNS].to_numpy(dtype=np.float64)[in_timeframe]
+    predictions = model.predict(weather_x / normalisation_coeff[FEATURE_COLUMNS].to_numpy())
+  pred_probabilities = pd.Series(predictions).groupby(days, sort=False).mean()
 
-  return pred_probabilities
+  return pred_probabilities.tolist()
 
-def get_extreme_weather_over_timeframe(weather_dataset, model, timeframe_in_days=21, percent_to_consider_extreme=100):
+def get_extreme_weather_over_timeframe(weather_dataset, model, normalisation_coeff, timeframe_in_days=21, percent_to_consider_extreme=100, daily_table=None, workers=1):
 
   '''
   Wrapper for function above, that returns percent of extreme weather days
@@ -227,9 +608,27 @@ def get_extreme_weather_over_timeframe(weather_dataset, model, timeframe_in_days
   percent_to_consider_extreme controls how many readings on a given day need
   to be extreme for a day to be considered extreme. 100 means all readings need
   to be outliers.
+
+  If a DailyWeatherTable for the dataset is given, the answer is looked up
+  for the locations in weather_dataset and the model is not run at all.
+  Otherwise workers is passed on to the function above.
   '''
 
-  prob_arr = [(i + 1) / 2 for i in get_extreme_weather_probabilities_over_timeframe(weather_dataset, model, timeframe_in_days)]
+  if daily_table is not None:
+    sensors = daily_table.sensors_for_locations(weather_dataset['location_name'].unique())
+    return daily_table.get_extreme_weather_over_timeframe(sensors, timeframe_in_days, percent_to_consider_extreme)
+
+  pred_probabilities = get_extreme_weather_probabilities_over_timeframe(weather_dataset, model, normalisation_coeff, timeframe_in_days, workers)
+
+  return get_extreme_day_fraction(pred_probabilities, percent_to_consider_extreme)
+
+def get_extreme_day_fraction(pred_probabilities, percent_to_consider_extreme=100):
+  '''
+  Takes per-day probabilities as returned by
+  get_extreme_weather_probabilities_over_timeframe and returns the fraction
+  of those days that count as extreme.
+  '''
+  prob_arr = [(i + 1) / 2 for i in pred_probabilities]
   non_extreme_events = 0
 
   for i in prob_arr:
@@ -237,6 +636,377 @@ def get_extreme_weather_over_timeframe(weather_dataset, model, timeframe_in_days
 
   return (len(prob_arr) - non_extreme_events) / len(prob_arr)
 
+def get_reading_days(weather_dataset):
+  '''
+  Returns the day of every reading's last_updated as days since 1970-01-01.
+  For categorical columns only the distinct timestamps are parsed.
+  '''
+  last_updated = weather_dataset['last_updated']
+  if isinstance(last_updated.dtype, pd.CategoricalDtype):
+    categories = pd.Series(last_updated.cat.categories)
+    category_days = pd.to_datetime(categories.str.slice(0, 10)).to_numpy().astype('datetime64[D]').astype(np.int32)
+    return category_days[last_updated.cat.codes.to_numpy()]
+  return pd.to_datetime(last_updated.str.slice(0, 10)).to_numpy().astype('datetime64[D]').astype(np.int32)
+
+LOCAL_DAILY_TABLE_FILE = "./last_daily_weather_table.npz"
+# Readings scored per decision_function call while building the table
+DAILY_TABLE_CHUNK_ROWS = 100000
+
+# Worker processes used to score readings, 1 scores in this process. Only
+# worth it for large scoring passes, so smaller ones stay in process anyway.
+SCORING_WORKERS = 1
+PARALLEL_SCORING_MIN_ROWS = 200000
+
+def score_readings(dataset_df, rows, model, normalisation_coeff, workers=None, boundaries=None):
+  '''
+  Returns the model's decision_function for the dataset rows at positions
+  rows. Scored in chunks so the scaled copy of the features stays small.
+
+  With workers > 1 (SCORING_WORKERS by default) and enough rows, the scaled
+  features are written once to shared memory and scored by a process pool,
+  split at the positions in boundaries if given. Scores come back in the
+  same order either way.
+  '''
+  workers = SCORING_WORKERS if workers is None else workers
+  weather_x = dataset_df[FEATURE_COLUMNS]
+  coeff = normalisation_coeff[FEATURE_COLUMNS].to_numpy()
+
+  def scaled_chunks():
+    for start in range(0, len(rows), DAILY_TABLE_CHUNK_ROWS):
+      chunk_rows = rows[start:start + DAILY_TABLE_CHUNK_ROWS]
+      yield start, weather_x.iloc[chunk_rows].to_numpy(dtype=np.float64) / coeff
+
+  if workers > 1 and len(rows) >= PARALLEL_SCORING_MIN_ROWS:
+    def fill_features(target):
+      for start, chunk_x in scaled_chunks():
+        target[start:start + len(chunk_x)] = chunk_x
+    return parallel_decision_function(model, fill_features, len(rows), len(FEATURE_COLUMNS), workers, boundaries)
+
+  scores = np.empty(len(rows))
+  for start, chunk_x in scaled_chunks():
+    scores[start:start + len(chunk_x)] = model.decision_function(chunk_x)
+  return scores
+
+class DailyWeatherTable:
+  '''
+  Every reading in the dataset scored once, and reduced to one row per
+  (location_name, day) holding the amount of readings, how many of them
+  are outliers and their mean LOF score (decision_function, negative
+  means outlier).
+
+  Rows are sorted by sensor then day, and sensor_starts marks where each
+  sensor's days begin, so the days of sensor i are the range
+  sensor_starts[i]:sensor_starts[i + 1]. Any timeframe can then be answered
+  with a binary search inside those ranges instead of a model pass.
+  '''
+
+  def __init__(self, location_names, sensor_starts, days, readings, outliers, mean_scores):
+    self.location_names = np.asarray(location_names)
+    self.sensor_starts = sensor_starts
+    self.days = days
+    self.readings = readings
+    self.outliers = outliers
+    self.mean_scores = mean_scores
+    self.sensor_ids = {name: i for i, name in enumerate(self.location_names)}
+
+  @classmethod
+  def build(cls, dataset_df, index, model, normalisation_coeff, workers=None):
+    row_sensors = np.repeat(np.arange(len(index.location_names)), np.diff(index.row_starts))
+    row_days = get_reading_days(dataset_df)[index.row_order]
+    # row_order is grouped by sensor, parallel scoring hands out whole sensors
+    workers = SCORING_WORKERS if workers is None else workers
+    boundaries = split_evenly(index.row_starts, workers * CHUNKS_PER_WORKER) if workers > 1 else None
+    scores = score_readings(dataset_df, index.row_order, model, normalisation_coeff, workers, boundaries)
+    return cls.from_scores(index.location_names, row_sensors, row_days, scores)
+
+  def rescored(self, dataset_df, index, model, normalisation_coeff, first_new_days, workers=None):
+    '''
+    Returns a table for dataset_df, a newer version of the dataset this table
+    was built on, that only scores what changed. first_new_days maps each
+    location_name with new readings to the earliest day they fall on; only
+    readings of those locations on or after that day are scored again, every
+    other row is carried over from this table.
+    '''
+    sensors = np.asarray([index.sensor_ids[name] for name in first_new_days.keys()], dtype=np.int64)
+    replaced_from = np.full(len(index.location_names), np.iinfo(np.int32).max, dtype=np.int64)
+    replaced_from[sensors] = list(first_new_days.values())
+
+    rows = index.rows_for_sensors(sensors) if len(sensors) else np.empty(0, dtype=np.int64)
+    row_sensors = np.repeat(sensors, index.readings_per_sensor(sensors))
+    row_days = get_reading_days(dataset_df)[rows]
+    changed = row_days >= replaced_from[row_sensors]
+    rows, row_sensors, row_days = rows[changed], row_sensors[changed], row_days[changed]
+    partial = DailyWeatherTable.from_scores(index.location_names, row_sensors, row_days,
+                                            score_readings(dataset_df, rows, model, normalisation_coeff, workers))
+
+    # Carry over this table's days that were not scored again
+    kept_sensors = np.asarray([index.sensor_ids[name] for name in self.location_names], dtype=np.int64)[self.day_sensors()]
+    kept = self.days < replaced_from[kept_sensors]
+
+    day_sensors = np.concatenate((kept_sensors[kept], partial.day_sensors()))
+    days = np.concatenate((self.days[kept], partial.days))
+    order = np.lexsort((days, day_sensors))
+    return DailyWeatherTable(
+      index.location_names,
+      np.searchsorted(day_sensors[order], np.arange(len(index.location_names) + 1)),
+      days[order],
+      np.concatenate((self.readings[kept], partial.readings))[order],
+      np.concatenate((self.outliers[kept], partial.outliers))[order],
+      np.concatenate((self.mean_scores[kept], partial.mean_scores))[order],
+    )
+
+  def day_sensors(self):
+    return np.repeat(np.arange(len(self.location_names)), np.diff(self.sensor_starts))
+
+  @classmethod
+  def from_scores(cls, location_names, row_sensors, row_days, scores):
+    '''
+    Reduces per-reading (sensor, day, decision_function score) arrays to the
+    per-day table. Like predict(), a reading is an outlier when its score is
+    below zero.
+    '''
+    order = np.lexsort((row_days, row_sensors))
+    row_sensors, row_days, scores = row_sensors[order], row_days[order], scores[order]
+
+    new_day = np.ones(len(order), dtype=bool)
+    new_day[1:] = (row_sensors[1:] != row_sensors[:-1]) | (row_days[1:] != row_days[:-1])
+    day_starts = np.flatnonzero(new_day)
+
+    readings = np.diff(np.append(day_starts, len(order))).astype(np.int32)
+    outliers = np.add.reduceat((scores < 0).astype(np.int32), day_starts) if len(order) else np.empty(0, np.int32)
+    mean_scores = (np.add.reduceat(scores, day_starts) / readings if len(order) else np.empty(0)).astype(np.float32)
+    day_sensors = row_sensors[day_starts]
+    sensor_starts = np.searchsorted(day_sensors, np.arange(len(location_names) + 1))
+
+    return cls(location_names, sensor_starts, row_days[day_starts], readings, outliers, mean_scores)
+
+  def sensors_for_locations(self, location_names):
+    return np.asarray([self.sensor_ids[name] for name in location_names if name in self.sensor_ids], dtype=np.int64)
+
+  def day_totals(self, sensors, timeframe_in_days=21):
+    '''
+    Returns (days, readings, outliers) summed over the given sensors for
+    every day within timeframe_in_days since date.today().
+    '''
+    timeframe_end = (np.datetime64(dt.date.today() - dt.timedelta(days=timeframe_in_days), 'D')
+                     .astype(np.int32))
+    selected = []
+    for i in sensors:
+      start, end = self.sensor_starts[i], self.sensor_starts[i + 1]
+      start += np.searchsorted(self.days[start:end], timeframe_end)
+      selected.append(np.arange(start, end))
+    selected = np.concatenate(selected) if selected else np.empty(0, dtype=np.int64)
+
+    days, day_index = np.unique(self.days[selected], return_inverse=True)
+    readings = np.bincount(day_index, weights=self.readings[selected], minlength=len(days))
+    outliers = np.bincount(day_index, weights=self.outliers[selected], minlength=len(days))
+    return days, readings, outliers
+
+  def get_extreme_weather_over_timeframe(self, sensors, timeframe_in_days=21, percent_to_consider_extreme=100):
+    '''
+    Same result as get_extreme_weather_over_timeframe over the readings of
+    the given sensors, from the table alone.
+    '''
+    _, readings, outliers = self.day_totals(sensors, timeframe_in_days)
+    # predict() gives 1 per inlier and -1 per outlier, this is their per-day mean
+    pred_probabilities = (readings - 2 * outliers) / readings
+    return get_extreme_day_fraction(pred_probabilities, percent_to_consider_extreme)
+
+  def save(self, path, fingerprint):
+    buffer = io.BytesIO()
+    np.savez(buffer, fingerprint=np.asarray(fingerprint), location_names=self.location_names.astype(str),
+             sensor_starts=self.sensor_starts, days=self.days, readings=self.readings,
+             outliers=self.outliers, mean_scores=self.mean_scores)
+    write_file_atomically(path, buffer.getvalue())
+
+  @classmethod
+  def load(cls, path, fingerprint):
+    '''
+    Returns the table saved at path if it was built on the dataset version
+    given by fingerprint, otherwise None.
+    '''
+    try:
+      with np.load(path) as saved:
+        if tuple(saved['fingerprint'].tolist()) != tuple(fingerprint):
+          return None
+        return cls(saved['location_names'], saved['sensor_starts'], saved['days'],
+                   saved['readings'], saved['outliers'], saved['mean_scores'])
+    except (FileNotFoundError, ValueError, KeyError, EOFError):
+      return None
+
+def get_daily_weather_table(dataset_df, fingerprint, index, model, normalisation_coeff):
+  '''
+  Returns the DailyWeatherTable for dataset_df, read back from
+  LOCAL_DAILY_TABLE_FILE if it was already built for this dataset version,
+  otherwise built and saved.
+  '''
+  table = DailyWeatherTable.load(LOCAL_DAILY_TABLE_FILE, fingerprint)
+  if table is None:
+    print("Building daily extreme weather table for this dataset version")
+    table = DailyWeatherTable.build(dataset_df, index, model, normalisation_coeff)
+    table.save(LOCAL_DAILY_TABLE_FILE, fingerprint)
+  return table
+
+def update_derived_state(previous_df, dataset_df, new_rows):
+  '''
+  Saves the derived state of dataset_df, which is previous_df with new_rows
+  appended, without redoing work for sensors that got no new readings. The
+  fitted model and its normalisation are carried over as they are and only
+  the affected days of the daily table are scored. The saved model and
+  features keep the version they were really fit on next to the one they are
+  now used for.
+
+  When the carried over model is due a refit (see model_needs_refit), or
+  the previous version's state was never saved, the features, model and
+  daily table are computed from scratch for dataset_df instead.
+  '''
+  previous_fingerprint = get_dataset_fingerprint(previous_df)
+  fingerprint = get_dataset_fingerprint(dataset_df)
+  record = load_model_record(previous_fingerprint)
+  features = load_prepared_features(previous_fingerprint)
+  if record is None or features is None or model_needs_refit(record, len(dataset_df)):
+    print("Refitting the weather model on the refreshed dataset")
+    features = get_prepared_features(dataset_df, fingerprint)
+    model = get_trained_model(features.normalised_x, fingerprint)
+    get_daily_weather_table(dataset_df, fingerprint, SensorIndex(dataset_df), model, features.normalisation_coeff)
+    return
+
+  model = record['model']
+  previous_index = SensorIndex(previous_df)
+  previous_table = get_daily_weather_table(previous_df, previous_fingerprint, previous_index, model,
+                                           features.normalisation_coeff)
+
+  index = SensorIndex(dataset_df, previous=previous_index)
+  new_days = pd.Series(get_reading_days(new_rows)).groupby(new_rows['location_name'].to_numpy()).min()
+  table = previous_table.rescored(dataset_df, index, model, features.normalisation_coeff, new_days.to_dict())
+
+  save_prepared_features(features, fingerprint, fit_fingerprint=record['fit_fingerprint'])
+  save_pickle_atomically(dict(record, fingerprint=fingerprint), LOCAL_MODEL_PARAMS_FILE)
+  table.save(LOCAL_DAILY_TABLE_FILE, fingerprint)
+
+# Everything derived from one version of the dataset. It is never modified
+# once built, so any number of threads can read it without locking.
+WeatherRiskState = namedtuple('WeatherRiskState', ['fingerprint', 'dataset', 'features', 'model', 'index',
+                                                   'daily_table', 'checked_at'])
+
+# How often a loaded dataset is checked for being out of date
+DATASET_CHECK_SECONDS = 600
+
+class WeatherRiskEngine:
+  '''
+  Owns the dataset, sensor index, fitted model, normalisation coefficients
+  and daily table for the current dataset version as one WeatherRiskState.
+
+  Every call reads the state reference once and only uses that, so it is
+  safe to call from many threads at once. A new dataset version is built
+  on the side and swapped in with a single assignment; calls already
+  running finish on the version they started with. Only one thread
+  reloads at a time, while the others keep answering from the old version.
+  '''
+
+  def __init__(self):
+    self._state = None
+    self._reload_lock = threading.Lock()
+
+  def get_state(self, force_reload_dataset=False):
+    state = self._state
+    if state is None or force_reload_dataset:
+      return self.reload(force_reload_dataset)
+
+    if time() - state.checked_at >= DATASET_CHECK_SECONDS and self._reload_lock.acquire(blocking=False):
+      try:
+        if self._state is state:
+          self._reload_locked(force_reload_dataset=False)
+      finally:
+        self._reload_lock.release()
+    return self._state
+
+  def reload(self, force_reload_dataset=False):
+    '''
+    Loads the dataset (redownloading or refreshing it if asked to or out
+    of date) and swaps in its state if it is a new version.
+    '''
+    with self._reload_lock:
+      return self._reload_locked(force_reload_dataset)
+
+  def _reload_locked(self, force_reload_dataset):
+    current = self._state
+    dataset = get_dataset(force_reload_dataset)
+    fingerprint = get_dataset_fingerprint(dataset)
+
+    if current is not None and current.fingerprint == fingerprint:
+      self._state = current._replace(checked_at=time())
+      return self._state
+
+    features = get_prepared_features(dataset, fingerprint)
+    model = get_trained_model(features.normalised_x, fingerprint)
+    index = SensorIndex(dataset, previous=current.index if current is not None else None)
+    daily_table = get_daily_weather_table(dataset, fingerprint, index, model, features.normalisation_coeff)
+
+    self._state = WeatherRiskState(fingerprint, dataset, features, model, index, daily_table, time())
+    return self._state
+
+  def get_sensor_index(self, dataset_df):
+    '''
+    Returns the loaded SensorIndex if dataset_df is the loaded dataset
+    version, otherwise builds one for it.
+    '''
+    state = self._state
+    if state is not None and state.fingerprint == get_dataset_fingerprint(dataset_df):
+      return state.index
+    return SensorIndex(dataset_df)
+
+  def get_extreme_weather(self, lat, lon, timeframe_in_days=21, percent_to_consider_extreme=100, sensors_to_use=3, force_reload_dataset=False):
+    state = self.get_state(force_reload_dataset)
+    _, sensors = state.index.nearest_sensors(lat, lon, sensors_to_use)
+    sensors = state.daily_table.sensors_for_locations(state.index.location_names[sensors])
+
+    return state.daily_table.get_extreme_weather_over_timeframe(sensors, timeframe_in_days, percent_to_consider_extreme)
+
+  def get_extreme_weather_batch(self, coords, timeframe_in_days=21, percent_to_consider_extreme=100, sensors_to_use=3, force_reload_dataset=False):
+    state = self.get_state(force_reload_dataset)
+    _, point_sensors = state.index.nearest_sensors_batch(coords, sensors_to_use)
+    return self.get_extreme_weather_for_sensors(state, point_sensors, timeframe_in_days, percent_to_consider_extreme)
+
+  @staticmethod
+  def get_extreme_weather_for_sensors(state, point_sensors, timeframe_in_days=21, percent_to_consider_extreme=100):
+    '''
+    Returns the extreme weather fraction for each row of point_sensors, a
+    (points, k) array of sensors of state.index, or None where those sensors
+    have no readings in the timeframe. Points sharing the same set of sensors
+    are only answered once.
+    '''
+    if len(point_sensors) == 0:
+      return []
+    point_sensors = np.sort(np.asarray(point_sensors).reshape(len(point_sensors), -1), axis=1)
+    sensor_sets, point_sets = np.unique(point_sensors, axis=0, return_inverse=True)
+
+    set_results = []
+    for sensors in sensor_sets:
+      sensors = state.daily_table.sensors_for_locations(state.index.location_names[sensors])
+      _, readings, outliers = state.daily_table.day_totals(sensors, timeframe_in_days)
+      if len(readings) == 0:
+        set_results.append(None)
+        continue
+      pred_probabilities = (readings - 2 * outliers) / readings
+      set_results.append(get_extreme_day_fraction(pred_probabilities, percent_to_consider_extreme))
+
+    return [set_results[i] for i in np.ravel(point_sets)]
+
+_weather_risk_engine = None
+_weather_risk_engine_lock = threading.Lock()
+
+def get_weather_risk_engine():
+  '''
+  Returns this process's WeatherRiskEngine, creating it on first use.
+  '''
+  global _weather_risk_engine
+  if _weather_risk_engine is None:
+    with _weather_risk_engine_lock:
+      if _weather_risk_engine is None:
+        _weather_risk_engine = WeatherRiskEngine()
+  return _weather_risk_engine
+
 def get_extreme_weather(lat, lon, timeframe_in_days=21, percent_to_consider_extreme=100, sensors_to_use=3, force_reload_dataset=False):
   """
   This is a wrapper designed to be used by anyone. Does all the
@@ -249,16 +1019,20 @@ def get_extreme_weather(lat, lon, timeframe_in_days=21, percent_to_consider_extr
   sensors_to_use: how many sensors to use. Sensors will always be used closest
   to furthest so =3 means 3 closest sensors to (lat, long) will be used.
   """
-  global values_to_keep
-  global normalisation_coeff
-  values_to_keep = ['temperature_celsius', 'precip_mm', 'humidity', 'gust_mph']
-  dataset = get_dataset(force_reload_dataset)
-  normalised_x = preprocess_dataset(dataset)
-  normalisation_coeff = preprocess_dataset(dataset, normalise=False).max()
-  closest_x = get_closest_cities_to_lat_lon(lat, lon, dataset, sensors_to_use)
-  model = create_model(normalised_x)
+  return get_weather_risk_engine().get_extreme_weather(lat, lon, timeframe_in_days, percent_to_consider_extreme,
+                                                       sensors_to_use, force_reload_dataset)
 
-  return get_extreme_weather_over_timeframe(closest_x, model, timeframe_in_days, percent_to_consider_extreme)
+def get_extreme_weather_batch(coords, timeframe_in_days=21, percent_to_consider_extreme=100, sensors_to_use=3, force_reload_dataset=False):
+  """
+  Same as get_extreme_weather, for many (lat, lon) pairs at once. The
+  closest sensors for every point are found in a single query and all of
+  them are answered from the same dataset version.
+
+  Returns a list with one result per coordinate, in input order. A point
+  whose sensors have no readings in the timeframe gets None.
+  """
+  return get_weather_risk_engine().get_extreme_weather_batch(coords, timeframe_in_days, percent_to_consider_extreme,
+                                                             sensors_to_use, force_reload_dataset)
 
 def visualise_model(x='wind_mph', y='precip_mm', model=None, dataset=None):
   from mlxtend.plotting import plot_decision_regions
@@ -271,7 +1045,7 @@ def visualise_model(x='wind_mph', y='precip_mm', model=None, dataset=None):
   normalised_x = preprocess_dataset(dataset)
   raw_x = preprocess_dataset(dataset, normalise=False)
   if model == None:
-    model = create_model(normalised_x)
+    model = get_trained_model(normalised_x, get_dataset_fingerprint(dataset), save=False)
 
   raw_x['predictions'] = model.predict(normalised_x)
   inliers = raw_x[(raw_x.predictions == 1)]
@@ -291,7 +1065,7 @@ def fetch_and_save_visualisations(y_arr=['wind_mph', 'gust_mph', 'humidity','tem
   if x_equals_y:
     fallback_x_arr = y_arr
   dataset = get_dataset()
-  model = create_model(preprocess_dataset(get_dataset()))
+  model = get_trained_model(preprocess_dataset(dataset), get_dataset_fingerprint(dataset), save=False)
   for i in y_arr:
     for ii in fallback_x_arr:
       if i != ii:
@@ -129,6 +129,46 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Geocode cache (core.geocoding): how long found postcodes and misses are trusted,
+# and the offline gazetteer CSV loaded by `manage.py preload_gazetteer`
+GEOCODE_CACHE_TTL_SECONDS = 90 * 24 * 60 * 60
+GEOCODE_CACHE_NEGATIVE_TTL_SECONDS = 24 * 60 * 60
+GEOCODE_GAZETTEER_FILE = None
+
+# ETH exchange rates (Equations.eth_converter): how long a rate is used as is, how much longer
+# it is still used while being refreshed in the background, and where rates are kept between restarts
+ETH_RATE_TTL_SECONDS = 300
+ETH_RATE_STALE_SECONDS = 3600
+ETH_RATE_CACHE_FILE = BASE_DIR / 'last_eth_rates.json'
+
+# Damage assessment model loaded by CoreConfig, either the Keras model or a quantized
+# .tflite export of it made with `python -m ML.export_tflite`
+DAMAGE_MODEL_FILE = BASE_DIR / 'ML/models/damageassessment.keras'
+# Versions promoted by retraining (ML.model_registry); the current one is used instead of
+# DAMAGE_MODEL_FILE once there is one, and running processes check for a new one this often
+DAMAGE_MODEL_REGISTRY_DIR = BASE_DIR / 'ML/models/registry'
+DAMAGE_MODEL_CHECK_SECONDS = 30
+
+# Damage assessment of open claims (core.signals.process_claims): images per forward pass
+# of the model, and threads decoding the next batch of images while it runs
+DAMAGE_INFERENCE_BATCH_SIZE = 16
+DAMAGE_DECODE_WORKERS = 4
+# How the scores of a claim's images make its score: 'max' (most severe image),
+# 'mean' (mean of the class probabilities) or 'majority' (most common class)
+DAMAGE_AGGREGATION = 'max'
+# Claim images preprocessed for the damage model when they are uploaded, one .npy per ClaimImage id
+CLAIM_IMAGE_CACHE_DIR = BASE_DIR / 'claim_image_cache'
+# Backbone features of reviewed claim images (ML.embedding_store), so retraining fits only the
+# model's head on stored features; None retrains the whole model from the images
+DAMAGE_EMBEDDING_STORE_DIR = BASE_DIR / 'damage_embeddings'
+
+# Out-of-process damage inference (ML.inference_worker): when enabled the web processes don't load
+# the model, they send images to the worker started with `manage.py run_inference_worker`
+DAMAGE_INFERENCE_WORKER = False
+DAMAGE_INFERENCE_WORKER_ADDRESS = '127.0.0.1:6010'
+DAMAGE_INFERENCE_WORKER_AUTHKEY = SECRET_KEY
+DAMAGE_INFERENCE_TIMEOUT_SECONDS = 600
+
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",
     "http://127.0.0.1:3000",
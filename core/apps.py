@@ -1,19 +1,42 @@
 from django.apps import AppConfig
-import os
 from ML.Damage_Assessment import load_trained_model
 from datetime import datetime
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
     loaded_model = None
+    damage_client = None
     training_data = []
     last_processed_time = None
     def ready(self):
         import core.signals  # Ensure signals are registered
+
+        # Geocode through the database cache instead of asking Nominatim every time
+        from Equations.disaster_risk import NominatimGeocoder, set_geocoder
+        from core.geocoding import CachedGeocoder
+        set_geocoder(CachedGeocoder(NominatimGeocoder()))
+
+        from django.conf import settings
+        from Equations.eth_converter import CryptoCompareRateSource, RateCache, set_rate_cache
+        set_rate_cache(RateCache(CryptoCompareRateSource(), settings.ETH_RATE_TTL_SECONDS,
+                                 settings.ETH_RATE_STALE_SECONDS, str(settings.ETH_RATE_CACHE_FILE)))
+
+        if settings.DAMAGE_INFERENCE_WORKER:
+            # The model lives in the inference worker process, not in every web process
+            from ML.inference_worker import InferenceClient, parse_address
+            CoreConfig.damage_client = InferenceClient(parse_address(settings.DAMAGE_INFERENCE_WORKER_ADDRESS),
+                                                       settings.DAMAGE_INFERENCE_WORKER_AUTHKEY.encode())
+            CoreConfig.last_processed_time = datetime.now()
+            return
+
+        from ML.model_registry import ModelRegistry, ModelWatcher
+        registry = ModelRegistry(settings.DAMAGE_MODEL_REGISTRY_DIR)
+        loaded_version = None
         try:
-            # Define model path
-            base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            model_path = os.path.join(base_dir, 'ML/models/damageassessment.keras')
+            # Define model path, the current registry version, or the Keras model
+            # or its TFLite export until a trained version has been promoted
+            version = registry.current_version()
+            model_path = registry.model_path(version) if version else str(settings.DAMAGE_MODEL_FILE)
 
             # Load model
             CoreConfig.loaded_model = load_trained_model(model_path)
@@ -21,9 +44,22 @@ class CoreConfig(AppConfig):
             # Debugging prints
             if CoreConfig.loaded_model:
                 CoreConfig.last_processed_time = datetime.now()
+                loaded_version = version
                 print("Model loaded successfully in CoreConfig!")
             else:
                 print(" Failed to load model in CoreConfig!")
 
         except Exception as e:
             print(f"Error loading ML model in CoreConfig: {e}")
+
+        # Load newly promoted versions in the background; process_claims reads loaded_model
+        # once per run, so a run in progress finishes on the model it started with
+        ModelWatcher(registry, load_trained_model, CoreConfig.swap_model,
+                     settings.DAMAGE_MODEL_CHECK_SECONDS, loaded_version).start()
+
+    @staticmethod
+    def swap_model(model, version):
+        CoreConfig.loaded_model = model
+        if CoreConfig.last_processed_time is None:
+            CoreConfig.last_processed_time = datetime.now()
+        print(f"Swapped in damage model version {version}")
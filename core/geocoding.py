@@ -0,0 +1,174 @@
+import csv
+import threading
+from datetime import timedelta
+from time import monotonic, sleep
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from core.models import GeocodeCache
+from Equations.disaster_risk import normalise_postcode
+from Equations.single_flight import SingleFlight
+
+# How long a geocoded postcode is trusted before it is looked up again
+DEFAULT_TTL = timedelta(days=90)
+# Misses are kept for less time, the postcode may have been mistyped or just be new
+DEFAULT_NEGATIVE_TTL = timedelta(days=1)
+# Rows written per query when preloading a gazetteer
+GAZETTEER_BATCH_SIZE = 1000
+GAZETTEER_COLUMNS = ["postcode", "country_code", "latitude", "longitude", "display_name"]
+# Source recorded for preloaded gazetteer rows
+GAZETTEER_SOURCE = "GAZETTEER"
+
+
+class CachedGeocoder:
+    """
+    Geocoder backend (see Equations.disaster_risk.set_geocoder) that keeps
+    every answer of another backend in the GeocodeCache table.
+
+    Postcodes that could not be geocoded are cached too, for a shorter time.
+    Concurrent lookups of the same postcode in this process share one call to
+    the backend. If the backend fails while an expired entry exists, the
+    expired entry is returned rather than failing the lookup. Each row records
+    the backend's name attribute (its class name if it has none) as its
+    source. Postcodes found in a gazetteer never expire.
+    """
+
+    def __init__(self, backend, ttl=None, negative_ttl=None):
+        self.backend = backend
+        self.ttl = ttl or timedelta(seconds=getattr(settings, "GEOCODE_CACHE_TTL_SECONDS", DEFAULT_TTL.total_seconds()))
+        self.negative_ttl = negative_ttl or timedelta(
+            seconds=getattr(settings, "GEOCODE_CACHE_NEGATIVE_TTL_SECONDS", DEFAULT_NEGATIVE_TTL.total_seconds()))
+        self._single_flight = SingleFlight()
+
+    def geocode(self, postcode, country_code):
+        key = (normalise_postcode(postcode), country_code.upper())
+        entry = GeocodeCache.objects.filter(postcode=key[0], country_code=key[1]).first()
+        if entry is not None and self._is_fresh(entry):
+            return self._as_location(entry)
+        return self._single_flight.do(key, lambda: self._fetch(key))
+
+    def _fetch(self, key):
+        postcode, country_code = key
+        # Another thread may have stored it while this one waited to get here
+        entry = GeocodeCache.objects.filter(postcode=postcode, country_code=country_code).first()
+        if entry is not None and self._is_fresh(entry):
+            return self._as_location(entry)
+
+        try:
+            location = self.backend.geocode(postcode, country_code)
+        except ValueError:
+            if entry is not None:
+                return self._as_location(entry)
+            raise
+
+        lat, lon, display_name = location if location is not None else (None, None, "")
+        _upsert([GeocodeCache(
+            postcode=postcode,
+            country_code=country_code,
+            latitude=lat,
+            longitude=lon,
+            display_name=display_name[:255],
+            found=location is not None,
+            source=backend_name(self.backend)[:GeocodeCache._meta.get_field("source").max_length],
+            fetched_at=timezone.now(),
+        )])
+        return location
+
+    def _is_fresh(self, entry):
+        if entry.source == GAZETTEER_SOURCE and entry.found:
+            return True
+        ttl = self.ttl if entry.found else self.negative_ttl
+        return timezone.now() - entry.fetched_at < ttl
+
+    @staticmethod
+    def _as_location(entry):
+        if not entry.found:
+            return None
+        return entry.latitude, entry.longitude, entry.display_name
+
+
+class RateLimitedGeocoder:
+    """
+    Geocoder backend that passes lookups on to another one at most
+    per_second times a second, however many threads are calling it.
+    Nominatim's usage policy asks for no more than one request a second.
+    """
+
+    def __init__(self, backend, per_second=1.0):
+        self.backend = backend
+        self.interval = 1.0 / per_second
+        self._lock = threading.Lock()
+        self._next_call = 0.0
+
+    @property
+    def name(self):
+        return backend_name(self.backend)
+
+    def geocode(self, postcode, country_code):
+        with self._lock:
+            now = monotonic()
+            wait = self._next_call - now
+            self._next_call = max(now, self._next_call) + self.interval
+        if wait > 0:
+            sleep(wait)
+        return self.backend.geocode(postcode, country_code)
+
+
+def backend_name(backend):
+    return getattr(backend, "name", type(backend).__name__)
+
+
+def preload_gazetteer(path, batch_size=GAZETTEER_BATCH_SIZE):
+    """
+    Loads a CSV with the columns in GAZETTEER_COLUMNS into the geocode cache,
+    replacing any cached answer for the same postcodes. Returns how many rows
+    were loaded.
+    """
+    loaded = 0
+    fetched_at = timezone.now()
+    with open(path, newline="", encoding="utf-8") as gazetteer_file:
+        reader = csv.DictReader(gazetteer_file)
+        missing = set(GAZETTEER_COLUMNS) - set(reader.fieldnames or [])
+        if missing:
+            raise ValueError(f"Gazetteer is missing columns: {', '.join(sorted(missing))}")
+
+        batch = {}
+        for row in reader:
+            postcode = normalise_postcode(row["postcode"])
+            country_code = row["country_code"].strip().upper()
+            # Later rows win, the same as loading the file row by row
+            batch[(postcode, country_code)] = GeocodeCache(
+                postcode=postcode,
+                country_code=country_code,
+                latitude=float(row["latitude"]),
+                longitude=float(row["longitude"]),
+                display_name=row["display_name"][:255],
+                found=True,
+                source=GAZETTEER_SOURCE,
+                fetched_at=fetched_at,
+            )
+            if len(batch) >= batch_size:
+                loaded += _save_gazetteer_rows(batch.values())
+                batch = {}
+        loaded += _save_gazetteer_rows(batch.values())
+    return loaded
+
+
+def _save_gazetteer_rows(rows):
+    rows = list(rows)
+    with transaction.atomic():
+        _upsert(rows)
+    return len(rows)
+
+
+def _upsert(rows):
+    # A single INSERT ... ON CONFLICT statement, so concurrent writers of the same postcode
+    # neither race on the unique constraint nor deadlock upgrading a read lock as SQLite would
+    GeocodeCache.objects.bulk_create(
+        rows,
+        update_conflicts=True,
+        unique_fields=["postcode", "country_code"],
+        update_fields=["latitude", "longitude", "display_name", "found", "source", "fetched_at"],
+    )
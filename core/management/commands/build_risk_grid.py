@@ -0,0 +1,27 @@
+from time import time
+
+from django.core.management.base import BaseCommand
+
+from Equations.risk_grid import RESOLUTION_DEGREES, RISK_GRID_DIR, TILE_CELLS, build_risk_grid
+
+
+class Command(BaseCommand):
+    help = "Build the precomputed disaster risk grid, rebuilding only tiles touched by new weather or hotspot data"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--grid-dir", default=RISK_GRID_DIR)
+        parser.add_argument("--resolution", type=float, default=RESOLUTION_DEGREES, help="Cell size in degrees")
+        parser.add_argument("--tile-cells", type=int, default=TILE_CELLS, help="Cells per side of a tile")
+        parser.add_argument("--full", action="store_true", help="Rebuild every tile")
+        parser.add_argument("--max-age-days", type=int, help="Also rebuild tiles built this many days ago or more")
+
+    def handle(self, *args, **options):
+        started = time()
+
+        def progress(done, total):
+            if done == total or done % 50 == 0:
+                self.stdout.write(f"  {done}/{total} tiles ({time() - started:.0f}s)")
+
+        rebuilt, tiles = build_risk_grid(options["grid_dir"], options["resolution"], options["tile_cells"],
+                                         full=options["full"], max_age_days=options["max_age_days"], progress=progress)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {rebuilt} of {tiles} tiles in {time() - started:.1f}s"))
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.geocoding import GAZETTEER_COLUMNS, preload_gazetteer
+
+
+class Command(BaseCommand):
+    help = "Preload the geocode cache from an offline gazetteer CSV ({})".format(", ".join(GAZETTEER_COLUMNS))
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", nargs="?", help="Gazetteer CSV, defaults to settings.GEOCODE_GAZETTEER_FILE")
+
+    def handle(self, *args, **options):
+        path = options["path"] or getattr(settings, "GEOCODE_GAZETTEER_FILE", None)
+        if not path:
+            raise CommandError("No gazetteer given and settings.GEOCODE_GAZETTEER_FILE is not set")
+
+        try:
+            loaded = preload_gazetteer(path)
+        except (OSError, ValueError, KeyError) as e:
+            raise CommandError(f"Could not load gazetteer {path}: {e}")
+
+        self.stdout.write(self.style.SUCCESS(f"Loaded {loaded} postcodes from {path}"))
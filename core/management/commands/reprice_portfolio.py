@@ -0,0 +1,121 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, transaction
+
+from core.geocoding import CachedGeocoder, RateLimitedGeocoder
+from core.models import Property
+from core.pricing import CURRENCY_CODES, get_eth_rates, reprice_property
+from Equations.disaster_risk import get_coordinates_from_postcode, get_disaster_risk_for_coordinates, get_geocoder, set_geocoder
+from ML.weather_detection_model import write_file_atomically
+
+CHECKPOINT_FILE = "./reprice_portfolio.checkpoint.json"
+UPDATE_FIELDS = ["riskLevel", "ethHouseValue", "premium"]
+
+
+class Command(BaseCommand):
+    help = "Recompute riskLevel, ethHouseValue and premium for every property, resuming from a checkpoint if asked"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=500, help="Properties scored and saved together")
+        parser.add_argument("--geocode-workers", type=int, default=4, help="Concurrent geocode lookups")
+        parser.add_argument("--geocode-rate", type=float, default=1.0,
+                            help="Most geocoder requests per second that miss the cache")
+        parser.add_argument("--checkpoint", default=CHECKPOINT_FILE)
+        parser.add_argument("--resume", action="store_true", help="Continue after the last property in the checkpoint")
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        checkpoint_path = options["checkpoint"]
+
+        checkpoint = {"last_id": 0, "processed": 0, "scored": 0, "failed": 0}
+        if options["resume"]:
+            try:
+                with open(checkpoint_path) as checkpoint_file:
+                    checkpoint = json.load(checkpoint_file)
+            except FileNotFoundError:
+                raise CommandError(f"No checkpoint at {checkpoint_path} to resume from")
+            self.stdout.write(f"Resuming after property {checkpoint['last_id']} "
+                              f"({checkpoint['processed']} already repriced)")
+
+        eth_rates = get_eth_rates(CURRENCY_CODES.values())
+        properties = (Property.objects.order_by("id")
+                      .only("id", "postcode", "country", "house_value", "currency", *UPDATE_FIELDS))
+        total = checkpoint["processed"] + properties.filter(id__gt=checkpoint["last_id"]).count()
+
+        # Only requests that miss the geocode cache count against the rate limit
+        geocoder = get_geocoder()
+        if isinstance(geocoder, CachedGeocoder):
+            backend = geocoder.backend
+            geocoder.backend = RateLimitedGeocoder(backend, options["geocode_rate"])
+        else:
+            set_geocoder(RateLimitedGeocoder(geocoder, options["geocode_rate"]))
+
+        started = time()
+        repriced_this_run = 0
+        try:
+            with ThreadPoolExecutor(max_workers=options["geocode_workers"]) as pool:
+                # Read a chunk at a time after the last saved id rather than holding one cursor open
+                # for the whole run, SQLite would lock the geocode cache out of writing meanwhile
+                while True:
+                    chunk = list(properties.filter(id__gt=checkpoint["last_id"])[:chunk_size].iterator())
+                    if not chunk:
+                        break
+                    self.reprice_chunk(chunk, pool, eth_rates, checkpoint, checkpoint_path)
+                    repriced_this_run += len(chunk)
+                    self.report(checkpoint, total, repriced_this_run, started)
+        finally:
+            if isinstance(geocoder, CachedGeocoder):
+                geocoder.backend = backend
+            else:
+                set_geocoder(geocoder)
+
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        self.stdout.write(self.style.SUCCESS(
+            f"Repriced {checkpoint['processed']} properties, {checkpoint['scored']} with a new risk level, "
+            f"{checkpoint['failed']} could not be located"))
+
+    def reprice_chunk(self, chunk, pool, eth_rates, checkpoint, checkpoint_path):
+        # Each distinct postcode is geocoded once per chunk
+        locations = {(prop.postcode, prop.country) for prop in chunk if prop.postcode and prop.country}
+        coordinates = dict(zip(locations, pool.map(lambda location: geocode(*location), locations)))
+
+        point_of = [coordinates.get((prop.postcode, prop.country)) for prop in chunk]
+        risk_levels = get_disaster_risk_for_coordinates(point_of)
+
+        for prop, risk_level in zip(chunk, risk_levels):
+            if risk_level is not None:
+                prop.riskLevel = risk_level
+                checkpoint["scored"] += 1
+            else:
+                checkpoint["failed"] += 1
+            reprice_property(prop, eth_rates)
+
+        with transaction.atomic():
+            Property.objects.bulk_update(chunk, UPDATE_FIELDS)
+
+        checkpoint["last_id"] = chunk[-1].id
+        checkpoint["processed"] += len(chunk)
+        write_file_atomically(checkpoint_path, json.dumps(checkpoint).encode())
+
+    def report(self, checkpoint, total, repriced_this_run, started):
+        elapsed = time() - started
+        rate = repriced_this_run / elapsed if elapsed > 0 else 0
+        self.stdout.write(f"  {checkpoint['processed']}/{total} properties, {rate:.1f}/s, "
+                          f"{checkpoint['failed']} without a risk level")
+
+
+def geocode(postcode, country):
+    """(lat, lon) for a property, or None if it cannot be geocoded."""
+    try:
+        lat, lon, _ = get_coordinates_from_postcode(postcode, country)
+        return lat, lon
+    except ValueError:
+        return None
+    finally:
+        # Worker threads each hold their own connection for the cache lookups
+        close_old_connections()
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ML.inference_worker import BATCH_WINDOW_SECONDS, MAX_BATCH_IMAGES, InferenceWorker, parse_address
+from ML.model_registry import ModelRegistry, ModelWatcher
+
+
+class Command(BaseCommand):
+    help = "Load the damage assessment model once and serve it to the web processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--model", help="Model file to serve, instead of the current registry version and its updates")
+        parser.add_argument("--address", default=settings.DAMAGE_INFERENCE_WORKER_ADDRESS)
+        parser.add_argument("--batch-window", type=float, default=BATCH_WINDOW_SECONDS,
+                            help="Seconds a request waits for others to share its batch")
+        parser.add_argument("--max-batch-images", type=int, default=MAX_BATCH_IMAGES)
+
+    def handle(self, *args, **options):
+        from ML.Damage_Assessment import load_trained_model
+
+        registry = ModelRegistry(settings.DAMAGE_MODEL_REGISTRY_DIR)
+        version = None if options["model"] else registry.current_version()
+        model_path = options["model"] or registry.model_path(version) or str(settings.DAMAGE_MODEL_FILE)
+        worker = InferenceWorker(load_trained_model(model_path), parse_address(options["address"]),
+                                 settings.DAMAGE_INFERENCE_WORKER_AUTHKEY.encode(), options["batch_window"],
+                                 options["max_batch_images"], settings.DAMAGE_DECODE_WORKERS)
+
+        if not options["model"]:
+            # The batching thread reads worker.model once per batch, so swapping it never splits a batch
+            def swap_model(model, new_version):
+                worker.model = model
+                self.stdout.write(f"Serving damage model version {new_version}")
+
+            ModelWatcher(registry, load_trained_model, swap_model, settings.DAMAGE_MODEL_CHECK_SECONDS, version).start()
+        worker.serve_forever()
@@ -0,0 +1,38 @@
+import json
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from core.models import Property
+from Equations.loss_simulator import simulate_portfolio_losses, summarise_losses
+from Equations.policy_engine import to_wei
+
+
+class Command(BaseCommand):
+    help = "Simulate aggregate losses of the property portfolio and print mean, VaR and tail VaR in ETH"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scenarios", type=int, default=10000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--workers", type=int, default=None, help="Processes to simulate on, all cores by default")
+        parser.add_argument("--occurrence-scale", type=float, default=1.0,
+                            help="Multiplier turning riskLevel into the chance of a disaster per scenario")
+
+    def handle(self, *args, **options):
+        risk_levels, house_values_wei = [], []
+        # ethHouseValue is in ETH, the payout formulas work in wei
+        for risk_level, eth_house_value in (Property.objects.filter(ethHouseValue__isnull=False)
+                                            .values_list("riskLevel", "ethHouseValue").iterator(chunk_size=10000)):
+            risk_levels.append(risk_level)
+            house_values_wei.append(to_wei(eth_house_value))
+
+        if not risk_levels:
+            self.stdout.write("No properties with an ETH house value to simulate")
+            return
+
+        losses = simulate_portfolio_losses(np.array(risk_levels), house_values_wei, options["scenarios"],
+                                           options["seed"], options["workers"],
+                                           occurrence_scale=options["occurrence_scale"])
+        summary = summarise_losses(losses)
+        summary["policies"] = len(risk_levels)
+        self.stdout.write(json.dumps(summary, indent=2))
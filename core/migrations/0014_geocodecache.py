@@ -0,0 +1,31 @@
+# Generated by Django 5.1.7 on 2026-10-17 09:12
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_remove_property_ethhousevalue1'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodeCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('postcode', models.CharField(max_length=20)),
+                ('country_code', models.CharField(max_length=2)),
+                ('latitude', models.FloatField(blank=True, null=True)),
+                ('longitude', models.FloatField(blank=True, null=True)),
+                ('display_name', models.CharField(blank=True, max_length=255)),
+                ('found', models.BooleanField(default=True)),
+                ('source', models.CharField(choices=[('NOMINATIM', 'Nominatim'), ('GAZETTEER', 'Gazetteer')], default='NOMINATIM', max_length=20)),
+                ('fetched_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('postcode', 'country_code'), name='unique_geocode_postcode_country')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-17 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_geocodecache'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='geocodecache',
+            name='source',
+            field=models.CharField(default='NOMINATIM', max_length=50),
+        ),
+    ]
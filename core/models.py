@@ -1,4 +1,6 @@
+import os
 import secrets
+from django.conf import settings
 from django.db import models
 from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
@@ -131,6 +133,11 @@ class ClaimImage(models.Model):
     def __str__(self):
         return f"Image {self.id} for Claim {self.claim.claim_id}"
 
+    @property
+    def tensor_cache_path(self):
+        """The image resized for the damage model, written when the image is saved (see core.signals)."""
+        return os.path.join(settings.CLAIM_IMAGE_CACHE_DIR, f"{self.id}.npy")
+
 class ReviewDecision(models.Model):
     """
     Stores predefined review decision levels.
@@ -168,3 +175,28 @@ class ClaimReview(models.Model):
 
     def __str__(self):
         return f"Review by {self.employee.email} for Claim {self.claim.claim_id}"
+
+
+class GeocodeCache(models.Model):
+    """
+    Result of geocoding a (postcode, country_code) pair, see core.geocoding.
+    A row with found=False remembers that the postcode could not be geocoded,
+    and source names the geocoder backend or gazetteer the answer came from.
+    """
+
+    postcode = models.CharField(max_length=20)
+    country_code = models.CharField(max_length=2)
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    display_name = models.CharField(max_length=255, blank=True)
+    found = models.BooleanField(default=True)
+    source = models.CharField(max_length=50, default="NOMINATIM")
+    fetched_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["postcode", "country_code"], name="unique_geocode_postcode_country"),
+        ]
+
+    def __str__(self):
+        return f"{self.postcode} ({self.country_code})"
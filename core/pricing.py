@@ -0,0 +1,18 @@
+from Equations.eth_converter import get_eth_rates
+from Equations.premium import calculate_premium_wei
+
+# Property.currency holds the symbol picked in the frontend
+CURRENCY_CODES = {"$": "USD", "£": "GBP", "€": "EUR"}
+
+
+def reprice_property(prop, eth_rates):
+    """
+    Recomputes ethHouseValue and premium the same way get_or_update_property
+    does, with the ETH price of each currency code taken from eth_rates.
+    Properties in a currency without a code keep their ethHouseValue.
+    """
+    code = CURRENCY_CODES.get(prop.currency)
+    if code is not None and prop.house_value is not None:
+        prop.ethHouseValue = float(prop.house_value) / eth_rates[code]
+    if prop.ethHouseValue is not None:
+        prop.premium = calculate_premium_wei(prop.ethHouseValue)
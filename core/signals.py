@@ -1,12 +1,14 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.apps import apps
 from core.models import Claim, ClaimImage, ClaimStatus, Property, ClaimReview
-from ML.Damage_Assessment import calculate_damage_assessment, create_retraining_dataset, train_model
+from ML.Damage_Assessment import aggregate_damage_probabilities, calculate_damage_probabilities_batch, create_retraining_dataset, retrain_head_from_store, save_preprocessed_image, train_model
 from ML.weather_detection_model import get_extreme_weather
 from Equations.disaster_risk import get_coordinates_from_postcode
+import os
 import threading
 from datetime import datetime, timedelta
+from django.conf import settings
 from shamir_mnemonic import generate_mnemonics
 from collections import Counter
 
@@ -60,13 +62,16 @@ def process_claims():
         # Get the CoreConfig dynamically
         core_config = apps.get_app_config('core')
         model = core_config.loaded_model
-        if model is None:
+        if model is None and core_config.damage_client is None:
             raise ValueError("Model is not loaded properly in CoreConfig!")
 
         # Fetch all "OPEN" claims
         open_claims = Claim.objects.filter(status=ClaimStatus.OPEN)
         print(f"Found {open_claims.count()} claim(s) with status OPEN.")
 
+        # Claims that passed the weather check, scored together once they are all collected
+        pending = []
+        cache_paths = {}
         for claim in open_claims:
             if claim.status != ClaimStatus.OPEN:
                 continue
@@ -78,19 +83,36 @@ def process_claims():
                 continue
 
             first_image = claim_images.first()
-            print(f"Using image {first_image.image_file.name} for prediction for Claim ID {claim.claim_id}.")
+            image_paths = [claim_image.image_file.path for claim_image in claim_images]
+            cache_paths.update((claim_image.image_file.path, claim_image.tensor_cache_path) for claim_image in claim_images)
+            print(f"Using {len(image_paths)} image(s) for prediction for Claim ID {claim.claim_id}.")
 
             if claim.status != ClaimStatus.OPEN and claim.manuel_review:
-                core_config.training_data.append([first_image.image_file.path, claim.ml_score])
+                core_config.training_data.append([first_image.image_file.path, claim.ml_score, first_image.tensor_cache_path])
 
-                counts = Counter(label for _, label in core_config.training_data)
+                counts = Counter(item[1] for item in core_config.training_data)
                 if all(counts[label] > 100 for label in [0, 1, 2]):
-                    # Run training on another thread
-                    train_thread = threading.Thread(
-                        target=train_model,
-                        args=(create_retraining_dataset(core_config.training_data),),
-                        daemon=True
-                    )
+                    # Run training on another thread, on stored backbone features when there is a store
+                    if settings.DAMAGE_EMBEDDING_STORE_DIR:
+                        train_thread = threading.Thread(
+                            target=retrain_head_from_store,
+                            args=(list(core_config.training_data), str(settings.DAMAGE_EMBEDDING_STORE_DIR)),
+                            kwargs={'registry_dir': str(settings.DAMAGE_MODEL_REGISTRY_DIR)},
+                            daemon=True
+                        )
+                    else:
+                        train_thread = threading.Thread(
+                            target=train_model,
+                            args=(create_retraining_dataset(core_config.training_data),),
+                            kwargs={
+                                'registry_dir': str(settings.DAMAGE_MODEL_REGISTRY_DIR),
+                                'metadata': {
+                                    'training_samples': len(core_config.training_data),
+                                    'class_counts': {str(label): counts[label] for label in sorted(counts)},
+                                },
+                            },
+                            daemon=True
+                        )
                     train_thread.start()
 
             weather_score = 1 # Assume the worst
@@ -104,18 +126,42 @@ def process_claims():
                 claim.save(update_fields=['manuel_review'])
                 start_review(claim.id, 0)
                 continue
-            ml_score = calculate_damage_assessment(first_image.image_file.path, model=model)
-            print(f"Predicted ML Score for Claim ID {claim.claim_id}: {ml_score[0]}")
+            pending.append((claim, image_paths))
 
-            claim.ml_score = int(ml_score[0])
-            if int(ml_score[0]) != 0:
+        if not pending:
+            return
+
+        # Every image of every pending claim shares the same batches, so a backlog of N
+        # images costs about N / batch size forward passes instead of N
+        image_paths = [image_path for _, claim_image_paths in pending for image_path in claim_image_paths]
+        if core_config.damage_client is not None:
+            probabilities = core_config.damage_client.submit(image_paths, cache_paths).result(settings.DAMAGE_INFERENCE_TIMEOUT_SECONDS)
+        else:
+            probabilities = calculate_damage_probabilities_batch(
+                image_paths,
+                model=model,
+                batch_size=getattr(settings, 'DAMAGE_INFERENCE_BATCH_SIZE', 16),
+                decode_workers=getattr(settings, 'DAMAGE_DECODE_WORKERS', 4),
+                cache_paths=cache_paths,
+            )
+
+        for claim, claim_image_paths in pending:
+            claim_probabilities = [probabilities[path] for path in claim_image_paths if path in probabilities]
+            if not claim_probabilities:
+                print(f"Could not read any image of Claim ID {claim.claim_id}, leaving it open.")
+                continue
+            ml_score = aggregate_damage_probabilities(claim_probabilities, getattr(settings, 'DAMAGE_AGGREGATION', 'max'))
+            print(f"Predicted ML Score for Claim ID {claim.claim_id}: {ml_score}")
+
+            claim.ml_score = ml_score
+            if ml_score != 0:
                 claim.status = "APPROVED"
             else:
                 claim.manuel_review = True
             claim.save(update_fields=['ml_score', 'status', 'manuel_review'])
             print(f"Updated Claim ID {claim.claim_id} with ML Score: {claim.ml_score} and Status: {claim.status}")
 
-            start_review(claim.claim_id,int(ml_score[0]))
+            start_review(claim.claim_id, ml_score)
 
     except Exception as e:
         print(f"Error processing claims: {e}")
@@ -126,6 +172,13 @@ def trigger_background_claim_processing(sender, instance, created, **kwargs):
     """
     Signal to trigger claim processing in a separate thread when a ClaimImage is saved.
     """
+    if created or not os.path.exists(instance.tensor_cache_path):
+        # Decode and resize the upload once here, inference and retraining read the cached array
+        try:
+            save_preprocessed_image(instance.image_file.path, instance.tensor_cache_path)
+        except Exception as e:
+            print(f"Could not preprocess ClaimImage {instance.id}, it will be decoded when scored: {e}")
+
     if created:
         print(f"New ClaimImage was created: {instance.id}, starting background processing...")
         core_config = apps.get_app_config('core')
@@ -135,3 +188,11 @@ def trigger_background_claim_processing(sender, instance, created, **kwargs):
             thread.start()
         else:
             print(f"Claims are processed every 5 minutes, only {datetime.now() - core_config.last_processed_time} has passed.")
+
+
+@receiver(post_delete, sender=ClaimImage)
+def remove_preprocessed_claim_image(sender, instance, **kwargs):
+    try:
+        os.remove(instance.tensor_cache_path)
+    except FileNotFoundError:
+        pass
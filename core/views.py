@@ -19,6 +19,7 @@ from Equations.disaster_risk import get_disaster_risk
 from Equations.eth_converter import convert_fiat_to_eth
 from .models import Claim, User
 from .models import Property, ClaimImage, Employee, ClaimReview
+from .pricing import CURRENCY_CODES
 
 
 @api_view(['POST'])
@@ -223,12 +224,8 @@ def get_or_update_property(request):
 
         prop.currency = request.data.get('currency', prop.currency)
 
-        if prop.currency == "$":
-           prop.ethHouseValue = convert_fiat_to_eth(prop.house_value, "USD")
-        elif prop.currency == "£":
-            prop.ethHouseValue = convert_fiat_to_eth(prop.house_value, "GBP")
-        elif prop.currency == "€":
-            prop.ethHouseValue = convert_fiat_to_eth(prop.house_value, "EUR")
+        if prop.currency in CURRENCY_CODES:
+            prop.ethHouseValue = convert_fiat_to_eth(prop.house_value, CURRENCY_CODES[prop.currency])
 
         prop.premium = calculate_premium_wei(prop.ethHouseValue)
 